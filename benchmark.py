@@ -0,0 +1,148 @@
+import os
+import subprocess
+import sys
+
+# Benchmarks for the prediction pipeline.
+# Run all of them with `python benchmark.py`, or a subset with `python benchmark.py <name> ...`.
+# Each benchmark prints its measurements and returns False if a budget was exceeded.
+
+# --- Budgets ---
+IMPORT_TIME_BUDGET_SECONDS = 0.05 # Entry points must import well under the cost of pandas (~0.4s)
+IMPORT_TIME_REPEATS = 5
+HISTORY_MEMORY_RATIO_BUDGET = 0.05 # Compact history must use under 5% of the DataFrame's memory
+HISTORY_BENCH_RACES_PER_HORSE = 30
+HISTORY_BENCH_HORSES_PER_BACKTEST = 2000 # ~137 races x 15 runners, parents excluded
+MONTE_CARLO_BUDGET_SECONDS = 1.0 # 100k simulated races of a full 18-runner field
+MONTE_CARLO_FIELD_SIZE = 18
+BET_OPTIMIZER_BUDGET_SECONDS = 0.01 # Re-run on every odds update: all 171 wide pairs + 36 singles of an 18-runner field
+BET_OPTIMIZER_REPEATS = 100
+
+# Columns of netkeiba's db_h_race_results table, as returned by get_horse_data.
+HORSE_RESULTS_COLUMNS = [
+    '日付', '開催', '天 気', 'R', 'レース名', '映 像', '頭 数', '枠 番', '馬 番', 'オ ッ ズ', '人 気',
+    '着 順', '騎手', '斤 量', '距離', '馬 場', '馬場 指数', 'タイム', '着差', 'ﾀｲﾑ 指数', '通過',
+    'ペース', 'agari_3f', '馬体重', '厩舎 ｺﾒﾝﾄ', '備考', '勝ち馬 (2着馬)', '賞金',
+]
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def measure_import_time(module_name, repeats=IMPORT_TIME_REPEATS):
+    """Returns the best wall time in seconds for importing module_name in a fresh interpreter."""
+    code = f"import time; t = time.perf_counter(); import {module_name}; print(time.perf_counter() - t)"
+    timings = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", code], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return min(timings)
+
+def bench_import_time():
+    """Import time of the CLI entry points, compared against importing pandas."""
+    pandas_time = measure_import_time("pandas")
+    print(f"  pandas (reference): {pandas_time * 1000:.1f} ms")
+    ok = True
+    for module_name in ("main", "evaluate"):
+        elapsed = measure_import_time(module_name)
+        within = elapsed <= IMPORT_TIME_BUDGET_SECONDS
+        ok = ok and within
+        print(f"  {module_name}: {elapsed * 1000:.1f} ms "
+              f"(budget {IMPORT_TIME_BUDGET_SECONDS * 1000:.0f} ms) {'OK' if within else 'OVER BUDGET'}")
+    return ok
+
+def make_sample_results_df(num_races=HISTORY_BENCH_RACES_PER_HORSE):
+    """Builds a DataFrame shaped like a parsed horse page, with realistic cell values."""
+    import pandas as pd
+    sample_row = {
+        '日付': '2024/04/20', '開催': '3京都5', '天 気': '晴', 'R': 11, 'レース名': 'アンタレスS(GIII)',
+        '映 像': None, '頭 数': 16, '枠 番': 1, '馬 番': 1, 'オ ッ ズ': 4.4, '人 気': 1, '着 順': '1',
+        '騎手': '岩田望', '斤 量': 55.0, '距離': 'ダ1800', '馬 場': '良', '馬場 指数': None, 'タイム': '1:50.1',
+        '着差': 'クビ', 'ﾀｲﾑ 指数': None, '通過': '4-4-5-4', 'ペース': '35.8-37.0', 'agari_3f': 36.9,
+        '馬体重': '470(0)', '厩舎 ｺﾒﾝﾄ': None, '備考': None, '勝ち馬 (2着馬)': 'ミッキーヌチバナ', '賞金': 4100.0,
+    }
+    return pd.DataFrame([sample_row] * num_races, columns=HORSE_RESULTS_COLUMNS)
+
+def bench_history_memory():
+    """Memory per horse and per backtest: results DataFrame vs compact history array."""
+    from history import from_results_df
+    df = make_sample_results_df()
+    df_bytes = int(df.memory_usage(deep=True).sum())
+    compact_bytes = from_results_df(df).nbytes
+    ratio = compact_bytes / df_bytes
+    print(f"  per horse ({HISTORY_BENCH_RACES_PER_HORSE} races): DataFrame {df_bytes / 1024:.1f} KiB, "
+          f"compact {compact_bytes / 1024:.2f} KiB ({ratio:.1%})")
+    print(f"  per backtest ({HISTORY_BENCH_HORSES_PER_BACKTEST} horses): "
+          f"DataFrame {df_bytes * HISTORY_BENCH_HORSES_PER_BACKTEST / 2**20:.1f} MiB, "
+          f"compact {compact_bytes * HISTORY_BENCH_HORSES_PER_BACKTEST / 2**20:.2f} MiB")
+    within = ratio <= HISTORY_MEMORY_RATIO_BUDGET
+    print(f"  budget {HISTORY_MEMORY_RATIO_BUDGET:.0%} {'OK' if within else 'OVER BUDGET'}")
+    return within
+
+def bench_monte_carlo():
+    """Harville closed form and 100k-race Monte Carlo for a full field."""
+    import time
+    import numpy as np
+    from probability import (DEFAULT_SIMULATIONS, harville_probabilities,
+                             scores_to_win_probabilities, simulate_probabilities)
+    scores = np.random.default_rng(0).normal(1000, 300, MONTE_CARLO_FIELD_SIZE)
+    win_probabilities = scores_to_win_probabilities(scores)
+
+    start = time.perf_counter()
+    exact = harville_probabilities(win_probabilities)
+    harville_time = time.perf_counter() - start
+    start = time.perf_counter()
+    simulated = simulate_probabilities(win_probabilities, rng=0)
+    simulation_time = time.perf_counter() - start
+
+    print(f"  Harville ({MONTE_CARLO_FIELD_SIZE} runners): {harville_time * 1000:.1f} ms")
+    print(f"  Monte Carlo ({DEFAULT_SIMULATIONS} races): {simulation_time * 1000:.1f} ms "
+          f"(budget {MONTE_CARLO_BUDGET_SECONDS * 1000:.0f} ms)")
+    print(f"  max |Harville - MC|: place {np.abs(exact['place'] - simulated['place']).max():.4f}, "
+          f"wide {np.abs(exact['wide'] - simulated['wide']).max():.4f}")
+    within = simulation_time <= MONTE_CARLO_BUDGET_SECONDS
+    print(f"  {'OK' if within else 'OVER BUDGET'}")
+    return within
+
+def bench_bet_optimizer():
+    """Expected-value optimisation over every tansho, fukusho and wide ticket of a full field."""
+    import time
+    import numpy as np
+    from betting import optimize_bets
+    from probability import scores_to_win_probabilities
+    rng = np.random.default_rng(0)
+    umaban = list(range(1, MONTE_CARLO_FIELD_SIZE + 1))
+    win_probabilities = scores_to_win_probabilities(rng.normal(1000, 300, MONTE_CARLO_FIELD_SIZE))
+    tansho_odds = np.round(0.8 / scores_to_win_probabilities(rng.normal(1000, 300, MONTE_CARLO_FIELD_SIZE)), 1)
+
+    timings = []
+    for _ in range(BET_OPTIMIZER_REPEATS):
+        start = time.perf_counter()
+        recommended_bets, tickets = optimize_bets(umaban, win_probabilities, tansho_odds)
+        timings.append(time.perf_counter() - start)
+    elapsed = min(timings)
+    print(f"  {MONTE_CARLO_FIELD_SIZE} runners: {elapsed * 1000:.2f} ms "
+          f"(budget {BET_OPTIMIZER_BUDGET_SECONDS * 1000:.0f} ms), {len(tickets)} tickets chosen")
+    within = elapsed <= BET_OPTIMIZER_BUDGET_SECONDS
+    print(f"  {'OK' if within else 'OVER BUDGET'}")
+    return within
+
+BENCHMARKS = {
+    "import_time": bench_import_time,
+    "history_memory": bench_history_memory,
+    "monte_carlo": bench_monte_carlo,
+    "bet_optimizer": bench_bet_optimizer,
+}
+
+if __name__ == '__main__':
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    failed = []
+    for name in selected:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name} (available: {', '.join(BENCHMARKS)})")
+            sys.exit(2)
+        print(f"--- {name} ---")
+        if not BENCHMARKS[name]():
+            failed.append(name)
+    if failed:
+        print(f"\nBudget exceeded: {', '.join(failed)}")
+        sys.exit(1)
+    print("\nAll benchmarks within budget.")
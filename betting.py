@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+
+from probability import fukusho_places, harville_probabilities, scores_to_win_probabilities
+
+# Expected-value bet optimizer.
+# Every tansho, fukusho and C(n, 2) wide ticket is evaluated in one vectorised pass:
+# EV per yen = hit probability x odds - 1. The budget is then spent, one ticket of
+# STAKE_PER_TICKET each, on the highest-EV tickets that clear the thresholds.
+#
+# The shutuba only carries win odds. When fukusho or wide odds are not supplied they
+# are estimated from the win odds: the market's implied win probabilities are pushed
+# through the same Harville model, and odds = payout rate / market probability.
+
+# JRA payout rates per bet type
+PAYOUT_RATES = {'tansho': 0.80, 'fukusho': 0.80, 'wide': 0.775}
+MIN_ODDS = 1.0 # Payouts never go below the stake
+
+DEFAULT_BUDGET = 1000 # yen; same outlay as the fixed 2 tansho + 2 fukusho + 6 wide strategy
+STAKE_PER_TICKET = 100
+MIN_EXPECTED_VALUE = 0.0 # Only buy tickets with positive expected profit
+MIN_HIT_PROBABILITY = 0.02 # Skip longshots whose probability estimate is too noisy to trust
+
+BET_TYPES = ('tansho', 'fukusho', 'wide')
+
+def implied_win_probabilities(tansho_odds):
+    """Market win probabilities from win odds, normalised to sum to 1. Missing odds count as 0."""
+    odds = np.asarray(tansho_odds, dtype=float)
+    inverse = np.where(np.isfinite(odds) & (odds > 0), 1 / np.where(odds > 0, odds, 1), 0)
+    total = inverse.sum()
+    return inverse / total if total > 0 else np.full(len(odds), 1 / len(odds))
+
+def estimate_market_odds(tansho_odds):
+    """Estimated fukusho odds (n,) and wide odds (n, n) from win odds."""
+    market = harville_probabilities(implied_win_probabilities(tansho_odds))
+    # Runners without win odds have no market probability; their tickets get NaN odds and are never bought.
+    with np.errstate(divide='ignore'):
+        fukusho_odds = np.where(market['place'] > 0, np.maximum(MIN_ODDS, PAYOUT_RATES['fukusho'] / market['place']), np.nan)
+        wide_odds = np.where(market['wide'] > 0, np.maximum(MIN_ODDS, PAYOUT_RATES['wide'] / market['wide']), np.nan)
+    return fukusho_odds, wide_odds
+
+def evaluate_candidates(win_probabilities, tansho_odds, fukusho_odds=None, wide_odds=None):
+    """
+    Hit probability, odds and EV of every ticket.
+
+    Returns:
+        dict of equal-length arrays: 'type' (index into BET_TYPES), 'first', 'second'
+        (runner indices; second is -1 for single-runner tickets), 'probability', 'odds', 'ev'.
+    """
+    n = len(win_probabilities)
+    probs = harville_probabilities(win_probabilities, places=fukusho_places(n))
+    if fukusho_odds is None or wide_odds is None:
+        estimated_fukusho, estimated_wide = estimate_market_odds(tansho_odds)
+        fukusho_odds = estimated_fukusho if fukusho_odds is None else fukusho_odds
+        wide_odds = estimated_wide if wide_odds is None else wide_odds
+
+    singles = np.arange(n)
+    pair_first, pair_second = np.triu_indices(n, 1)
+    candidate_type = np.concatenate([np.zeros(n, int), np.ones(n, int), np.full(len(pair_first), 2)])
+    first = np.concatenate([singles, singles, pair_first])
+    second = np.concatenate([np.full(2 * n, -1), pair_second])
+    probability = np.concatenate([probs['win'], probs['place'], probs['wide'][pair_first, pair_second]])
+    odds = np.concatenate([np.asarray(tansho_odds, dtype=float), np.asarray(fukusho_odds, dtype=float),
+                           np.asarray(wide_odds, dtype=float)[pair_first, pair_second]])
+    odds = np.nan_to_num(odds, nan=0.0)
+    return {
+        'type': candidate_type, 'first': first, 'second': second,
+        'probability': probability, 'odds': odds, 'ev': probability * odds - 1,
+    }
+
+def optimize_bets(umaban, win_probabilities, tansho_odds, fukusho_odds=None, wide_odds=None,
+                  budget=DEFAULT_BUDGET, stake=STAKE_PER_TICKET,
+                  min_expected_value=MIN_EXPECTED_VALUE, min_probability=MIN_HIT_PROBABILITY):
+    """
+    Chooses the ticket set with the highest expected value within the budget.
+
+    Args:
+        umaban (list): Horse numbers, aligned with win_probabilities and the odds arrays.
+        win_probabilities (array): Model win probability per runner.
+        tansho_odds (array): Current win odds per runner (NaN when not available).
+        fukusho_odds (array): Place odds per runner, estimated from tansho_odds when None.
+        wide_odds (array): (n, n) wide odds, estimated from tansho_odds when None.
+        budget (int): Yen to spend at most.
+        stake (int): Yen per ticket.
+
+    Returns:
+        tuple: (recommended_bets in main()'s format {'tansho': [...], 'fukusho': [...], 'wide': [(a, b), ...]},
+                list of chosen tickets as dicts with type, umaban, probability, odds and ev)
+    """
+    candidates = evaluate_candidates(win_probabilities, tansho_odds, fukusho_odds, wide_odds)
+    eligible = np.flatnonzero((candidates['ev'] > min_expected_value) & (candidates['probability'] >= min_probability))
+    chosen = eligible[np.argsort(-candidates['ev'][eligible], kind='stable')][:max(0, budget // stake)]
+
+    recommended_bets = {bet_type: [] for bet_type in BET_TYPES}
+    tickets = []
+    for i in chosen:
+        bet_type = BET_TYPES[candidates['type'][i]]
+        horses = umaban[candidates['first'][i]]
+        if bet_type == 'wide':
+            horses = tuple(sorted((umaban[candidates['first'][i]], umaban[candidates['second'][i]])))
+        recommended_bets[bet_type].append(horses)
+        tickets.append({
+            'type': bet_type, 'umaban': horses, 'stake': stake,
+            'probability': float(candidates['probability'][i]),
+            'odds': float(candidates['odds'][i]), 'ev': float(candidates['ev'][i]),
+        })
+    return recommended_bets, tickets
+
+def race_odds(row):
+    """Current win odds of a shutuba row, falling back to the forecast odds before the market opens."""
+    odds = pd.to_numeric(row.get('odds'), errors='coerce')
+    if pd.isna(odds):
+        odds = pd.to_numeric(row.get('yoso_odds'), errors='coerce')
+    return float(odds)
+
+def optimize_race_bets(sorted_horses, budget=DEFAULT_BUDGET):
+    """
+    optimize_bets for main()'s sorted_horses. Each entry needs 'umaban', 'score' and 'odds' (win odds).
+    Entries scored by the ranking model carry 'win_probability', which is used instead of the scores.
+
+    Returns:
+        tuple: (recommended_bets, tickets) as in optimize_bets.
+    """
+    umaban = [int(h['umaban']) for h in sorted_horses]
+    if all('win_probability' in h for h in sorted_horses):
+        win_probabilities = np.array([h['win_probability'] for h in sorted_horses], dtype=float)
+    else:
+        win_probabilities = scores_to_win_probabilities([h['score'] for h in sorted_horses])
+    tansho_odds = np.array([h.get('odds', np.nan) for h in sorted_horses], dtype=float)
+    return optimize_bets(umaban, win_probabilities, tansho_odds, budget=budget)
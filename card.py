@@ -0,0 +1,146 @@
+import json
+import re
+import sys
+
+import pandas as pd
+from bs4 import BeautifulSoup
+
+import main as predictor
+import data_fetcher
+from pipeline import fetch_horse_histories, print_pipeline_stats
+from scraping import fetch_and_save_shutuba_data
+
+# Whole race-day card prediction. All shutuba tables for a date (optionally one venue)
+# are gathered first, the pages the scorer reads across every race are deduplicated and
+# fetched once into data_fetcher's caches, and then every race is scored in one batch.
+#
+#   python card.py <YYYYMMDD> [venue]      e.g. python card.py 20240420 京都
+#   python card.py <kaisai prefix>          e.g. python card.py 2024080101 (10-digit race_id prefix)
+
+RACE_LIST_URL_FORMAT = "https://race.netkeiba.com/top/race_list_sub.html?kaisai_date={kaisai_date}"
+SHUTUBA_URL_FORMAT = "https://race.netkeiba.com/race/shutuba.html?race_id={race_id}"
+CARD_REPORT_FILE_FORMAT = predictor.DATA_DIR + "/card_{name}.json"
+RACES_PER_DAY = 12
+
+# JRA venue codes as used in race_id[4:6]
+VENUE_CODES = {
+    "札幌": "01", "函館": "02", "福島": "03", "新潟": "04", "東京": "05",
+    "中山": "06", "中京": "07", "京都": "08", "阪神": "09", "小倉": "10",
+}
+
+# Shutuba columns naming each kind of entity the scorer looks up (prefetch.SCORER_KINDS):
+# get_horse_score_components reads only the runner's own page.
+ENTITY_COLUMNS = {
+    'horse': 'horse_id',
+}
+
+def get_race_ids_for_date(kaisai_date, venue=None):
+    """Lists the race_ids held on kaisai_date (YYYYMMDD), optionally limited to one venue."""
+    venue_code = VENUE_CODES.get(venue, venue)
+    try:
+        response = data_fetcher.SESSION.get(RACE_LIST_URL_FORMAT.format(kaisai_date=kaisai_date))
+        response.raise_for_status()
+        soup = BeautifulSoup(response.content, "lxml")
+    except Exception as e:
+        print(f"レース一覧の取得中にエラー: {e}")
+        return []
+
+    race_ids = set()
+    for link in soup.find_all('a', href=True):
+        match = re.search(r'race_id=(\d{12})', link['href'])
+        if match and (venue_code is None or match.group(1)[4:6] == venue_code):
+            race_ids.add(match.group(1))
+    return sorted(race_ids)
+
+def get_race_ids_for_kaisai(kaisai_prefix):
+    """Expands a 10-digit race_id prefix (year, venue, kai, day) into that day's races."""
+    return [f"{kaisai_prefix}{race_num:02d}" for race_num in range(1, RACES_PER_DAY + 1)]
+
+def collect_card_entities(shutuba_dfs):
+    """
+    Builds the deduplicated set of entities referenced by a card.
+
+    Returns:
+        tuple: ({kind: set of ids}, {kind: number of references before deduplication})
+    """
+    entities = {kind: set() for kind in ENTITY_COLUMNS}
+    references = {kind: 0 for kind in ENTITY_COLUMNS}
+    for df in shutuba_dfs.values():
+        for kind, column in ENTITY_COLUMNS.items():
+            if column not in df.columns:
+                continue
+            ids = df[column].dropna().astype(str)
+            references[kind] += len(ids)
+            entities[kind].update(ids)
+    return entities, references
+
+def prefetch_card_entities(entities):
+    """Fetches every entity the scorer needs exactly once, filling data_fetcher's caches."""
+    horse_ids = sorted(entities['horse'])
+    print(f"  馬データ取得: {len(horse_ids)}頭 (取得と解析を並行処理)")
+    print_pipeline_stats(fetch_horse_histories(horse_ids))
+
+def predict_card(race_ids):
+    """Scores every race on the card. Returns {race_id: prediction dict} for the races that succeeded."""
+    shutuba_dfs = {}
+    for race_id in race_ids:
+        csv_path = fetch_and_save_shutuba_data(race_id)
+        if csv_path:
+            shutuba_dfs[race_id] = pd.read_csv(csv_path)
+    if not shutuba_dfs:
+        print("出馬表を取得できたレースがありません。")
+        return {}
+
+    entities, references = collect_card_entities(shutuba_dfs)
+    print(f"\n--- {len(shutuba_dfs)}レースの取得対象 (重複除去後 / 参照数) ---")
+    for kind in ENTITY_COLUMNS:
+        print(f"  {kind}: {len(entities[kind])} / {references[kind]}")
+
+    prefetch_card_entities(entities)
+
+    predictions = {}
+    for race_id in shutuba_dfs:
+        sorted_horses, recommended_bets = predictor.main(SHUTUBA_URL_FORMAT.format(race_id=race_id))
+        if sorted_horses and recommended_bets:
+            predictor.save_prediction(race_id, sorted_horses, recommended_bets)
+            predictions[race_id] = predictor.prediction_to_dict(race_id, sorted_horses, recommended_bets)
+    return predictions
+
+def print_card_report(predictions):
+    print("\n=== 開催まとめ ===")
+    for race_id, prediction in predictions.items():
+        top = prediction['horses'][:4]
+        print(f"\n{race_id} ({int(race_id[-2:])}R)")
+        print("  上位: " + ", ".join(f"{h['umaban']} {h['horse_name']} ({h['score']:.0f})" for h in top))
+        print(f"  単勝: {prediction['bets']['tansho']}  複勝: {prediction['bets']['fukusho']}")
+        print(f"  ワイド: {[tuple(c) for c in prediction['bets']['wide']]}")
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("使用法: python card.py <YYYYMMDD> [競馬場名]")
+        print("        python card.py <race_idの先頭10桁>")
+        sys.exit(1)
+
+    target = sys.argv[1]
+    if len(target) == 10:
+        race_ids = get_race_ids_for_kaisai(target)
+        report_name = target
+    else:
+        venue = sys.argv[2] if len(sys.argv) > 2 else None
+        race_ids = get_race_ids_for_date(target, venue)
+        report_name = f"{target}_{VENUE_CODES.get(venue, venue)}" if venue else target
+
+    if not race_ids:
+        print("対象レースが見つかりません。")
+        sys.exit(1)
+
+    predictions = predict_card(race_ids)
+    print_card_report(predictions)
+    if predictions:
+        report_path = CARD_REPORT_FILE_FORMAT.format(name=report_name)
+        try:
+            with open(report_path, 'w', encoding='utf-8') as f:
+                json.dump(predictions, f, ensure_ascii=False)
+            print(f"\nまとめを {report_path} に保存しました。")
+        except OSError as e:
+            print(f"まとめの保存に失敗しました: {e}")
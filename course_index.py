@@ -0,0 +1,344 @@
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import horse_cache
+from history import HISTORY_DTYPE, MISSING, OTHER, SURFACES, TRACK_CONDITIONS, VENUES
+
+# Course par-time and lap-time index.
+# Raw times mean little on their own: 1:33.4 is fast over 芝1600 at 中山 on a heavy track and
+# slow at 東京 on a good one. This index holds the norms of every course (venue, surface,
+# distance, track condition) so the scorer can score times and paces relative to them:
+#
+#   par_time      median winning time
+#   par_first_3f  median first / last 3 furlongs of the race (the ペース column, or Race_LapTime)
+#   par_last_3f
+#   lap_profile   median 200m laps (Race_LapTime of the result pages read by evaluate.py)
+#
+# Built from every history in horse_cache (each race appears once per runner stored, so race-level
+# values are de-duplicated by date and course) and from course_laps.csv. Keys with few races fall
+# back to the course over all conditions, then to the surface and distance over all venues.
+# The arrays are sorted by key code, so a whole history is looked up with one searchsorted call.
+#
+#   course_index.npz   codes (sorted int64), races, par_time, par_first_3f, par_last_3f, lap_profile,
+#                      and each key's races by date: race_offsets, race_dates, race_time, race_first_3f, race_last_3f
+#   course_laps.csv    race_id, date, venue, surface, distance, condition, laps ('12.3-11.0-...')
+#
+#   python course_index.py   rebuild the index and print the busiest courses
+#
+# The stored histories and laps include the races a backtest scores (and later ones), so queries
+# take an as_of date: the pars are then medians over the races before it only, computed from the
+# per-key race arrays (memoised per key and date). Lap profiles are not point-in-time.
+
+COURSE_INDEX_FILE = "/Users/akahoshihiroki/Documents/pytests/keiba_yosou/course_index.npz"
+COURSE_LAPS_FILE = "/Users/akahoshihiroki/Documents/pytests/keiba_yosou/course_laps.csv"
+LAP_COLUMNS = ['race_id', 'date', 'venue', 'surface', 'distance', 'condition', 'laps']
+
+COURSE_INDEX_MAX_AGE_DAYS = 7 # Rebuilt on load when older, to take in newly fetched horses
+MIN_PAR_RACES = 5             # Below this many races a key falls back to the next, coarser key
+ANY = 0                       # venue / condition code of the fallback keys
+LAP_METRES = 200
+PAR_FIELDS = ('par_time', 'par_first_3f', 'par_last_3f')
+
+_index = None # Loaded lazily by get_index
+_recorded_laps = None # race_ids already in COURSE_LAPS_FILE
+
+def course_code(venue, surface, distance, condition=ANY):
+    """Integer key of a course; works on scalars and arrays alike."""
+    return ((np.asarray(venue, dtype=np.int64) * 10 + surface) * 10000 + distance) * 10 + condition
+
+def lap_split(lap_times, distance, metres=600):
+    """
+    Time of the first `metres` of a race from its Race_LapTime laps. Laps are 200m, except the first
+    when the distance is not a multiple of 200 (e.g. 100m of a 2500m race). NaN if the laps do not fit.
+    """
+    laps = np.asarray(lap_times, dtype=float)
+    first = distance % LAP_METRES or LAP_METRES
+    if len(laps) != (distance - first) // LAP_METRES + 1 or distance < metres:
+        return np.nan
+    ends = first + LAP_METRES * np.arange(len(laps)) # metres covered at the end of each lap
+    return float(np.interp(metres, np.concatenate([[0], ends]), np.concatenate([[0], np.cumsum(laps)])))
+
+# --- Building ---
+
+def _load_histories():
+    """Every history array stored by horse_cache (older layouts are skipped)."""
+    histories = []
+    for path in glob.glob(os.path.join(horse_cache.CACHE_DIR, "*.npy")):
+        try:
+            history = np.load(path, allow_pickle=False)
+        except (OSError, ValueError):
+            continue
+        if history.dtype == HISTORY_DTYPE:
+            histories.append(history)
+    return histories
+
+def _read_laps(path=COURSE_LAPS_FILE):
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=LAP_COLUMNS)
+    laps = pd.read_csv(path, dtype={'race_id': str})
+    return laps.drop_duplicates('race_id', keep='last') # Later rows win
+
+def _race_rows(histories, laps):
+    """
+    One row per known race: course, winning time (NaN unless a stored horse won it) and first / last 3F.
+
+    Returns:
+        DataFrame: date, venue, surface, distance, condition, time, first_3f, last_3f, laps (array or None)
+    """
+    rows = np.concatenate(histories) if histories else np.zeros(0, dtype=HISTORY_DTYPE)
+    rows = rows[(rows['venue'] > OTHER) & (rows['surface'] > OTHER) & (rows['distance'] > 0) & ~np.isnat(rows['date'])]
+    races = pd.DataFrame({
+        'date': rows['date'].astype('datetime64[ns]'), 'venue': rows['venue'], 'surface': rows['surface'],
+        'distance': rows['distance'], 'condition': rows['condition'],
+        'time': np.where(rows['rank'] == 1, rows['time'], np.nan),
+        'first_3f': rows['first_3f'], 'last_3f': rows['last_3f'],
+    })
+    race_key = ['date', 'venue', 'surface', 'distance']
+    # 'first' skips NaN, so a race keeps its winning time whichever runner's page holds it
+    races = races.groupby(race_key, as_index=False).agg('first')
+    races['laps'] = None
+
+    if not laps.empty:
+        lap_races = pd.DataFrame({
+            'date': pd.to_datetime(laps['date'], errors='coerce'),
+            'venue': laps['venue'].astype(int), 'surface': laps['surface'].astype(int),
+            'distance': laps['distance'].astype(int), 'condition': laps['condition'].astype(int),
+        })
+        lap_races['laps'] = [np.array([float(lap) for lap in str(value).split('-')]) for value in laps['laps']]
+        lap_races['first_3f'] = [lap_split(l, d) for l, d in zip(lap_races['laps'], lap_races['distance'])]
+        lap_races['last_3f'] = [float(l[-3:].sum()) if len(l) > 3 else np.nan for l in lap_races['laps']] # Last laps are 200m
+        lap_races = lap_races.dropna(subset=['date'])
+        # A race in both sources keeps the history's values and gains its laps
+        races = races.merge(lap_races[race_key + ['laps']], on=race_key, how='left', suffixes=('_drop', ''))
+        races = races.drop(columns='laps_drop')
+        known = races.set_index(race_key).index
+        extra = lap_races[~lap_races.set_index(race_key).index.isin(known)]
+        races = pd.concat([races, extra.assign(time=np.nan)], ignore_index=True)
+    return races
+
+def _level_codes(races, level):
+    """Key code of each race at one fallback level (0: full key, 1: any condition, 2: any venue)."""
+    venue = races['venue'].to_numpy() if level < 2 else ANY
+    condition = races['condition'].to_numpy() if level == 0 else ANY
+    return course_code(venue, races['surface'].to_numpy(), races['distance'].to_numpy(), condition)
+
+def _aggregate(races, key_columns):
+    """Medians per key over a block of races, with lap profiles of the commonest lap count."""
+    grouped = races.groupby(key_columns)
+    table = grouped.agg(races=('distance', 'size'), par_time=('time', 'median'),
+                        par_first_3f=('first_3f', 'median'), par_last_3f=('last_3f', 'median'))
+    profiles = {}
+    for key, laps in grouped['laps']:
+        laps = [l for l in laps if isinstance(l, np.ndarray)] # NaN for races without recorded laps
+        if laps:
+            length = pd.Series([len(l) for l in laps]).mode()[0]
+            profiles[key] = np.median(np.stack([l for l in laps if len(l) == length]), axis=0)
+    table['lap_profile'] = pd.Series([profiles.get(key) for key in table.index], index=table.index, dtype=object)
+    return table.reset_index()
+
+def build_course_index(histories, laps=None):
+    """
+    Builds the index from history arrays and a course_laps.csv table.
+
+    Returns:
+        dict: 'codes' (sorted), 'races', the PAR_FIELDS and 'lap_profile' (keys x laps, NaN padded) as arrays.
+    """
+    races = _race_rows(histories, laps if laps is not None else pd.DataFrame(columns=LAP_COLUMNS))
+    races['condition'] = races['condition'].where(races['condition'] > OTHER, MISSING)
+    tables = [
+        _aggregate(races[races['condition'] > OTHER], ['venue', 'surface', 'distance', 'condition']),
+        _aggregate(races, ['venue', 'surface', 'distance']).assign(condition=ANY),
+        _aggregate(races, ['surface', 'distance']).assign(venue=ANY, condition=ANY),
+    ]
+    table = pd.concat([t for t in tables if not t.empty], ignore_index=True) if not races.empty else pd.DataFrame()
+    if table.empty:
+        return {'codes': np.zeros(0, dtype=np.int64), 'races': np.zeros(0, dtype=np.int32),
+                **{field: np.zeros(0, dtype=np.float32) for field in PAR_FIELDS},
+                'lap_profile': np.zeros((0, 0), dtype=np.float32),
+                'race_offsets': np.zeros(1, dtype=np.int64), 'race_dates': np.zeros(0, dtype='datetime64[D]'),
+                **{'race_' + field: np.zeros(0, dtype=np.float32) for field in ('time', 'first_3f', 'last_3f')}}
+    codes = course_code(table['venue'].to_numpy(), table['surface'].to_numpy(),
+                        table['distance'].to_numpy(), table['condition'].to_numpy())
+    order = np.argsort(codes)
+    max_laps = max((len(p) for p in table['lap_profile'] if p is not None), default=0)
+    lap_profile = np.full((len(table), max_laps), np.nan, dtype=np.float32)
+    for i, profile in enumerate(table['lap_profile']):
+        if profile is not None:
+            lap_profile[i, :len(profile)] = profile
+    index = {'codes': codes[order], 'races': table['races'].to_numpy(dtype=np.int32)[order], 'lap_profile': lap_profile[order]}
+    for field in PAR_FIELDS:
+        index[field] = table[field].to_numpy(dtype=np.float32)[order]
+
+    # The races behind every key, grouped by key in code order and sorted by date within a key
+    levels = [races[races['condition'] > OTHER], races, races]
+    race_codes = np.concatenate([_level_codes(level_races, level) for level, level_races in enumerate(levels)])
+    stacked = pd.concat(levels, ignore_index=True)
+    race_dates = stacked['date'].to_numpy().astype('datetime64[D]')
+    order = np.lexsort((race_dates, race_codes))
+    index['race_offsets'] = np.append(np.searchsorted(race_codes[order], index['codes']), len(order))
+    index['race_dates'] = race_dates[order]
+    for field in ('time', 'first_3f', 'last_3f'):
+        index['race_' + field] = stacked[field].to_numpy(dtype=np.float32)[order]
+    return index
+
+def save_index(index, path=COURSE_INDEX_FILE):
+    temp_path = path + ".tmp.npz"
+    np.savez(temp_path, **index)
+    os.replace(temp_path, path)
+
+def rebuild():
+    """Builds the index from horse_cache and course_laps.csv, makes it current and saves it."""
+    global _index
+    index = build_course_index(_load_histories(), _read_laps(COURSE_LAPS_FILE))
+    try:
+        save_index(index, COURSE_INDEX_FILE)
+    except OSError as e:
+        print(f"コース基準タイムの索引を保存できませんでした: {e}")
+    _index = _with_rows(index)
+    return _index
+
+def _with_rows(index):
+    index['rows'] = {int(code): row for row, code in enumerate(index['codes'])}
+    index['as_of'] = {} # (row, cutoff) -> (races, *PAR_FIELDS) before the cutoff
+    index['last_date'] = index['race_dates'].max() if len(index['race_dates']) else None
+    return index
+
+def get_index():
+    """The index, loaded on first use and rebuilt when missing or older than COURSE_INDEX_MAX_AGE_DAYS."""
+    global _index
+    if _index is not None:
+        return _index
+    if os.path.exists(COURSE_INDEX_FILE) and time.time() - os.path.getmtime(COURSE_INDEX_FILE) < COURSE_INDEX_MAX_AGE_DAYS * 86400:
+        with np.load(COURSE_INDEX_FILE, allow_pickle=False) as data:
+            if 'race_offsets' in data.files: # Older files lack the per-race arrays
+                _index = _with_rows({name: data[name] for name in data.files})
+                return _index
+    print("コース基準タイムの索引を作成しています...")
+    return rebuild()
+
+# --- Queries ---
+
+def _cutoff(as_of):
+    """Day before which races count, or None when every stored race does."""
+    return None if as_of is None else np.datetime64(pd.Timestamp(as_of).date(), 'D')
+
+def _median(values):
+    values = values[~np.isnan(values)]
+    return float(np.median(values)) if len(values) else np.nan
+
+def _stats_as_of(index, rows, cutoff):
+    """
+    Race counts and pars of index rows over their races before cutoff (all races when cutoff is None).
+
+    Returns:
+        tuple: (races, {field: values}) arrays aligned with rows.
+    """
+    if cutoff is None or index['last_date'] is None or cutoff > index['last_date']:
+        return index['races'][rows], {field: index[field][rows] for field in PAR_FIELDS}
+    memo = index['as_of']
+    for row in np.unique(rows):
+        if (row, cutoff) not in memo:
+            lo, hi = index['race_offsets'][row], index['race_offsets'][row + 1]
+            count = int(np.searchsorted(index['race_dates'][lo:hi], cutoff))
+            memo[row, cutoff] = (count, *(_median(index['race_' + field[4:]][lo:lo + count]) for field in PAR_FIELDS))
+    stats = np.array([memo[row, cutoff] for row in rows], dtype=float).reshape(len(rows), 1 + len(PAR_FIELDS))
+    return stats[:, 0], {field: stats[:, i + 1] for i, field in enumerate(PAR_FIELDS)}
+
+def _resolve_rows(codes_by_level, index, cutoff=None):
+    """
+    Row of each key at the finest level with at least MIN_PAR_RACES races before cutoff (-1 when
+    none has), and the pars of those rows.
+    """
+    rows = np.full(len(codes_by_level[0]), -1)
+    pars = {field: np.full(len(rows), np.nan) for field in PAR_FIELDS}
+    if len(index['codes']) == 0:
+        return rows, pars
+    for codes in codes_by_level:
+        positions = np.searchsorted(index['codes'], codes).clip(max=len(index['codes']) - 1)
+        candidates = np.flatnonzero((index['codes'][positions] == codes) & (rows < 0))
+        races, values = _stats_as_of(index, positions[candidates], cutoff)
+        found = candidates[races >= MIN_PAR_RACES]
+        rows[found] = positions[found]
+        for field in PAR_FIELDS:
+            pars[field][found] = values[field][races >= MIN_PAR_RACES]
+    return rows, pars
+
+def par_values(venues, surfaces, distances, conditions, as_of=None):
+    """
+    Vectorised par lookup for arrays of courses (e.g. every past race of a history), over the
+    races before as_of (a date; None for every stored race).
+
+    Returns:
+        dict: PAR_FIELDS -> float arrays, NaN where no key has enough races.
+    """
+    index = get_index()
+    venues, surfaces, distances, conditions = (np.asarray(a, dtype=np.int64) for a in (venues, surfaces, distances, conditions))
+    levels = [course_code(venues, surfaces, distances, np.where(conditions > OTHER, conditions, ANY)),
+              course_code(venues, surfaces, distances), course_code(ANY, surfaces, distances)]
+    return _resolve_rows(levels, index, _cutoff(as_of))[1]
+
+def history_pars(history, as_of=None):
+    """par_values for each past race of a history array, over the races before as_of."""
+    return par_values(history['venue'], history['surface'], history['distance'], history['condition'], as_of)
+
+def par(venue, surface, distance, condition=ANY, as_of=None):
+    """
+    The norms of one course in O(1) (once memoised for as_of): dict with 'races', the PAR_FIELDS
+    and 'lap_profile', or None. venue / condition may be None (unknown), which uses the coarser keys.
+    """
+    index = get_index()
+    venue = venue if venue and venue > OTHER else ANY
+    condition = condition if condition and condition > OTHER else ANY
+    for key in ((venue, condition), (venue, ANY), (ANY, ANY)):
+        row = index['rows'].get(int(course_code(key[0], surface, distance, key[1])))
+        if row is None:
+            continue
+        races, values = _stats_as_of(index, np.array([row]), _cutoff(as_of))
+        if races[0] >= MIN_PAR_RACES:
+            profile = index['lap_profile'][row]
+            return {'races': int(races[0]), **{field: float(values[field][0]) for field in PAR_FIELDS},
+                    'lap_profile': profile[~np.isnan(profile)]}
+    return None
+
+# --- Recording lap times ---
+
+def record_race_laps(race_id, race_date, venue, surface, distance, condition, lap_times):
+    """Appends the Race_LapTime of a result page to COURSE_LAPS_FILE, once per race_id."""
+    global _recorded_laps
+    if _recorded_laps is None:
+        _recorded_laps = set(_read_laps(COURSE_LAPS_FILE)['race_id'].astype(str))
+    if str(race_id) in _recorded_laps or not lap_times:
+        return
+    row = pd.DataFrame([[str(race_id), pd.Timestamp(race_date).strftime('%Y-%m-%d'), venue, surface, distance,
+                         condition, '-'.join(f"{lap:.1f}" for lap in lap_times)]], columns=LAP_COLUMNS)
+    try:
+        row.to_csv(COURSE_LAPS_FILE, mode='a', header=not os.path.exists(COURSE_LAPS_FILE), index=False)
+        _recorded_laps.add(str(race_id))
+    except OSError as e:
+        print(f"ラップタイムの書き込みに失敗しました ({COURSE_LAPS_FILE}): {e}")
+
+def venue_from_race_id(race_id):
+    """Venue code (VENUES) from digits 5-6 of a race_id, OTHER for non-JRA ids."""
+    code = int(str(race_id)[4:6]) if len(str(race_id)) >= 6 and str(race_id)[4:6].isdigit() else OTHER
+    return code if 1 <= code <= len(VENUES) else OTHER
+
+def print_index(index, top=10):
+    keys = index['codes']
+    print(f"コース数: {len(keys)} (馬場状態別・全状態・全競馬場を含む)")
+    for row in np.argsort(-index['races'])[:top]:
+        code = int(keys[row])
+        condition, distance, surface, venue = code % 10, code // 10 % 10000, code // 100000 % 10, code // 1000000
+        venue_name = VENUES[venue - 1] if venue > ANY else "全競馬場"
+        condition_name = TRACK_CONDITIONS[condition - 1] if condition > ANY else "全状態"
+        print(f"  {venue_name} {SURFACES[surface - 1]}{distance} {condition_name}: {index['races'][row]}レース, "
+              f"基準タイム {index['par_time'][row]:.1f}秒, 前半3F {index['par_first_3f'][row]:.1f}, 後半3F {index['par_last_3f'][row]:.1f}")
+
+if __name__ == '__main__':
+    index = rebuild()
+    print_index(index, int(sys.argv[1]) if len(sys.argv) > 1 else 10)
+    print(f"保存しました: {COURSE_INDEX_FILE}")
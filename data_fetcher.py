@@ -1,10 +1,19 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
 from bs4 import BeautifulSoup
 import pandas as pd
 import time
 import os
 import datetime
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
+from history import as_of, from_results_df, merge
+import horse_cache
+import pedigree
+import warehouse
 
 # Base URL for horse data
 BASE_URL = "https://db.netkeiba.com/horse/"
@@ -13,48 +22,109 @@ HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/100.0.4896.127 Safari/537.36"
 }
 
-def get_horse_data(horse_id):
+# Shared HTTP connection pool; reusing connections avoids a TLS handshake per page.
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+
+# Offline testing: with NETKEIBA_BASE_URL set (e.g. http://127.0.0.1:8766, see stub_server.py)
+# every netkeiba request made through SESSION goes to that server instead, as
+# <base>/<host><path>?<query>. URLs in the code stay the real ones.
+NETKEIBA_BASE_URL = os.environ.get("NETKEIBA_BASE_URL")
+NETKEIBA_HOSTS = ("db.netkeiba.com", "race.netkeiba.com")
+_scratch_stores = None # stub_server.use_scratch_stores state while NETKEIBA_BASE_URL is set
+_scratch_lock = threading.Lock()
+
+class BaseUrlAdapter(HTTPAdapter):
+    """Transport adapter that sends requests for a netkeiba host to base_url instead."""
+    def __init__(self, base_url):
+        super().__init__()
+        self.base_url = base_url.rstrip('/')
+
+    def send(self, request, **kwargs):
+        use_scratch_stores() # No-op unless set at import (NETKEIBA_BASE_URL), before the stores were loaded
+        parts = urlsplit(request.url)
+        request.url = f"{self.base_url}/{parts.netloc}{parts.path}" + (f"?{parts.query}" if parts.query else "")
+        return super().send(request, **kwargs)
+
+def _mount(base_url):
+    for host in NETKEIBA_HOSTS:
+        SESSION.mount(f"https://{host}/", BaseUrlAdapter(base_url) if base_url else HTTPAdapter())
+
+def use_scratch_stores():
+    """
+    Stand-in pages never reach the real stores: while a base URL is set every store path points
+    into a scratch directory (stub_server.use_scratch_stores). Done once per base URL.
+    """
+    global _scratch_stores
+    with _scratch_lock:
+        if NETKEIBA_BASE_URL and _scratch_stores is None:
+            import stub_server
+            _scratch_stores = stub_server.use_scratch_stores()
+
+def set_base_url(base_url):
+    """
+    Points SESSION at a netkeiba stand-in (base_url), with the stores in a scratch directory,
+    or back at the real site and stores with None.
+    """
+    global NETKEIBA_BASE_URL, _scratch_stores
+    NETKEIBA_BASE_URL = base_url
+    _mount(base_url)
+    if base_url:
+        use_scratch_stores()
+    elif _scratch_stores is not None:
+        import stub_server
+        stub_server.restore_stores(_scratch_stores)
+        _scratch_stores = None
+    clear_caches()
+
+if NETKEIBA_BASE_URL:
+    # The store modules may still be importing this one: their paths move on the first request
+    _mount(NETKEIBA_BASE_URL)
+
+# In-process caches. A single run benefits when the same horse or year is needed twice,
+# and a long-running process (server.py) keeps them warm across predictions.
+_horse_data_cache = {} # horse_id -> (compact history array, parent_ids), see get_horse_history
+_jockey_leading_cache = {} # year -> leading DataFrame
+
+# Jockey leading tables (get_jockey_leading_data). Past years never change once the year is over;
+# the current year's table is refetched when older than JOCKEY_LEADING_REFRESH_HOURS.
+JOCKEY_LEADING_URL_FORMAT = "https://db.netkeiba.com/jockey/jockey_leading_jra.html?year={year}&page={page}"
+JOCKEY_LEADING_CSV_FORMAT = "/Users/akahoshihiroki/Documents/pytests/keiba_yosou/jockey_leading_{year}.csv"
+JOCKEY_LEADING_REFRESH_HOURS = 24
+JOCKEY_LEADING_WORKERS = 3
+JOCKEY_LEADING_MIN_INTERVAL_SECONDS = 1.0 # between request starts, shared by the workers
+_request_slot = {'lock': threading.Lock(), 'next': 0.0}
+_jockey_leading_fetched = {} # year -> time.monotonic() of the last fetch attempt in this process
+_course_aptitude_cache = {} # (kind, id) -> DataFrame, kind in 'horse', 'jockey', 'sire', 'bms'
+
+def clear_caches():
+    """Drops all in-process caches (horse pages, jockey leading tables, course aptitude)."""
+    _horse_data_cache.clear()
+    _jockey_leading_cache.clear()
+    _jockey_leading_fetched.clear()
+    _course_aptitude_cache.clear()
+
+def get_horse_data(horse_id, since=None, timeout=None):
     """
     Fetches and parses the data for a given horse_id from netkeiba database.
 
     Args:
         horse_id (str): The ID of the horse.
+        since (datetime.date): Only parse result rows dated after this (incremental refetch).
+        timeout (float): Seconds to wait for the page (None: no limit).
 
     Returns:
         tuple: A tuple containing:
             - pd.DataFrame: Past race results of the horse. None if not found.
-            - dict: A dictionary with parent horse IDs ('sire', 'mare'). None if not found.
+            - dict: A dictionary with parent horse IDs ('sire', 'mare', 'bms') and 'grandparents'
+              ({parent_id: (sire_id, dam_id)}). None if not found.
     """
     try:
         url = f"{BASE_URL}{horse_id}"
-        response = requests.get(url, headers=HEADERS)
+        response = SESSION.get(url, timeout=timeout)
         response.raise_for_status()
         time.sleep(1)
-
-        soup = BeautifulSoup(response.content, "lxml")
-
-        # --- Get Past Race Results ---
-        race_results_df = None
-        results_table = soup.find("table", class_="db_h_race_results")
-        if results_table:
-            race_results_df = pd.read_html(StringIO(str(results_table)))[0]
-            # Rename columns for easier access
-            race_results_df.rename(columns={'上り': 'agari_3f'}, inplace=True)
-
-        # --- Get Parent IDs ---
-        parent_ids = {'sire': None, 'mare': None}
-        blood_table = soup.find("table", class_="blood_table")
-        if blood_table:
-            # Find all <a> tags that link to horse pages within the blood_table
-            horse_links = [link for link in blood_table.find_all('a') if link.get('href') and '/horse/' in link.get('href')]
-
-            # Assuming the first link is the sire and the second is the mare
-            if len(horse_links) >= 1:
-                parent_ids['sire'] = horse_links[0].get('href').split('/')[-2]
-            if len(horse_links) >= 2:
-                parent_ids['mare'] = horse_links[1].get('href').split('/')[-2]
-
-        return race_results_df, parent_ids
+        return parse_horse_page(response.content, since)
 
     except requests.exceptions.RequestException as e:
         print(f"Error fetching data for horse {horse_id}: {e}")
@@ -63,11 +133,131 @@ def get_horse_data(horse_id):
         print(f"An error occurred while processing horse {horse_id}: {e}")
         return None, None
 
+def parse_horse_page(content, since=None):
+    """
+    Parses a fetched horse page into (race results DataFrame, parent_ids), as returned by get_horse_data.
+    Depends only on its arguments, so pipeline.py can run it in worker processes.
+    """
+    soup = BeautifulSoup(content, "lxml")
+
+    # --- Get Past Race Results ---
+    race_results_df = None
+    results_table = soup.find("table", class_="db_h_race_results")
+    if results_table and since is not None:
+        # Drop the rows already stored so read_html only parses the new races
+        for row in results_table.find_all('tr'):
+            date_cell = row.find('td')
+            if date_cell is None:
+                continue # Header row
+            row_date = pd.to_datetime(date_cell.get_text(strip=True), errors='coerce')
+            if pd.notna(row_date) and row_date.date() <= since:
+                row.decompose()
+        if not results_table.find('td'):
+            results_table = None
+    if results_table:
+        race_results_df = pd.read_html(StringIO(str(results_table)))[0]
+        # Rename columns for easier access
+        race_results_df.rename(columns={'上り': 'agari_3f'}, inplace=True)
+
+    # --- Get Parent IDs ---
+    parent_ids = {'sire': None, 'mare': None, 'bms': None, 'grandparents': {}}
+    blood_table = soup.find("table", class_="blood_table")
+    if blood_table:
+        # Find all <a> tags that link to horse pages within the blood_table
+        horse_links = [link for link in blood_table.find_all('a') if link.get('href') and '/horse/' in link.get('href')]
+        link_ids = [link.get('href').split('/')[-2] for link in horse_links]
+
+        if len(link_ids) >= 6:
+            # Two-generation table in document order: 父, 父父, 父母, 母, 母父, 母母
+            parent_ids['sire'], parent_ids['mare'], parent_ids['bms'] = link_ids[0], link_ids[3], link_ids[4]
+            parent_ids['grandparents'] = {
+                link_ids[0]: (link_ids[1], link_ids[2]), # sire -> (sire, dam)
+                link_ids[3]: (link_ids[4], link_ids[5]), # mare -> (sire, dam)
+            }
+        else:
+            # Assuming the first link is the sire and the second is the mare
+            if len(link_ids) >= 1:
+                parent_ids['sire'] = link_ids[0]
+            if len(link_ids) >= 2:
+                parent_ids['mare'] = link_ids[1]
+
+    return race_results_df, parent_ids
+
+def get_horse_history(horse_id, timeout=None):
+    """
+    Same as get_horse_data, but returns the past race results as a compact history array
+    (see history.py) and keeps it in memory and on disk (horse_cache.py). The full DataFrame
+    is discarded after conversion. A stored page is refetched only when the horse has raced
+    since, and then only the new result rows are parsed.
+
+    Returns:
+        tuple: (np.ndarray with history.HISTORY_DTYPE, parent_ids dict). parent_ids is None if the fetch failed.
+    """
+    if horse_id in _horse_data_cache:
+        return _horse_data_cache[horse_id]
+
+    # Persistent cache (horse_cache.py): reuse the stored page unless the horse has raced since
+    cached = horse_cache.get(horse_id)
+    if cached is not None and not horse_cache.is_stale(horse_id):
+        _horse_data_cache[horse_id] = cached
+        return cached
+    since = horse_cache.last_race_date(horse_id) if cached is not None else None
+
+    race_results_df, parent_ids = get_horse_data(horse_id, since=since, timeout=timeout)
+    return store_horse_data(horse_id, race_results_df, parent_ids, cached)
+
+def store_horse_data(horse_id, race_results_df, parent_ids, cached=None, history=None):
+    """
+    Ingests a parsed horse page (get_horse_data's result) into the warehouse, the pedigree graph,
+    horse_cache and the in-process cache. `cached` is the stored (history, parent_ids) the page
+    was fetched incrementally against, if any; `history` is from_results_df(race_results_df) when
+    already converted.
+
+    Returns:
+        tuple: (history, parent_ids) as get_horse_history.
+    """
+    if parent_ids is None:
+        if cached is not None:
+            return cached # Fetch failed; the stale page is better than nothing
+        return from_results_df(None), None # Fetch failed; do not cache so it is retried
+    warehouse.ingest_horse_results(horse_id, race_results_df)
+    warehouse.register_pedigree(horse_id, parent_ids.get('sire'), parent_ids.get('mare'), parent_ids.get('bms'))
+    pedigree.add_from_parent_ids(horse_id, parent_ids)
+    if history is None:
+        history = from_results_df(race_results_df)
+    if cached is not None:
+        history = merge(cached[0], history)
+    horse_cache.save(horse_id, history, parent_ids)
+    _horse_data_cache[horse_id] = (history, parent_ids)
+    return _horse_data_cache[horse_id]
+
+def get_cached_horse_history(horse_id):
+    """get_horse_history without fetching: the cached (history, parent_ids), or None if it would be fetched."""
+    if horse_id in _horse_data_cache:
+        return _horse_data_cache[horse_id]
+    if horse_cache.is_stale(horse_id):
+        return None
+    cached = horse_cache.get(horse_id)
+    if cached is not None:
+        _horse_data_cache[horse_id] = cached
+    return cached
+
+def get_horse_history_as_of(horse_id, race_date):
+    """
+    get_horse_history truncated to the races run before race_date (see history.as_of).
+    The horse page is fetched once per process; every backtest race the horse appears in is
+    served from the same cached history, without results from on or after its date.
+    """
+    history, parent_ids = get_horse_history(horse_id)
+    return as_of(history, race_date), parent_ids
+
 def get_horse_course_aptitude(horse_id):
     """Fetches course aptitude data for a given horse_id."""
+    if ('horse', horse_id) in _course_aptitude_cache:
+        return _course_aptitude_cache[('horse', horse_id)]
     try:
         url = f"{BASE_URL}{horse_id}"
-        response = requests.get(url, headers=HEADERS)
+        response = SESSION.get(url)
         response.raise_for_status()
         time.sleep(1)
         soup = BeautifulSoup(response.content, "lxml")
@@ -89,184 +279,257 @@ def get_horse_course_aptitude(horse_id):
             df = pd.read_html(StringIO(str(course_aptitude_table)))[0]
             # Clean up column names if necessary (e.g., remove spaces)
             df.columns = [col.replace(' ', '') for col in df.columns]
+            _course_aptitude_cache[('horse', horse_id)] = df
             return df
     except Exception as e:
         print(f"Could not fetch horse course aptitude for {horse_id}: {e}")
     return pd.DataFrame()
 
+def parse_jockey_leading_page(content):
+    """
+    Parses one page of jockey_leading_jra.html.
+
+    Returns:
+        tuple: (DataFrame with 騎手, jockey_cd, win_rate, rentai_rate, or None if the table is missing,
+        number of pages the ranking spans as far as this page shows)
+    """
+    soup = BeautifulSoup(content, "lxml")
+
+    # Find the main table containing jockey data
+    jockey_table = soup.find("table", class_="nk_tb_common race_table_01")
+    if not jockey_table:
+        return None, 0
+
+    df = pd.read_html(StringIO(str(jockey_table)), header=0)[0] # Let pandas handle header
+
+    # Clean column names (remove spaces and other potential issues)
+    # Convert MultiIndex to single level if it exists
+    if isinstance(df.columns, pd.MultiIndex):
+        df.columns = ['_'.join(col).strip() for col in df.columns.values]
+    df.columns = [col.replace(' ', '').strip() for col in df.columns]
+
+    # Jockey codes from the name links, one per DataFrame row (the first row is the header)
+    jockey_codes = []
+    for row in jockey_table.find_all('tr')[1:]:
+        link = row.find('a', href=re.compile(r'/jockey/'))
+        code_match = re.search(r'/jockey/(?:result/recent/)?(\d{5})', link['href']) if link else None
+        jockey_codes.append(code_match.group(1) if code_match else None)
+
+    # Filter and rename relevant columns
+    df_processed = pd.DataFrame()
+    for expected_col_name in ('騎手', '1着', '2着', '3着', '着外'):
+        found_col = next((col for col in df.columns if expected_col_name in col), None) # Use 'in' for partial matching
+        if found_col is None:
+            # If a critical column is missing, print a warning and skip this page
+            print(f"Warning: Critical column '{expected_col_name}' not found in jockey table. Actual columns: {df.columns.tolist()}")
+            return pd.DataFrame(), 0
+        df_processed[expected_col_name] = df[found_col]
+    df_processed['jockey_cd'] = jockey_codes if len(jockey_codes) == len(df_processed) else None
+    df_processed = df_processed[df_processed['騎手'] != '騎手名'] # Second header row
+
+    for col in ('1着', '2着', '3着', '着外'):
+        df_processed[col] = pd.to_numeric(df_processed[col], errors='coerce').fillna(0)
+    total_races_run = df_processed['1着'] + df_processed['2着'] + df_processed['3着'] + df_processed['着外']
+    df_processed['win_rate'] = (df_processed['1着'] / total_races_run).fillna(0)
+    df_processed['rentai_rate'] = ((df_processed['1着'] + df_processed['2着']) / total_races_run).fillna(0)
+
+    # Page count: the highest page number in the pager, or the total count over the rows per page
+    page_count = 1
+    pager = soup.find("div", class_="common_pager")
+    if pager:
+        page_numbers = [int(link.get_text(strip=True)) for link in pager.find_all('a') if link.get_text(strip=True).isdigit()]
+        page_count = max(page_numbers + [1])
+        total_match = re.search(r'([\d,]+)件中', pager.get_text())
+        if total_match and len(df_processed):
+            total = int(total_match.group(1).replace(',', ''))
+            page_count = max(page_count, -(-total // len(df_processed)))
+    return df_processed[['騎手', 'jockey_cd', 'win_rate', 'rentai_rate']], page_count
+
+def wait_for_request_slot(min_interval, deadline=None):
+    """
+    Blocks until the next request may start: at most one start per min_interval across threads.
+    Returns False at once, without taking the slot, when it would start at or after deadline (time.monotonic()).
+    """
+    with _request_slot['lock']:
+        now = time.monotonic()
+        start = max(now, _request_slot['next'])
+        if deadline is not None and start >= deadline:
+            return False
+        _request_slot['next'] = start + min_interval
+    time.sleep(start - now)
+    return True
+
+def fetch_jockey_leading_page(year, page_num):
+    """Fetches and parses one page of the leading table under the shared rate limit. (None, 0) on error."""
+    wait_for_request_slot(JOCKEY_LEADING_MIN_INTERVAL_SECONDS)
+    try:
+        response = SESSION.get(JOCKEY_LEADING_URL_FORMAT.format(year=year, page=page_num))
+        response.raise_for_status()
+        return parse_jockey_leading_page(response.content)
+    except requests.exceptions.RequestException as e:
+        print(f"Could not fetch jockey leading data for {year}, page {page_num}: {e}")
+    except Exception as e:
+        print(f"An unexpected error occurred while processing jockey leading data for {year}, page {page_num}: {e}")
+    return None, 0
+
+def is_jockey_leading_cache_fresh(year, cache_file):
+    """
+    Past years are final once their table was saved after the year ended. The current year's
+    table is refetched when older than JOCKEY_LEADING_REFRESH_HOURS.
+    """
+    if not os.path.exists(cache_file):
+        return False
+    saved = datetime.datetime.fromtimestamp(os.path.getmtime(cache_file))
+    if year < datetime.date.today().year:
+        return saved.year > year
+    return datetime.datetime.now() - saved < datetime.timedelta(hours=JOCKEY_LEADING_REFRESH_HOURS)
+
 def get_jockey_leading_data(year):
-    """Fetches the jockey leading data for a specific year, handling pagination and caching."""
+    """
+    Fetches the jockey leading data for a specific year, handling pagination and caching.
+
+    The first page gives the page count; the remaining pages are fetched concurrently
+    (JOCKEY_LEADING_WORKERS threads) under one rate limit. See is_jockey_leading_cache_fresh
+    for when the saved table is reused.
+    """
     current_year = datetime.date.today().year
     if year > current_year:
         year = current_year # Use current year's data for future races
 
-    cache_file = f"/Users/akahoshihiroki/Documents/pytests/keiba_yosou/jockey_leading_{year}.csv"
+    cache_file = JOCKEY_LEADING_CSV_FORMAT.format(year=year)
+    fresh = is_jockey_leading_cache_fresh(year, cache_file)
+    recently_fetched = time.monotonic() - _jockey_leading_fetched.get(year, -float('inf')) < JOCKEY_LEADING_REFRESH_HOURS * 3600
+    if year in _jockey_leading_cache and (fresh or year < current_year or recently_fetched):
+        return _jockey_leading_cache[year]
 
     # Try to load from cache
-    if os.path.exists(cache_file):
+    if fresh:
         try:
             print(f"Loading jockey leading data from cache: {cache_file}")
-            return pd.read_csv(cache_file)
+            _jockey_leading_cache[year] = pd.read_csv(cache_file, dtype={'jockey_cd': str})
+            return _jockey_leading_cache[year]
         except Exception as e:
             print(f"Error loading jockey data from cache {cache_file}: {e}. Fetching from web.")
 
-    all_jockey_data = pd.DataFrame()
-    page_num = 1
-    while True:
-        try:
-            url = f"https://db.netkeiba.com/jockey/jockey_leading_jra.html?year={year}&page={page_num}"
-            response = requests.get(url, headers=HEADERS)
-            response.raise_for_status()
-            time.sleep(1)
-            soup = BeautifulSoup(response.content, "lxml")
-
-            # Find the main table containing jockey data
-            jockey_table = soup.find("table", class_="nk_tb_common race_table_01")
-            if not jockey_table:
-                break # No more tables, end pagination
-
-            df = pd.read_html(StringIO(str(jockey_table)), header=None)[0]
-
-            # Assuming the first row of the DataFrame is the header
-            # and the actual data starts from the second row.
-            df = pd.read_html(StringIO(str(jockey_table)), header=0)[0] # Let pandas handle header
-
-            # Clean column names (remove spaces and other potential issues)
-            # Convert MultiIndex to single level if it exists
-            if isinstance(df.columns, pd.MultiIndex):
-                df.columns = ['_'.join(col).strip() for col in df.columns.values]
-            df.columns = [col.replace(' ', '').strip() for col in df.columns]
-
-            # Filter and rename relevant columns
-            expected_cols_map = {
-                '騎手': '騎手',
-                '1着': '1着',
-                '2着': '2着',
-                '3着': '3着',
-                '着外': '着外'
-            }
-            
-            # Create a new DataFrame with only the expected columns, handling missing ones
-            df_processed = pd.DataFrame()
-            for expected_col_name, _ in expected_cols_map.items():
-                found_col = None
-                for actual_col_name in df.columns:
-                    if expected_col_name in actual_col_name: # Use 'in' for partial matching
-                        found_col = actual_col_name
-                        break
-                if found_col:
-                    df_processed[expected_col_name] = df[found_col]
-                else:
-                    # If a critical column is missing, print a warning and skip this page
-                    print(f"Warning: Critical column '{expected_col_name}' not found in jockey table for year {year}, page {page_num}. Actual columns: {df.columns.tolist()}")
-                    df_processed = pd.DataFrame() # Clear df_processed to indicate failure for this page
-                    break
-
-            if not df_processed.empty:
-                df_processed['1着'] = pd.to_numeric(df_processed['1着'], errors='coerce').fillna(0)
-                df_processed['2着'] = pd.to_numeric(df_processed['2着'], errors='coerce').fillna(0)
-                df_processed['3着'] = pd.to_numeric(df_processed['3着'], errors='coerce').fillna(0)
-                df_processed['着外'] = pd.to_numeric(df_processed['着外'], errors='coerce').fillna(0)
-
-                total_races_run = df_processed['1着'] + df_processed['2着'] + df_processed['3着'] + df_processed['着外']
-                df_processed['win_rate'] = (df_processed['1着'] / total_races_run).fillna(0)
-                df_processed['rentai_rate'] = ((df_processed['1着'] + df_processed['2着']) / total_races_run).fillna(0)
-
-                df_final = df_processed[['騎手', 'win_rate', 'rentai_rate']]
-                all_jockey_data = pd.concat([all_jockey_data, df_final], ignore_index=True)
-            else:
-                # If df_processed is empty due to missing critical columns, continue to next page
-                pass # Warning already printed inside the loop
-
-            # Check for next page
-            pager = soup.find("div", class_="common_pager")
-            # Check for a link to the next page number specifically
-            next_page_link = pager.find('a', string=str(page_num + 1)) if pager else None
-            if next_page_link:
-                page_num += 1
-            else:
-                break # No next page link
-
-        except requests.exceptions.RequestException as e:
-            print(f"Could not fetch jockey leading data for {year}, page {page_num}: {e}")
-            break
-        except Exception as e:
-            print(f"An unexpected error occurred while processing jockey leading data for {year}, page {page_num}: {e}")
-            break
-    
-    # Save to cache
-    if not all_jockey_data.empty:
+    _jockey_leading_fetched[year] = time.monotonic()
+    first_page, page_count = fetch_jockey_leading_page(year, 1)
+    pages = [first_page]
+    if first_page is not None and page_count > 1:
+        with ThreadPoolExecutor(max_workers=JOCKEY_LEADING_WORKERS) as pool:
+            pages += list(pool.map(lambda page_num: fetch_jockey_leading_page(year, page_num)[0], range(2, page_count + 1)))
+    all_jockey_data = pd.concat([page for page in pages if page is not None], ignore_index=True) \
+        if any(page is not None for page in pages) else pd.DataFrame()
+
+    # Save to cache. A partial table (a page failed) is used but not saved, so the next call retries.
+    if not all_jockey_data.empty and all(page is not None for page in pages):
         all_jockey_data.to_csv(cache_file, index=False)
-        print(f"Jockey leading data saved to cache: {cache_file}")
+        print(f"Jockey leading data saved to cache: {cache_file} ({page_count} pages)")
+    if all_jockey_data.empty and os.path.exists(cache_file):
+        print(f"騎手リーディングの更新に失敗しました。{cache_file} をそのまま使用します。")
+        all_jockey_data = pd.read_csv(cache_file, dtype={'jockey_cd': str})
+    if not all_jockey_data.empty:
+        _jockey_leading_cache[year] = all_jockey_data
 
     return all_jockey_data
 
-def get_jockey_course_aptitude(jockey_id):
-    """Fetches course aptitude data for a given jockey_id."""
-    try:
-        url = f"https://db.netkeiba.com/jockey/{jockey_id}/"
-        response = requests.get(url, headers=HEADERS)
-        response.raise_for_status()
-        time.sleep(1)
-        soup = BeautifulSoup(response.content, "lxml")
+def is_course_aptitude_cached(kind, entity_id):
+    """True when get_{kind}_course_aptitude(entity_id) would not fetch a page (memo or warehouse hit)."""
+    return (kind, entity_id) in _course_aptitude_cache or warehouse.get_course_aptitude(kind, entity_id) is not None
 
-        course_aptitude_table = None
-        # Jockey course aptitude is usually in a table after an h3 with text 'コース別成績'
-        for h3 in soup.find_all('h3'):
-            if 'コース別成績' in h3.text:
-                course_aptitude_table = h3.find_next_sibling('table')
-                break
+def store_course_aptitude(kind, entity_id, df):
+    """Keeps a course aptitude table parsed elsewhere (fetch_plan.py) as get_{kind}_course_aptitude would."""
+    _course_aptitude_cache[(kind, entity_id)] = df
 
-        if course_aptitude_table:
+def parse_course_aptitude_page(content):
+    """
+    Parses the course aptitude table of a jockey, sire or BMS page.
+    It is usually in a table after an h3 with text 'コース別成績'. None if the page has no such table.
+    """
+    soup = BeautifulSoup(content, "lxml")
+    for h3 in soup.find_all('h3'):
+        if 'コース別成績' in h3.text:
+            course_aptitude_table = h3.find_next_sibling('table')
+            if course_aptitude_table is None:
+                return None
             df = pd.read_html(StringIO(str(course_aptitude_table)))[0]
             df.columns = [col.replace(' ', '') for col in df.columns]
             return df
+    return None
+
+def get_jockey_course_aptitude(jockey_id, as_of=None):
+    """
+    Fetches course aptitude data for a given jockey_id. With as_of, only the warehouse's races
+    before that date count and no page is fetched (the page includes later results).
+    """
+    if as_of is not None:
+        local_df = warehouse.get_course_aptitude('jockey', jockey_id, as_of=as_of)
+        return local_df if local_df is not None else pd.DataFrame()
+    if ('jockey', jockey_id) in _course_aptitude_cache:
+        return _course_aptitude_cache[('jockey', jockey_id)]
+    local_df = warehouse.get_course_aptitude('jockey', jockey_id)
+    if local_df is not None:
+        return local_df # Enough local results; no page fetch needed
+    try:
+        url = f"https://db.netkeiba.com/jockey/{jockey_id}/"
+        response = SESSION.get(url)
+        response.raise_for_status()
+        time.sleep(1)
+        df = parse_course_aptitude_page(response.content)
+        if df is not None:
+            _course_aptitude_cache[('jockey', jockey_id)] = df
+            return df
     except Exception as e:
         print(f"Could not fetch jockey course aptitude for {jockey_id}: {e}")
     return pd.DataFrame()
 
-def get_sire_course_aptitude(sire_id):
-    """Fetches course aptitude data for a given sire_id."""
+def get_sire_course_aptitude(sire_id, as_of=None):
+    """
+    Fetches course aptitude data for a given sire_id. With as_of, only the warehouse's races
+    before that date count and no page is fetched (the page includes later results).
+    """
+    if as_of is not None:
+        local_df = warehouse.get_course_aptitude('sire', sire_id, as_of=as_of)
+        return local_df if local_df is not None else pd.DataFrame()
+    if ('sire', sire_id) in _course_aptitude_cache:
+        return _course_aptitude_cache[('sire', sire_id)]
+    local_df = warehouse.get_course_aptitude('sire', sire_id)
+    if local_df is not None:
+        return local_df # Enough local results; no page fetch needed
     try:
         url = f"https://db.netkeiba.com/horse/sire/{sire_id}/"
-        response = requests.get(url, headers=HEADERS)
+        response = SESSION.get(url)
         response.raise_for_status()
         time.sleep(1)
-        soup = BeautifulSoup(response.content, "lxml")
-
-        course_aptitude_table = None
-        for h3 in soup.find_all('h3'):
-            if 'コース別成績' in h3.text:
-                course_aptitude_table = h3.find_next_sibling('table')
-                break
-
-        if course_aptitude_table:
-            df = pd.read_html(StringIO(str(course_aptitude_table)))[0]
-            df.columns = [col.replace(' ', '') for col in df.columns]
+        df = parse_course_aptitude_page(response.content)
+        if df is not None:
+            _course_aptitude_cache[('sire', sire_id)] = df
             return df
     except Exception as e:
         print(f"Could not fetch sire course aptitude for {sire_id}: {e}")
     return pd.DataFrame()
 
-def get_bms_course_aptitude(bms_id):
-    """Fetches course aptitude data for a given bms_id."""
+def get_bms_course_aptitude(bms_id, as_of=None):
+    """
+    Fetches course aptitude data for a given bms_id. With as_of, only the warehouse's races
+    before that date count and no page is fetched (the page includes later results).
+    """
+    if as_of is not None:
+        local_df = warehouse.get_course_aptitude('bms', bms_id, as_of=as_of)
+        return local_df if local_df is not None else pd.DataFrame()
+    if ('bms', bms_id) in _course_aptitude_cache:
+        return _course_aptitude_cache[('bms', bms_id)]
+    local_df = warehouse.get_course_aptitude('bms', bms_id)
+    if local_df is not None:
+        return local_df # Enough local results; no page fetch needed
     try:
         url = f"https://db.netkeiba.com/horse/bms/{bms_id}/"
-        response = requests.get(url, headers=HEADERS)
+        response = SESSION.get(url)
         response.raise_for_status()
         time.sleep(1)
-        soup = BeautifulSoup(response.content, "lxml")
-
-        course_aptitude_table = None
-        for h3 in soup.find_all('h3'):
-            if 'コース別成績' in h3.text:
-                course_aptitude_table = h3.find_next_sibling('table')
-                break
-
-        if course_aptitude_table:
-            df = pd.read_html(StringIO(str(course_aptitude_table)))[0]
-            df.columns = [col.replace(' ', '') for col in df.columns]
+        df = parse_course_aptitude_page(response.content)
+        if df is not None:
+            _course_aptitude_cache[('bms', bms_id)] = df
             return df
     except Exception as e:
         print(f"Could not fetch bms course aptitude for {bms_id}: {e}")
-    return pd.DataFrame()
\ No newline at end of file
+    return pd.DataFrame()
@@ -1,21 +1,55 @@
+import os
 import sys
 import re
-import pandas as pd
-import requests
-from bs4 import BeautifulSoup
-from io import StringIO
+import json
 from main import main as run_prediction
 
 PAST_RACES_FILE = "/Users/akahoshihiroki/Documents/pytests/keiba_yosou/pastRace.txt"
+# One JSON object per evaluated race, written as each race finishes (see settle_race).
+EVALUATION_RESULTS_FILE = "/Users/akahoshihiroki/Documents/pytests/keiba_yosou/evaluation_results.jsonl"
+
+BET_TYPES = ('tansho', 'fukusho', 'wide')
+BET_TYPE_NAMES = {'tansho': '単勝', 'fukusho': '複勝', 'wide': 'ワイド'}
+STAKE_PER_TICKET = 100 # yen; payouts on netkeiba are quoted per 100 yen
+
+# Durable progress journal: one line per completed race with its prediction and settled outcome,
+# tagged with scorer.SCORER_VERSION. Races already in the journal for the current version are
+# skipped, so an interrupted run resumes where it stopped.
+EVALUATION_JOURNAL_FILE = "/Users/akahoshihiroki/Documents/pytests/keiba_yosou/evaluation_journal.jsonl"
+
+# Two-phase evaluation: provisional pass over the first races, full pass if the wide hit rate clears the threshold.
+PROVISIONAL_RACES = 80
+PASS_THRESHOLD = 0.30
+# The provisional pass may stop early at fixed looks once the confidence interval of the wide hit rate
+# lies entirely on one side of the threshold. A race's ~3 winning wide pairs are not independent
+# trials, so the interval uses the race-clustered variance of the hits / winners ratio, and
+# SEQUENTIAL_ALPHA (the chance of any wrong early decision) is split evenly over the looks
+# (Bonferroni; each look's z follows from SEQUENTIAL_ALPHA / len(SEQUENTIAL_LOOKS)).
+SEQUENTIAL_ALPHA = 0.05
+SEQUENTIAL_LOOKS = (20, 40, 60) # races settled at each look; the end of the pass decides otherwise
+REPORT_Z = 1.96 # 95% interval printed after the provisional pass
+
+def parse_payout_amounts(text):
+    """Returns the yen amounts in a payout cell's text, e.g. '1,230円 150円' -> [1230, 150]."""
+    return [int(amount.replace(',', '')) for amount in re.findall(r'([\d,]+)円', text)]
 
 def get_actual_payouts(result_url):
-    """Fetches the payout information by iterating through each row of the payout tables."""
+    """
+    Fetches the payout information by iterating through each row of the payout tables.
+
+    Returns:
+        dict: Winning numbers per bet type ('tansho', 'fukusho' lists of umaban, 'wide' list of
+        sorted pairs), and 'amounts' {bet_type: {umaban or pair: yen per 100 yen ticket}}.
+    """
+    from bs4 import BeautifulSoup
+    from data_fetcher import SESSION
+
     try:
-        response = requests.get(result_url, headers={"User-Agent": "Mozilla/5.0"})
+        response = SESSION.get(result_url)
         response.raise_for_status()
         soup = BeautifulSoup(response.content, "lxml")
         
-        payouts = {'tansho': [], 'fukusho': [], 'wide': []}
+        payouts = {'tansho': [], 'fukusho': [], 'wide': [], 'amounts': {'tansho': {}, 'fukusho': {}, 'wide': {}}}
         all_rows = soup.select('.Payout_Detail_Table tr')
 
         for row in all_rows:
@@ -32,23 +66,51 @@ def get_actual_payouts(result_url):
             except (ValueError, TypeError):
                 continue
 
+            # Yen per 100 yen ticket, one amount per winning number/combination, e.g. "160円 130円 360円"
+            payout_cell = row.find('td', class_='Payout')
+            amounts = parse_payout_amounts(payout_cell.get_text(' ')) if payout_cell else []
+
             if '単勝' in header and numbers:
                 payouts['tansho'] = numbers
+                payouts['amounts']['tansho'] = dict(zip(numbers, amounts))
             elif '複勝' in header and numbers:
                 payouts['fukusho'] = numbers
+                payouts['amounts']['fukusho'] = dict(zip(numbers, amounts))
             elif 'ワイド' in header and numbers:
                 if len(numbers) % 2 == 0:
                     payouts['wide'] = [tuple(sorted(numbers[i:i+2])) for i in range(0, len(numbers), 2)]
+                    payouts['amounts']['wide'] = dict(zip(payouts['wide'], amounts))
 
         return payouts
     except Exception as e:
         print(f"Could not fetch or parse payout results from {result_url}: {e}")
         raise
 
+def record_course_laps(result_url, soup, lap_times):
+    """Stores a result page's lap times with its course for course_index.py's lap profiles."""
+    import course_index
+    from history import MISSING, SURFACES, TRACK_CONDITIONS, encode
+
+    race_id_match = re.search(r'race_id=(\d+)', result_url)
+    race_details_element = soup.find('div', class_='RaceData01')
+    details_text = race_details_element.text if race_details_element else ''
+    distance_match = re.search(r'(芝|ダ)(\d+)m', details_text)
+    condition_match = re.search(r'馬場:(\w+)', details_text)
+    date_match = re.search(r'(\d{4})年(\d{1,2})月(\d{1,2})日', soup.get_text())
+    if not (race_id_match and distance_match and date_match):
+        return
+    course_index.record_race_laps(
+        race_id_match.group(1), '-'.join(date_match.groups()), course_index.venue_from_race_id(race_id_match.group(1)),
+        encode(distance_match.group(1), SURFACES), int(distance_match.group(2)),
+        encode(condition_match.group(1), TRACK_CONDITIONS) if condition_match else MISSING, lap_times)
+
 def get_race_lap_times(result_url):
-    """Fetches lap times from the race result page."""
+    """Fetches lap times from the race result page and records them for course_index.py."""
+    from bs4 import BeautifulSoup
+    from data_fetcher import SESSION
+
     try:
-        response = requests.get(result_url, headers={"User-Agent": "Mozilla/5.0"})
+        response = SESSION.get(result_url)
         response.raise_for_status()
         soup = BeautifulSoup(response.content, "lxml")
 
@@ -56,6 +118,7 @@ def get_race_lap_times(result_url):
         if lap_time_p:
             lap_times_str = lap_time_p.get_text(strip=True)
             lap_times = [float(lt) for lt in lap_times_str.split('-')]
+            record_course_laps(result_url, soup, lap_times)
             return lap_times
 
         return None
@@ -63,113 +126,369 @@ def get_race_lap_times(result_url):
         print(f"Could not fetch or parse lap times from {result_url}: {e}")
         return None
 
-def evaluate_races(num_races_to_evaluate=None, specific_urls=None):
-    """Runs predictions on past races and evaluates based on the new criteria."""
-    if specific_urls:
-        race_urls = specific_urls
-    else:
-        try:
-            with open(PAST_RACES_FILE, 'r') as f:
-                race_urls = [line.strip().lstrip('-').strip() for line in f if line.strip()]
-        except FileNotFoundError:
-            print(f"エラー: {PAST_RACES_FILE} が見つかりません。")
-            return 0
-        if num_races_to_evaluate:
-            race_urls = race_urls[:num_races_to_evaluate]
-
-    total_races = 0
-    total_tansho_hits = 0
-    total_fukusho_hits = 0
-    total_wide_hits = 0
-    
-    for result_url in race_urls:
-        if not result_url:
-            continue
-        
-        shutuba_url = result_url.replace('result.html', 'shutuba.html')
-        race_id_match = re.search(r'race_id=(\d+)', shutuba_url)
-        if not race_id_match:
-            print(f"URLからrace_idを抽出できませんでした: {shutuba_url}")
-            continue
-        race_id = race_id_match.group(1)
-
-        print(f"\n--- レース評価中: {race_id} ---")
-        
-        try:
-            total_races += 1
+def get_finishing_positions(result_url):
+    """
+    Fetches the finishing order from the race result page.
+
+    Returns:
+        dict: {umaban: finishing position}, 0 for runners without a numeric position
+        (中止, 除外...), or None if the page could not be read.
+    """
+    import pandas as pd
+    from io import StringIO
+    from bs4 import BeautifulSoup
+    from data_fetcher import SESSION
+    from history import parse_rank
+
+    try:
+        response = SESSION.get(result_url)
+        response.raise_for_status()
+        soup = BeautifulSoup(response.content, "lxml")
+
+        result_table = soup.find('table', id='All_Result_Table')
+        if not result_table:
+            return None
+        df = pd.read_html(StringIO(str(result_table)))[0]
+        df.columns = [str(col).replace(' ', '') for col in df.columns]
+        return {int(umaban): parse_rank(rank) for umaban, rank in zip(df['馬番'], df['着順']) if pd.notna(umaban)}
+    except Exception as e:
+        print(f"Could not fetch or parse finishing positions from {result_url}: {e}")
+        return None
+
+def settle_race(race_id, recommended_bets, actual_payouts):
+    """
+    Settles one race's recommended bets against its payouts.
+
+    Returns:
+        dict: JSON-serialisable per-race record with, for each bet type, the number of tickets,
+        hits, stake and payout in yen, and the number of winning numbers/combinations.
+    """
+    record = {'race_id': race_id, 'bets': {}, 'actual': {}}
+    for bet_type in BET_TYPES:
+        winners = actual_payouts.get(bet_type, [])
+        amounts = actual_payouts.get('amounts', {}).get(bet_type, {})
+        bets = [tuple(sorted(bet)) if bet_type == 'wide' else bet for bet in recommended_bets.get(bet_type, [])]
+        hits = [bet for bet in bets if bet in winners]
+        for bet in hits:
+            print(f"[的中] {BET_TYPE_NAMES[bet_type]}! 賭け: {bet}, 実際: {winners}, 払戻: {amounts.get(bet, 0)}円")
+        record['bets'][bet_type] = [list(map(int, bet)) if bet_type == 'wide' else int(bet) for bet in bets]
+        record['actual'][bet_type] = [
+            [*map(int, winner), amounts.get(winner, 0)] if bet_type == 'wide' else [int(winner), amounts.get(winner, 0)]
+            for winner in winners
+        ]
+        record[bet_type] = {
+            'tickets': len(bets),
+            'hits': len(hits),
+            'stake': len(bets) * STAKE_PER_TICKET,
+            'payout': sum(amounts.get(bet, 0) for bet in hits) * STAKE_PER_TICKET // 100,
+            'winners': len(winners),
+        }
+    return record
+
+def summarize_results(records):
+    """
+    Aggregates per-race records (from settle_race or load_results) by bet type.
+
+    Returns:
+        dict: {'races': n, bet_type: {'tickets', 'hits', 'stake', 'payout', 'winners',
+        'hit_rate' (hits / tickets), 'race_hit_rate' (races with a hit / races),
+        'coverage' (hits / winning combinations), 'roi' (payout / stake)}}
+    """
+    summary = {'races': len(records)}
+    for bet_type in BET_TYPES:
+        totals = {key: sum(r[bet_type][key] for r in records) for key in ('tickets', 'hits', 'stake', 'payout', 'winners')}
+        races_with_hit = sum(1 for r in records if r[bet_type]['hits'] > 0)
+        totals['hit_rate'] = totals['hits'] / totals['tickets'] if totals['tickets'] else 0
+        totals['race_hit_rate'] = races_with_hit / len(records) if records else 0
+        totals['coverage'] = totals['hits'] / totals['winners'] if totals['winners'] else 0
+        totals['roi'] = totals['payout'] / totals['stake'] if totals['stake'] else 0
+        summary[bet_type] = totals
+    return summary
+
+def load_results(results_file=EVALUATION_RESULTS_FILE):
+    """Reads the per-race records streamed by evaluate_races. Incomplete trailing lines are skipped."""
+    records = []
+    try:
+        with open(results_file, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    except FileNotFoundError:
+        print(f"エラー: {results_file} が見つかりません。")
+    return records
+
+def load_journal(scorer_version, journal_file=EVALUATION_JOURNAL_FILE):
+    """Completed races recorded for scorer_version: {race_id: journal entry}. Later lines win."""
+    completed = {}
+    if not os.path.exists(journal_file):
+        return completed
+    with open(journal_file, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue # Line cut short by a crash
+            if entry.get('scorer_version') == scorer_version:
+                completed[entry['race_id']] = entry
+    return completed
+
+def append_journal(entry, journal_file=EVALUATION_JOURNAL_FILE):
+    """Appends one completed race and forces it to disk before the next race starts."""
+    try:
+        with open(journal_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+    except OSError as e:
+        print(f"評価ジャーナルの書き込みに失敗しました: {e}")
+
+def print_summary(summary):
+    print(f"評価レース数: {summary['races']}")
+    for bet_type in BET_TYPES:
+        totals = summary[bet_type]
+        print(f"{BET_TYPE_NAMES[bet_type]}: 的中 {totals['hits']}/{totals['tickets']}点 ({totals['hit_rate']:.1%}), "
+              f"的中レース率 {totals['race_hit_rate']:.1%}, "
+              f"投資 {totals['stake']:,}円, 払戻 {totals['payout']:,}円, 回収率 {totals['roi']:.1%}")
+    # Share of the winning wide combinations that were bought (3 per race, fewer with small fields or cancelled tickets)
+    print(f"ワイド的中率: {summary['wide']['coverage']:.2%}")
 
-            lap_times = get_race_lap_times(result_url)
-            predicted_horses, recommended_bets = run_prediction(shutuba_url, lap_times)
-            if not predicted_horses or not recommended_bets:
-                print("このレースの予測に失敗しました。")
+def load_race_urls(num_races_to_evaluate=None):
+    """Reads the result URLs from PAST_RACES_FILE. Returns None if the file is missing."""
+    try:
+        with open(PAST_RACES_FILE, 'r') as f:
+            race_urls = [line.strip().lstrip('-').strip() for line in f if line.strip()]
+    except FileNotFoundError:
+        print(f"エラー: {PAST_RACES_FILE} が見つかりません。")
+        return None
+    return race_urls[:num_races_to_evaluate] if num_races_to_evaluate else race_urls
+
+def look_z(alpha=SEQUENTIAL_ALPHA, looks=SEQUENTIAL_LOOKS):
+    """Two-sided z of one look when alpha is split evenly over the looks."""
+    from statistics import NormalDist
+    return NormalDist().inv_cdf(1 - alpha / (2 * len(looks)))
+
+def clustered_rate_interval(records, z, bet_type='wide'):
+    """
+    Confidence interval of hits / winners over records with races as clusters: the ratio
+    estimator's variance sum((h_i - rate * w_i)^2) / W^2 * n / (n - 1), so a race's winning
+    combinations count together. Returns (lower, upper) as fractions, clipped to [0, 1].
+    """
+    hits = [r[bet_type]['hits'] for r in records]
+    winners = [r[bet_type]['winners'] for r in records]
+    total_winners = sum(winners)
+    if len(records) < 2 or total_winners == 0:
+        return 0.0, 1.0
+    rate = sum(hits) / total_winners
+    residuals = sum((h - rate * w) ** 2 for h, w in zip(hits, winners))
+    half_width = z * (residuals / total_winners ** 2 * len(records) / (len(records) - 1)) ** 0.5
+    return max(0.0, rate - half_width), min(1.0, rate + half_width)
+
+def sequential_decision(records, threshold=PASS_THRESHOLD, looks=SEQUENTIAL_LOOKS, alpha=SEQUENTIAL_ALPHA):
+    """
+    Decides pass/fail on the wide hit rate at the fixed looks (after looks[k] races) once the
+    race-clustered interval at the per-look level clears the threshold.
+
+    Returns:
+        str: 'pass' (lower bound >= threshold), 'fail' (upper bound < threshold) or None (undecided,
+        or not a look).
+    """
+    if len(records) not in looks:
+        return None
+    lower, upper = clustered_rate_interval(records, look_z(alpha, looks))
+    if lower >= threshold:
+        return 'pass'
+    if upper < threshold:
+        return 'fail'
+    return None
+
+def run_evaluation(race_urls, results_file=EVALUATION_RESULTS_FILE, journal_file=EVALUATION_JOURNAL_FILE,
+                   resume=True, prior_records=None, stop_rule=None, scoring='sum'):
+    """
+    Predicts and settles each race in race_urls.
+
+    Each settled race is appended to results_file as one JSON line as soon as it finishes, so a
+    long run can be summarised (python evaluate.py --summary) while it is running or afterwards.
+    Completed races are also journaled; with resume=True, races already in journal_file for the
+    current scorer version are taken from there instead of being predicted again. Races in
+    prior_records ({race_id: record}, e.g. from an earlier pass of the same process) are reused too.
+
+    Args:
+        stop_rule (callable): Called with the records so far after each race; a truthy return
+            value ends the run early.
+        scoring (str): 'sum' (get_horse_total_score) or 'model' (ranking_model.py), see main.main.
+            Model runs are journaled under the model's own version.
+
+    Returns:
+        tuple: (list of per-race records, stop_rule's last truthy value or None). records is None
+        after an unrecoverable error.
+    """
+    from scorer import SCORER_VERSION
+    scorer_version = SCORER_VERSION
+    if scoring == 'model':
+        import ranking_model
+        model = ranking_model.load_model()
+        if model is None:
+            print(f"学習済みモデルがありません: {ranking_model.MODEL_FILE} (python ranking_model.py で学習してください)")
+            return None, None
+        scorer_version = ranking_model.scoring_version(model)
+    completed = {race_id: {'record': record} for race_id, record in (prior_records or {}).items()}
+    if resume:
+        completed = {**load_journal(scorer_version, journal_file), **completed}
+
+    records = []
+    failed_races = 0
+    reused_races = 0
+    decision = None
+    results_out = open(results_file, 'w', encoding='utf-8')
+
+    try:
+        for result_url in race_urls:
+            if not result_url:
                 continue
 
-            actual_payouts = get_actual_payouts(result_url)
-            if not actual_payouts:
-                print("このレースの実際の結果を取得できませんでした。")
+            shutuba_url = result_url.replace('result.html', 'shutuba.html')
+            race_id_match = re.search(r'race_id=(\d+)', shutuba_url)
+            if not race_id_match:
+                print(f"URLからrace_idを抽出できませんでした: {shutuba_url}")
                 continue
+            race_id = race_id_match.group(1)
 
-            print(f"  - 実際の単勝: {actual_payouts.get('tansho', [])}")
-            print(f"  - 実際の複勝: {actual_payouts.get('fukusho', [])}")
-            print(f"  - 実際のワイド: {actual_payouts.get('wide', [])}")
-            print(f"  - 推奨単勝: {recommended_bets.get('tansho', [])}")
-            print(f"  - 推奨複勝: {recommended_bets.get('fukusho', [])}")
-            print(f"  - 推奨ワイド: {recommended_bets.get('wide', [])}")
-
-            tansho_hits_in_race = 0
-            for bet in recommended_bets.get('tansho', []):
-                if bet in actual_payouts.get('tansho', []):
-                    tansho_hits_in_race += 1
-                    print(f"[的中] 単勝! 賭け: {bet}, 実際: {actual_payouts['tansho']}")
-            total_tansho_hits += tansho_hits_in_race
-
-            fukusho_hits_in_race = 0
-            for bet in recommended_bets.get('fukusho', []):
-                if bet in actual_payouts.get('fukusho', []):
-                    fukusho_hits_in_race += 1
-                    print(f"[的中] 複勝! 賭け: {bet}, 実際: {actual_payouts['fukusho']}")
-            total_fukusho_hits += fukusho_hits_in_race
-
-            wide_hits_in_race = 0
-            for bet in recommended_bets.get('wide', []):
-                if tuple(sorted(bet)) in actual_payouts.get('wide', []):
-                    wide_hits_in_race += 1
-                    print(f"[的中] ワイド! 賭け: {bet}, 実際: {actual_payouts['wide']}")
-            total_wide_hits += wide_hits_in_race
-            
-            print(f"レース {race_id} 結果: 単勝的中: {tansho_hits_in_race}, 複勝的中: {fukusho_hits_in_race}, ワイド的中: {wide_hits_in_race}")
-        except Exception as e:
-            print(f"レース {race_id} の評価中に回復不能なエラーが発生しました: {e}")
-            print("評価を停止します。")
-            return 0
+            if race_id in completed:
+                record = completed[race_id]['record']
+                records.append(record)
+                results_out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                reused_races += 1
+            else:
+                print(f"\n--- レース評価中: {race_id} ---")
 
-    print("\n--- 評価完了 ---")
-    if total_races > 0:
-        wide_win_rate = (total_wide_hits / (total_races * 3)) * 100
-        
-        print(f"評価レース数: {total_races}")
-        print(f"単勝的中数: {total_tansho_hits}")
-        print(f"複勝的中数: {total_fukusho_hits}")
-        print(f"ワイド的中数: {total_wide_hits}")
-        print(f"ワイド的中率: {wide_win_rate:.2f}%")
+                try:
+                    # The race's own laps are a result: never passed to the scorer, only recorded for course_index.py
+                    predicted_horses, recommended_bets = run_prediction(shutuba_url, scoring=scoring)
+                    get_race_lap_times(result_url)
+                    if not predicted_horses or not recommended_bets:
+                        print("このレースの予測に失敗しました。")
+                        failed_races += 1
+                        continue
+
+                    actual_payouts = get_actual_payouts(result_url)
+                    if not actual_payouts:
+                        print("このレースの実際の結果を取得できませんでした。")
+                        failed_races += 1
+                        continue
+
+                    print(f"  - 実際の単勝: {actual_payouts.get('tansho', [])}")
+                    print(f"  - 実際の複勝: {actual_payouts.get('fukusho', [])}")
+                    print(f"  - 実際のワイド: {actual_payouts.get('wide', [])}")
+                    print(f"  - 推奨単勝: {recommended_bets.get('tansho', [])}")
+                    print(f"  - 推奨複勝: {recommended_bets.get('fukusho', [])}")
+                    print(f"  - 推奨ワイド: {recommended_bets.get('wide', [])}")
+
+                    record = settle_race(race_id, recommended_bets, actual_payouts)
+                    records.append(record)
+                    append_journal({
+                        'race_id': race_id,
+                        'scorer_version': scorer_version,
+                        'horses': [{'umaban': int(h['umaban']), 'score': float(h['score'])} for h in predicted_horses],
+                        'record': record,
+                    }, journal_file)
+                    results_out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    results_out.flush()
+
+                    print(f"レース {race_id} 結果: " + ", ".join(
+                        f"{BET_TYPE_NAMES[t]}的中: {record[t]['hits']} (払戻 {record[t]['payout']}円)" for t in BET_TYPES))
+                except Exception as e:
+                    print(f"レース {race_id} の評価中に回復不能なエラーが発生しました: {e}")
+                    print(f"評価を停止します。完了した{len(records)}レースはジャーナルに記録済みで、再実行するとこのレースから再開します。")
+                    return None, None
+
+            decision = stop_rule(records) if stop_rule else None
+            if decision:
+                break
+    finally:
+        results_out.close()
+
+    if reused_races:
+        print(f"\n再利用したレース数: {reused_races} (スコアラー版 {scorer_version})")
+    if failed_races:
+        print(f"予測・結果取得に失敗したレース数: {failed_races}")
+    return records, decision
+
+def evaluate_races(num_races_to_evaluate=None, specific_urls=None, results_file=EVALUATION_RESULTS_FILE,
+                   journal_file=EVALUATION_JOURNAL_FILE, resume=True, scoring='sum'):
+    """
+    Runs predictions on past races and evaluates hit rates and ROI per bet type (see run_evaluation).
 
-        return wide_win_rate
+    Returns:
+        float: Wide hit rate in percent (hits / winning wide combinations), 0 on error.
+    """
+    race_urls = specific_urls or load_race_urls(num_races_to_evaluate)
+    if race_urls is None:
+        return 0
+    records, _ = run_evaluation(race_urls, results_file, journal_file, resume, scoring=scoring)
+    if records is None:
+        return 0
+
+    print("\n--- 評価完了 ---")
+    if records:
+        summary = summarize_results(records)
+        print_summary(summary)
+        return summary['wide']['coverage'] * 100
     else:
         print("評価されたレースはありませんでした。")
         return 0
 
+def two_phase_evaluation(provisional_races=PROVISIONAL_RACES, threshold=PASS_THRESHOLD, scoring='sum'):
+    """
+    Provisional pass over the first races, then the full pass if the wide hit rate clears threshold.
+
+    The provisional pass stops at the first look (SEQUENTIAL_LOOKS) where sequential_decision is
+    clear either way; otherwise the point estimate after provisional_races decides, as before. The full pass reuses every race
+    the provisional pass settled and only predicts the remainder.
+    """
+    race_urls = load_race_urls()
+    if race_urls is None:
+        return
+    print(f"\n--- 仮検証 (最初の{provisional_races}レース) ---")
+    provisional_records, decision = run_evaluation(race_urls[:provisional_races],
+                                                   stop_rule=lambda records: sequential_decision(records, threshold),
+                                                   scoring=scoring)
+    if not provisional_records:
+        print("評価されたレースはありませんでした。")
+        return
+    summary = summarize_results(provisional_records)
+    print_summary(summary)
+    provisional_win_rate = summary['wide']['coverage'] * 100
+    lower, upper = clustered_rate_interval(provisional_records, REPORT_Z)
+    print(f"ワイド的中率の95%信頼区間 (レース単位): {lower:.1%} - {upper:.1%} ({len(provisional_records)}レース時点)")
+
+    if decision == 'fail' or (decision is None and provisional_win_rate < threshold * 100):
+        print(f"\n仮検証の的中率が {provisional_win_rate:.2f}% であり、{threshold:.0%}未満です。アルゴリズムを見直してください。\nまだ使われていないカラムを活用するか、URLを読み込む方法を検討してください。")
+        return
+    if decision == 'pass':
+        print(f"\n信頼区間の下限が{threshold:.0%}を超えたため、{len(provisional_records)}レースで合格と判定しました。")
+    print(f"\n仮検証の勝率が{threshold:.0%}以上です。全レースで本格評価を行います。")
+    records, _ = run_evaluation(race_urls, prior_records={r['race_id']: r for r in provisional_records}, scoring=scoring)
+    if records:
+        print("\n--- 評価完了 ---")
+        print_summary(summarize_results(records))
+
 if __name__ == '__main__':
-    if len(sys.argv) > 1:
+    # --model anywhere: score with the trained ranking model instead of get_horse_total_score
+    scoring = 'model' if '--model' in sys.argv[1:] else 'sum'
+    if scoring == 'model':
+        sys.argv.remove('--model')
+    if len(sys.argv) > 1 and sys.argv[1] == '--summary':
+        results_file = sys.argv[2] if len(sys.argv) > 2 else EVALUATION_RESULTS_FILE
+        print_summary(summarize_results(load_results(results_file)))
+    elif len(sys.argv) > 1:
         test_url = sys.argv[1]
         print(f"--- 単一レースチェックを実行中: {test_url} ---")
-        evaluate_races(specific_urls=[test_url])
+        evaluate_races(specific_urls=[test_url], resume=False, scoring=scoring)
     else:
         print("全レース評価の実行方法: python evaluate.py")
         print("単一レースチェックの実行方法: python evaluate.py <レース結果のURL>")
-        print("\n--- 仮検証 (最初の80レース) ---")
-        provisional_win_rate = evaluate_races(num_races_to_evaluate=80)
-        if provisional_win_rate >= 30:
-            print("\n仮検証の勝率が30%以上です。全レースで本格評価を行います。")
-            evaluate_races()
-        else:
-            print(f"\n仮検証の的中率が {provisional_win_rate:.2f}% であり、30%未満です。アルゴリズムを見直してください。\nまだ使われていないカラムを活用するか、URLを読み込む方法を検討してください。")
+        print("保存済み結果の集計: python evaluate.py --summary [結果ファイル]")
+        print("学習済みランキングモデルで評価: python evaluate.py --model [レース結果のURL]")
+        two_phase_evaluation(scoring=scoring)
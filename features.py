@@ -0,0 +1,193 @@
+import json
+import os
+import re
+import sys
+
+import numpy as np
+
+# Per-runner feature store for backtests and weight searches.
+# The score components of every runner (scorer.SCORE_COMPONENTS, computed from the shutuba
+# and the point-in-time history) are computed once and written as fixed-width NumPy arrays.
+# Workers open them with np.load(mmap_mode='r'): the pages are shared through the OS page
+# cache, so any number of worker processes use one physical copy and start without parsing.
+#
+#   feature_store/features.npy      float32 (runners, components), rows grouped by race
+#   feature_store/index.npy         INDEX_DTYPE per row: race_id, umaban, horse_id, finishing position
+#   feature_store/race_offsets.npy  int64 (races + 1): the rows of race i are offsets[i]:offsets[i + 1]
+#   feature_store/meta.json         component names and scorer version the store was built with
+#
+#   python features.py [number of races]   build from pastRace.txt
+#   python features.py --info              describe the current store
+
+FEATURE_STORE_DIR = "/Users/akahoshihiroki/Documents/pytests/keiba_yosou/feature_store"
+
+INDEX_DTYPE = np.dtype([
+    ('race_id', 'i8'),
+    ('umaban', 'i2'),
+    ('horse_id', 'U10'),
+    ('rank', 'i2'), # finishing position, 0 when not a number or unknown
+])
+FEATURE_DTYPE = np.float32
+STORE_ARRAYS = ('features', 'index', 'race_offsets')
+
+def compute_race_features(result_url):
+    """
+    Score components of every runner of a past race, with its finishing position.
+
+    Returns:
+        tuple: (index array of INDEX_DTYPE, features array (runners, components)), or None
+        if the shutuba, race details or result could not be read.
+    """
+    import pandas as pd
+    import main as predictor
+    from evaluate import get_finishing_positions
+    from scorer import SCORE_COMPONENTS
+    from scraping import fetch_and_save_shutuba_data
+
+    shutuba_url = result_url.replace('result.html', 'shutuba.html')
+    race_id_match = re.search(r'race_id=(\d+)', shutuba_url)
+    if not race_id_match:
+        print(f"URLからrace_idを抽出できませんでした: {shutuba_url}")
+        return None
+    race_id = race_id_match.group(1)
+
+    shutuba_csv_path = fetch_and_save_shutuba_data(race_id)
+    race_info = predictor.get_race_info_from_url(shutuba_url)
+    positions = get_finishing_positions(result_url)
+    if not shutuba_csv_path or not race_info or positions is None:
+        return None
+
+    df_shutuba = pd.read_csv(shutuba_csv_path)
+    index = np.zeros(len(df_shutuba), dtype=INDEX_DTYPE)
+    features = np.zeros((len(df_shutuba), len(SCORE_COMPONENTS)), dtype=FEATURE_DTYPE)
+    for i, (_, row) in enumerate(df_shutuba.iterrows()):
+        components = predictor.shutuba_row_components(row, race_info)
+        umaban = int(row['umaban']) if pd.notna(row['umaban']) else 0
+        index[i] = (int(race_id), umaban, str(row['horse_id']), positions.get(umaban, 0))
+        features[i] = [components[name] for name in SCORE_COMPONENTS]
+    return index, features
+
+def write_feature_store(race_blocks, store_dir=FEATURE_STORE_DIR):
+    """
+    Writes the store from a list of (index, features) blocks, one per race.
+    Each file is written under a temporary name and renamed, so a worker never maps a half-written file.
+    """
+    from scorer import SCORE_COMPONENTS, SCORER_VERSION
+
+    os.makedirs(store_dir, exist_ok=True)
+    sizes = [len(index) for index, _ in race_blocks]
+    arrays = {
+        'features': np.concatenate([features for _, features in race_blocks]) if race_blocks
+                    else np.zeros((0, len(SCORE_COMPONENTS)), dtype=FEATURE_DTYPE),
+        'index': np.concatenate([index for index, _ in race_blocks]) if race_blocks else np.zeros(0, dtype=INDEX_DTYPE),
+        'race_offsets': np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64),
+    }
+    for name, array in arrays.items():
+        temp_path = os.path.join(store_dir, f"{name}.tmp.npy")
+        np.save(temp_path, np.ascontiguousarray(array), allow_pickle=False)
+        os.replace(temp_path, os.path.join(store_dir, f"{name}.npy"))
+    meta = {'feature_names': list(SCORE_COMPONENTS), 'scorer_version': SCORER_VERSION,
+            'races': len(race_blocks), 'runners': int(sum(sizes))}
+    with open(os.path.join(store_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    return meta
+
+def build_feature_store(race_urls, store_dir=FEATURE_STORE_DIR):
+    """
+    Computes the features of every race in race_urls and writes the store once at the end.
+    The runners' horse pages are fetched first with pipeline.py, overlapping fetching and parsing.
+    """
+    import pandas as pd
+    from pipeline import fetch_horse_histories, print_pipeline_stats
+    from scraping import fetch_and_save_shutuba_data
+
+    horse_ids = []
+    for result_url in race_urls:
+        race_id_match = re.search(r'race_id=(\d+)', result_url)
+        csv_path = fetch_and_save_shutuba_data(race_id_match.group(1)) if race_id_match else None
+        if csv_path:
+            horse_ids.extend(pd.read_csv(csv_path)['horse_id'].astype(str))
+    print_pipeline_stats(fetch_horse_histories(horse_ids))
+
+    race_blocks = []
+    for result_url in race_urls:
+        print(f"\n--- 特徴量計算中: {result_url} ---")
+        block = compute_race_features(result_url)
+        if block is None:
+            print("このレースの特徴量を計算できませんでした。")
+            continue
+        race_blocks.append(block)
+    return write_feature_store(race_blocks, store_dir)
+
+def open_feature_store(store_dir=FEATURE_STORE_DIR):
+    """
+    Maps the store read-only. Nothing is read until a row is accessed.
+
+    Returns:
+        dict: 'features', 'index', 'race_offsets' (memory-mapped arrays) plus the meta.json fields,
+        or None if no store exists.
+    """
+    meta_path = os.path.join(store_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, encoding='utf-8') as f:
+        store = json.load(f)
+    for name in STORE_ARRAYS:
+        store[name] = np.load(os.path.join(store_dir, f"{name}.npy"), mmap_mode='r', allow_pickle=False)
+    return store
+
+def race_rows(store, race_number):
+    """(index, features) views of one race of an open store."""
+    start, end = store['race_offsets'][race_number], store['race_offsets'][race_number + 1]
+    return store['index'][start:end], store['features'][start:end]
+
+# --- Parallel access ---
+# Each worker process maps the store once in its initializer; tasks only carry race numbers.
+
+_worker_store = None
+
+def _open_worker_store(store_dir):
+    global _worker_store
+    _worker_store = open_feature_store(store_dir)
+
+def _run_race_task(task):
+    func, race_number = task
+    return func(*race_rows(_worker_store, race_number))
+
+def map_races(func, store_dir=FEATURE_STORE_DIR, processes=None):
+    """
+    Calls func(index, features) for every race of the store in a process pool and returns the results
+    in race order. func must be a module-level function so it can be sent to the workers.
+    """
+    from multiprocessing import Pool
+    store = open_feature_store(store_dir)
+    if store is None:
+        return []
+    tasks = [(func, race_number) for race_number in range(len(store['race_offsets']) - 1)]
+    with Pool(processes, initializer=_open_worker_store, initargs=(store_dir,)) as pool:
+        return pool.map(_run_race_task, tasks)
+
+def print_store_info(store):
+    from scorer import SCORER_VERSION
+    print(f"レース数: {store['races']}, 出走馬数: {store['runners']}, 特徴量: {len(store['feature_names'])} "
+          f"({store['features'].nbytes / 2**20:.1f} MiB)")
+    print(f"特徴量: {', '.join(store['feature_names'])}")
+    version_note = "" if store['scorer_version'] == SCORER_VERSION else f" (現在のスコアラーは {SCORER_VERSION}。再作成してください)"
+    print(f"スコアラーのバージョン: {store['scorer_version']}{version_note}")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--info':
+        store = open_feature_store()
+        if store is None:
+            print(f"特徴量ストアがありません: {FEATURE_STORE_DIR}")
+            sys.exit(1)
+        print_store_info(store)
+        sys.exit(0)
+
+    from evaluate import load_race_urls
+    num_races = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    race_urls = load_race_urls(num_races)
+    if race_urls is None:
+        sys.exit(1)
+    meta = build_feature_store(race_urls)
+    print(f"\n特徴量ストアを作成しました: {FEATURE_STORE_DIR} ({meta['races']}レース, {meta['runners']}頭)")
@@ -0,0 +1,159 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+import requests
+
+import data_fetcher
+import horse_cache
+from prefetch import ENTITY_KINDS, SCORER_KINDS, is_cached, race_entities
+
+# Dependency-aware fetch planner for one race.
+# Fetching entity by entity makes a race one long serial chain: a horse page, then its parents'
+# pages (known only once the horse page is read), then each jockey / sire / BMS page in turn.
+# Here the pages a race needs are laid out as a graph first:
+#
+#   ('horse', runner) -> ('parent', sire / mare)   parents not in the pedigree graph yet
+#   ('parent', id), ('jockey', id), ('sire', id), ('bms', id)   known from the shutuba / pedigree graph
+#
+# and fetched in waves: every page whose prerequisites are resolved is fetched at once by a
+# thread pool, under one rate limit shared with data_fetcher. Pages are parsed and stored on the
+# calling thread as they arrive (the stores are not thread-safe), and the result is a bundle
+# with everything the scorer reads, so scoring itself fetches nothing.
+# With a stop_event and a deadline (main.py's deadline mode) no page is fetched or stored once
+# the event is set, and no request starts after, or runs past, the deadline.
+
+FETCH_PLAN_WORKERS = 4
+FETCH_PLAN_MIN_INTERVAL_SECONDS = 1.0 # between request starts, shared by the workers
+
+PAGE_URL_FORMATS = {
+    'horse': data_fetcher.BASE_URL + "{entity_id}",
+    'parent': data_fetcher.BASE_URL + "{entity_id}",
+    'jockey': "https://db.netkeiba.com/jockey/{entity_id}/",
+    'sire': "https://db.netkeiba.com/horse/sire/{entity_id}/",
+    'bms': "https://db.netkeiba.com/horse/bms/{entity_id}/",
+}
+
+def build_fetch_graph(df_shutuba, kinds=ENTITY_KINDS):
+    """
+    The pages of one race as {(kind, id): prerequisite nodes}. Parents already in the pedigree
+    graph have no prerequisite; the parents of the other runners are added by fetch_race_pages
+    once their runner's page is read, as ('horse', runner) -> ('parent', id) edges.
+    """
+    entities = race_entities(df_shutuba)
+    graph = {}
+    for kind in kinds:
+        for entity_id in entities[kind]:
+            if kind == 'parent' and ('horse', entity_id) in graph:
+                continue # Also a runner; one fetch serves both
+            graph.setdefault((kind, entity_id), ())
+    return graph
+
+def _stopped(stop_event):
+    return stop_event is not None and stop_event.is_set()
+
+def fetch_page(kind, entity_id, min_interval=FETCH_PLAN_MIN_INTERVAL_SECONDS, stop_event=None, deadline=None):
+    """
+    Worker thread: the raw page under the shared rate limit, or None on error. None without a
+    request once stop_event is set or when no request slot is left before deadline (time.monotonic()).
+    """
+    if _stopped(stop_event) or not data_fetcher.wait_for_request_slot(min_interval, deadline) or _stopped(stop_event):
+        return None
+    try:
+        timeout = deadline - time.monotonic() if deadline is not None else None
+        response = data_fetcher.SESSION.get(PAGE_URL_FORMATS[kind].format(entity_id=entity_id), timeout=timeout)
+        response.raise_for_status()
+        return response.content
+    except requests.exceptions.RequestException as e:
+        print(f"Could not fetch {kind} page {entity_id}: {e}")
+    return None
+
+def store_page(kind, entity_id, content, bundle):
+    """Parses a fetched page (content None when the fetch failed), stores it like the data_fetcher getters and adds it to the bundle."""
+    if kind in ('horse', 'parent'):
+        cached = horse_cache.get(entity_id)
+        since = horse_cache.last_race_date(entity_id) if cached is not None else None
+        race_results_df, parent_ids = None, None
+        if content is not None:
+            try:
+                race_results_df, parent_ids = data_fetcher.parse_horse_page(content, since)
+            except Exception as e:
+                print(f"An error occurred while processing horse {entity_id}: {e}")
+        bundle['histories'][entity_id] = data_fetcher.store_horse_data(entity_id, race_results_df, parent_ids, cached)
+        return
+    df = None
+    if content is not None:
+        try:
+            df = data_fetcher.parse_course_aptitude_page(content)
+        except Exception as e:
+            print(f"Could not parse {kind} course aptitude for {entity_id}: {e}")
+    if df is not None:
+        data_fetcher.store_course_aptitude(kind, entity_id, df)
+    bundle['aptitude'][(kind, entity_id)] = df if df is not None else pd.DataFrame()
+
+def resolve_cached(kind, entity_id, bundle):
+    """Adds a page that needs no fetch to the bundle (cache hits; the getters do not fetch)."""
+    if kind in ('horse', 'parent'):
+        bundle['histories'][entity_id] = data_fetcher.get_cached_horse_history(entity_id)
+    else:
+        bundle['aptitude'][(kind, entity_id)] = getattr(data_fetcher, f"get_{kind}_course_aptitude")(entity_id)
+
+def discovered_parents(horse_id, bundle, graph):
+    """('parent', id) nodes read from a runner's page that are not in the graph yet."""
+    _, parent_ids = bundle['histories'].get(horse_id, (None, None))
+    nodes = []
+    for relation in ('sire', 'mare'):
+        parent_id = (parent_ids or {}).get(relation)
+        if parent_id and ('parent', parent_id) not in graph and ('horse', parent_id) not in graph:
+            nodes.append(('parent', parent_id))
+    return nodes
+
+def fetch_race_pages(df_shutuba, kinds=ENTITY_KINDS, workers=FETCH_PLAN_WORKERS,
+                     min_interval=FETCH_PLAN_MIN_INTERVAL_SECONDS, stop_event=None, deadline=None):
+    """
+    Resolves every page of one race in maximal-parallel waves, requesting them in shutuba row order.
+    Setting stop_event (from another thread) ends the fetch: pages not yet requested are skipped
+    and pages still arriving are dropped, so nothing is stored after it is set.
+
+    Returns:
+        dict: 'histories' {horse_id: (history, parent_ids)} for runners and parents,
+        'aptitude' {(kind, id): course aptitude DataFrame}, 'waves' (pages fetched per wave)
+        and 'seconds' (wall time).
+    """
+    start = time.monotonic()
+    graph = build_fetch_graph(df_shutuba, kinds)
+    bundle = {'histories': {}, 'aptitude': {}, 'waves': [], 'seconds': 0.0}
+    resolved = set()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while len(resolved) < len(graph) and not _stopped(stop_event):
+            wave = [node for node, prerequisites in graph.items()
+                    if node not in resolved and all(p in resolved for p in prerequisites)]
+            to_fetch = []
+            for kind, entity_id in wave:
+                if is_cached(kind, entity_id):
+                    resolve_cached(kind, entity_id, bundle)
+                else:
+                    to_fetch.append((kind, entity_id))
+            futures = {pool.submit(fetch_page, kind, entity_id, min_interval, stop_event, deadline): (kind, entity_id)
+                       for kind, entity_id in to_fetch}
+            for future in as_completed(futures):
+                kind, entity_id = futures[future]
+                if _stopped(stop_event):
+                    continue
+                store_page(kind, entity_id, future.result(), bundle)
+            if to_fetch:
+                bundle['waves'].append(len(to_fetch))
+            resolved.update(wave)
+            # Next wave: parents that only the runner pages just read could name
+            if 'parent' in kinds:
+                for kind, entity_id in wave:
+                    if kind == 'horse':
+                        for node in discovered_parents(entity_id, bundle, graph):
+                            graph[node] = (('horse', entity_id),)
+    bundle['seconds'] = time.monotonic() - start
+    return bundle
+
+def print_fetch_stats(bundle):
+    fetched = sum(bundle['waves'])
+    waves = " + ".join(str(count) for count in bundle['waves']) or "0"
+    print(f"ページ取得: {fetched}件を{len(bundle['waves'])}段階 ({waves}) で{bundle['seconds']:.1f}秒")
@@ -0,0 +1,172 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+# Compact per-horse race history.
+# get_horse_data returns the db_h_race_results table as a DataFrame with ~28 Japanese
+# object columns. The scorer only needs a handful of them, so histories are kept as a
+# NumPy structured array with one fixed-width record per past race and the categorical
+# columns (surface, track condition, weather) encoded as small integers.
+# Records are sorted oldest first (NaT last), so the history a horse had on any given
+# day is a prefix of the array: as_of() returns it as a view without copying.
+
+# Encoded categorical values: index + 1 in the tuple, OTHER for an unrecognised
+# value and MISSING when the cell was empty.
+MISSING = -1
+OTHER = 0
+SURFACES = ("芝", "ダ", "障")
+TRACK_CONDITIONS = ("良", "稍重", "重", "不良")
+WEATHERS = ("晴", "曇", "雨", "雪")
+# JRA racecourses in race_id order: the code is also digits 5-6 of a race_id. Local and overseas races are OTHER.
+VENUES = ("札幌", "函館", "福島", "新潟", "東京", "中山", "中京", "京都", "阪神", "小倉")
+
+HISTORY_DTYPE = np.dtype([
+    ('date', 'datetime64[D]'), # NaT when the date could not be parsed
+    ('rank', 'i2'),            # finishing position, 0 when not a number (中, 除, 取...)
+    ('margin', 'f4'),          # seconds behind the winner (parse_margin), NaN when empty
+    ('agari_3f', 'f4'),        # last 3 furlongs in seconds, NaN when empty
+    ('distance', 'i2'),        # metres, 0 when unknown
+    ('surface', 'i1'),
+    ('condition', 'i1'),
+    ('weather', 'i1'),
+    ('venue', 'i1'),
+    ('time', 'f4'),            # finishing time in seconds, NaN when empty
+    ('first_3f', 'f4'),        # the race's first and last 3 furlongs (ペース), NaN when empty
+    ('last_3f', 'f4'),
+])
+
+EMPTY_HISTORY = np.zeros(0, dtype=HISTORY_DTYPE)
+
+# Margin adjustment (smaller margin = higher bonus, reduced values)
+# These are now interpreted as seconds or fractions of a second behind the winner.
+# Smaller values mean closer to the winner, thus higher bonus.
+MARGIN_TO_SECONDS = {
+    "クビ": 0.05,  # Neck
+    "アタマ": 0.02, # Head
+    "ハナ": 0.01,  # Nose
+    "1/2": 0.1,   # 1/2 length
+    "3/4": 0.15,  # 3/4 length
+    "1": 0.2,     # 1 length
+    "1 1/4": 0.25,
+    "1 1/2": 0.3,
+    "1 3/4": 0.35,
+    "2": 0.4,
+    "2 1/2": 0.5,
+    "3": 0.6,
+    "3 1/2": 0.7,
+    "4": 0.8,
+    "5": 1.0,
+    # Add more as needed, larger margins will get less bonus
+}
+
+def parse_margin(margin_str):
+    """Converts margin string to a numerical value (seconds) for scoring."""
+    if pd.isna(margin_str):
+        return 999.0 # Large value for unknown margin
+
+    margin_str = str(margin_str).strip()
+
+    # Direct mapping for common small margins
+    if margin_str in MARGIN_TO_SECONDS:
+        return MARGIN_TO_SECONDS[margin_str]
+
+    # Handle numerical margins (e.g., "2 1/2", "3", "0.5")
+    try:
+        if " " in margin_str:
+            parts = margin_str.split(" ")
+            whole = float(parts[0])
+            # Safely parse fraction without eval
+            if '/' in parts[1]:
+                num, den = map(int, parts[1].split('/'))
+                fraction = num / den
+            else:
+                fraction = float(parts[1])
+            return whole + fraction
+        return float(margin_str)
+    except ValueError:
+        # If parsing fails, it's a large or unrecognised margin, assign a large value
+        return 999.0
+
+def encode(value, vocabulary):
+    """Encodes a categorical cell as MISSING, OTHER or its 1-based position in vocabulary."""
+    if pd.isna(value):
+        return MISSING
+    value = str(value).strip()
+    return vocabulary.index(value) + 1 if value in vocabulary else OTHER
+
+def parse_rank(value):
+    """Converts a finishing position cell to an int, 0 if it is not a number."""
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return 0
+
+def parse_distance(value):
+    """Returns (surface code, metres) for a 距離 cell such as '芝1600'."""
+    if pd.isna(value):
+        return MISSING, 0
+    value = str(value)
+    match = re.search(r'\d+', value)
+    return encode(value[:1], SURFACES), int(match.group()) if match else 0
+
+def parse_venue(value):
+    """Venue code of a 開催 cell such as '3京都5'."""
+    if pd.isna(value):
+        return MISSING
+    return encode(re.sub(r'\d', '', str(value)), VENUES)
+
+def parse_time(value):
+    """Seconds of a タイム cell such as '1:50.1' (or '58.9'), NaN if empty or unreadable."""
+    if pd.isna(value):
+        return np.nan
+    try:
+        parts = str(value).strip().split(':')
+        return float(parts[0]) * 60 + float(parts[1]) if len(parts) == 2 else float(parts[0])
+    except ValueError:
+        return np.nan
+
+def parse_pace(value):
+    """(first 3F, last 3F) seconds of a ペース cell such as '35.8-37.0', NaN when empty."""
+    if pd.isna(value):
+        return np.nan, np.nan
+    parts = str(value).split('-')
+    try:
+        return float(parts[0]), float(parts[1])
+    except (ValueError, IndexError):
+        return np.nan, np.nan
+
+def from_results_df(race_results_df):
+    """Converts a db_h_race_results DataFrame (as returned by get_horse_data) to a history array."""
+    if race_results_df is None or race_results_df.empty:
+        return EMPTY_HISTORY
+
+    missing_column = pd.Series(np.nan, index=race_results_df.index)
+    history = np.zeros(len(race_results_df), dtype=HISTORY_DTYPE)
+    history['date'] = pd.to_datetime(race_results_df.get('日付', missing_column), errors='coerce').values.astype('datetime64[D]')
+    history['agari_3f'] = pd.to_numeric(race_results_df.get('agari_3f', missing_column), errors='coerce')
+    for i, (_, row) in enumerate(race_results_df.iterrows()):
+        margin = row.get('着差')
+        history['rank'][i] = parse_rank(row.get('着 順'))
+        history['margin'][i] = np.nan if pd.isna(margin) else parse_margin(margin)
+        history['surface'][i], history['distance'][i] = parse_distance(row.get('距離'))
+        history['condition'][i] = encode(row.get('馬 場'), TRACK_CONDITIONS)
+        history['weather'][i] = encode(row.get('天 気'), WEATHERS)
+        history['venue'][i] = parse_venue(row.get('開催'))
+        history['time'][i] = parse_time(row.get('タイム'))
+        history['first_3f'][i], history['last_3f'][i] = parse_pace(row.get('ペース'))
+    return history[np.argsort(history['date'], kind='stable')]
+
+def merge(history, new_rows):
+    """Adds newly parsed races to a history; a new row replaces a stored row with the same date."""
+    new_dates = new_rows['date'][~np.isnat(new_rows['date'])]
+    merged = np.concatenate([history[~np.isin(history['date'], new_dates)], new_rows])
+    return merged[np.argsort(merged['date'], kind='stable')]
+
+def as_of(history, date):
+    """
+    Point-in-time view: the races run strictly before `date`, as a slice (no copy) of the history.
+    Races without a date are excluded. Scoring a past race with this view never sees its own or later results.
+    """
+    day = np.datetime64(pd.Timestamp(date).date(), 'D')
+    return history[:np.searchsorted(history['date'], day, side='left')]
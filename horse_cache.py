@@ -0,0 +1,139 @@
+import datetime
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from history import HISTORY_DTYPE
+
+# Persistent cache of horse pages (compact history + parent ids) with race-calendar invalidation.
+# A db.netkeiba.com/horse/{id} page only changes after the horse runs, so a cached page stays
+# valid until a race the horse was entered in (known from shutuba kaisai_date) has been run
+# after the page was fetched. Only then is the page fetched again, and only the new rows of
+# its results table are parsed (data_fetcher.get_horse_data(horse_id, since=...)).
+#
+#   horse_cache/{horse_id}.npy   history array (history.HISTORY_DTYPE)
+#   horse_cache_index.csv        horse_id, fetched_date, last_race_date, parent_ids (JSON); later rows win
+#   race_calendar.csv            horse_id, race_date of every shutuba entry seen; later rows win
+
+CACHE_DIR = "/Users/akahoshihiroki/Documents/pytests/keiba_yosou/horse_cache"
+INDEX_FILE = "/Users/akahoshihiroki/Documents/pytests/keiba_yosou/horse_cache_index.csv"
+CALENDAR_FILE = "/Users/akahoshihiroki/Documents/pytests/keiba_yosou/race_calendar.csv"
+
+INDEX_COLUMNS = ['horse_id', 'fetched_date', 'last_race_date', 'parent_ids']
+CALENDAR_COLUMNS = ['horse_id', 'race_date']
+
+# Safety net for races we never saw a shutuba for: pages older than this are refetched anyway.
+MAX_AGE_DAYS = 90
+
+_index = None    # horse_id -> {'fetched_date': date, 'last_race_date': date or None, 'parent_ids': dict}
+_calendar = {}   # horse_id -> latest known race date
+
+def _parse_date(value):
+    if value is None or pd.isna(value) or str(value).strip() == '':
+        return None
+    return pd.Timestamp(str(value)).date()
+
+def _parse_parent_ids(value):
+    parent_ids = json.loads(value) if value else {}
+    parent_ids['grandparents'] = {k: tuple(v) for k, v in parent_ids.get('grandparents', {}).items()}
+    return parent_ids
+
+def _append_csv(path, df):
+    try:
+        df.to_csv(path, mode='a', header=not os.path.exists(path), index=False)
+    except OSError as e:
+        print(f"馬キャッシュの書き込みに失敗しました ({path}): {e}")
+
+def load():
+    """Loads the index and the race calendar. Called lazily on first use."""
+    global _index
+    if _index is not None:
+        return
+    _index = {}
+    if os.path.exists(INDEX_FILE):
+        df = pd.read_csv(INDEX_FILE, dtype=str, keep_default_na=False)
+        for horse_id, fetched_date, last_race_date, parent_ids in df[INDEX_COLUMNS].itertuples(index=False):
+            _index[horse_id] = {
+                'fetched_date': _parse_date(fetched_date),
+                'last_race_date': _parse_date(last_race_date),
+                'parent_ids': _parse_parent_ids(parent_ids),
+            }
+    if os.path.exists(CALENDAR_FILE):
+        df = pd.read_csv(CALENDAR_FILE, dtype=str, keep_default_na=False)
+        for horse_id, race_date in df[CALENDAR_COLUMNS].itertuples(index=False):
+            race_date = _parse_date(race_date)
+            if race_date and (horse_id not in _calendar or race_date > _calendar[horse_id]):
+                _calendar[horse_id] = race_date
+
+def record_entries(df_shutuba):
+    """Adds every runner of a shutuba table to the race calendar (horse_id -> kaisai_date)."""
+    load()
+    new_rows = []
+    for horse_id, kaisai_date in zip(df_shutuba['horse_id'], df_shutuba.get('kaisai_date', pd.Series(dtype=str))):
+        horse_id, race_date = str(horse_id), _parse_date(kaisai_date)
+        if race_date and (horse_id not in _calendar or race_date > _calendar[horse_id]):
+            _calendar[horse_id] = race_date
+            new_rows.append([horse_id, race_date.isoformat()])
+    if new_rows:
+        _append_csv(CALENDAR_FILE, pd.DataFrame(new_rows, columns=CALENDAR_COLUMNS))
+
+def get(horse_id):
+    """Returns the cached (history, parent_ids) for horse_id, or None. Does not check staleness."""
+    load()
+    entry = _index.get(str(horse_id))
+    path = os.path.join(CACHE_DIR, f"{horse_id}.npy")
+    if entry is None or not os.path.exists(path):
+        return None
+    history = np.load(path, allow_pickle=False)
+    if history.dtype != HISTORY_DTYPE:
+        return None # Written by an older layout; refetch
+    return history, entry['parent_ids']
+
+def last_race_date(horse_id):
+    """Date of the newest race in the cached page, None if not cached or the horse has not run."""
+    load()
+    entry = _index.get(str(horse_id))
+    return entry['last_race_date'] if entry else None
+
+def is_stale(horse_id, today=None):
+    """
+    True when the cached page may be missing races: the horse was entered in a race run on or after
+    the day the page was fetched (and before today), or the page is older than MAX_AGE_DAYS.
+    False if not cached.
+    """
+    load()
+    entry = _index.get(str(horse_id))
+    if entry is None:
+        return False
+    today = today or datetime.date.today()
+    if (today - entry['fetched_date']).days > MAX_AGE_DAYS:
+        return True
+    known_race = _calendar.get(str(horse_id))
+    # Results are on the page from the day after the race; a page fetched on race day may predate it, hence <=
+    return known_race is not None and entry['fetched_date'] <= known_race < today
+
+def save(horse_id, history, parent_ids, today=None):
+    """Stores a horse's full history and parent ids, recording the fetch date."""
+    load()
+    horse_id = str(horse_id)
+    today = today or datetime.date.today()
+    dates = history['date'][~np.isnat(history['date'])]
+    entry = {
+        'fetched_date': today,
+        'last_race_date': pd.Timestamp(dates.max()).date() if len(dates) else None,
+        'parent_ids': parent_ids,
+    }
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        np.save(os.path.join(CACHE_DIR, f"{horse_id}.npy"), history, allow_pickle=False)
+    except OSError as e:
+        print(f"馬キャッシュの書き込みに失敗しました ({horse_id}): {e}")
+        return
+    _index[horse_id] = entry
+    _append_csv(INDEX_FILE, pd.DataFrame([[
+        horse_id, today.isoformat(),
+        entry['last_race_date'].isoformat() if entry['last_race_date'] else '',
+        json.dumps(parent_ids, ensure_ascii=False),
+    ]], columns=INDEX_COLUMNS))
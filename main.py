@@ -1,27 +1,45 @@
-import pandas as pd
 import itertools
-import sys
+import json
+import os
 import re
-import requests
-from bs4 import BeautifulSoup
-from scorer import get_horse_total_score
-from scraping import fetch_and_save_shutuba_data
+import sys
+
+# pandas, requests, bs4 and the scorer are imported inside the functions that
+# need them so that quick commands (usage, --cached, --list) start instantly.
 
 # --- Configuration ---
 # No specific configuration for number of recommendations as trifecta is removed.
+DATA_DIR = "/Users/akahoshihiroki/Documents/pytests/keiba_yosou"
+PREDICTION_CACHE_FILE_FORMAT = DATA_DIR + "/prediction_{race_id}.json"
+
+# Race details only change between race days, so a long-running process keeps them.
+_race_info_cache = {}
+
+# Deadline mode (main_with_deadline): time kept back from the budget for scoring and bets.
+DEADLINE_SCORING_RESERVE_SECONDS = 0.5
+# Component names used in each runner's 'omitted' list.
+COMPONENT_NAMES = {'history': '過去成績'}
 
-def get_race_info_from_url(race_url):
+def get_race_info_from_url(race_url, timeout=None):
     """
     Scrapes the race page to get race details.
 
     Args:
         race_url (str): The URL of the race page.
+        timeout (float): Seconds to wait for the page (None: no limit).
 
     Returns:
         dict: A dictionary containing race details, or None if an error occurred.
     """
+    if race_url in _race_info_cache:
+        return _race_info_cache[race_url]
+
+    import pandas as pd
+    from bs4 import BeautifulSoup
+    from data_fetcher import SESSION
+
     try:
-        response = requests.get(race_url, headers={"User-Agent": "Mozilla/5.0"})
+        response = SESSION.get(race_url, timeout=timeout)
         response.raise_for_status()
         soup = BeautifulSoup(response.content, "lxml")
 
@@ -38,6 +56,8 @@ def get_race_info_from_url(race_url):
             return None
         track_type = distance_match.group(1) + str(distance_match.group(2))
 
+        post_time_match = re.search(r'(\d{1,2}:\d{2})発走', details_text)
+
         weather_match = re.search(r'天候:(\w+)', details_text)
         weather = weather_match.group(1) if weather_match else "良"
 
@@ -52,17 +72,94 @@ def get_race_info_from_url(race_url):
             print(f"Could not find date in the page's text.")
             return None
 
-        return {
+        _race_info_cache[race_url] = {
             "distance": track_type,
             "track_type": weather,  # Assuming track condition is same as weather for simplicity
             "weather": weather,
-            "date": race_date
+            "date": race_date,
+            "post_time": post_time_match.group(1) if post_time_match else None
         }
+        return _race_info_cache[race_url]
     except Exception as e:
         print(f"レース情報の取得中にエラー: {e}")
         return None
 
-def main(race_url, lap_times=None):
+def shutuba_row_components(row, race_info, lap_times=None, history=None):
+    """Score components of one runner (a row of the shutuba CSV), see scorer.get_horse_score_components."""
+    import pandas as pd
+    from scorer import get_horse_score_components
+
+    horse_id = str(row['horse_id'])
+    sire_id = pd.to_numeric(row['sire_id'], errors='coerce')
+    bms_id = pd.to_numeric(row['bms_id'], errors='coerce')
+    return get_horse_score_components(
+        horse_id, race_info["distance"], race_info["track_type"],
+        race_info["weather"], row['yoso_ninki'], race_info["date"],
+        row['jockey_name'], pd.to_numeric(row['jockey_cd'], errors='coerce'),
+        sire_id if pd.notna(sire_id) else None,
+        bms_id if pd.notna(bms_id) else None,
+        row['futan'], row['weight'], row['weight_sa'], row['wakuban'],
+        row['odds'], row['corner'], row['kyaku'], row['time'], row['pace'],
+        row['harontimel3'], row['chakusa'], row['sex'], row['age'],
+        row['blinker'], row['norikawari'], row['trainer_syozoku'], row['owner_cd'], lap_times,
+        history=history
+    )
+
+def score_shutuba_row(row, race_info, lap_times=None, history=None):
+    """Scores one runner (a row of the shutuba CSV) for the race described by race_info.
+    history, when given, replaces the runner's fetched history (see get_horse_total_score)."""
+    return sum(shutuba_row_components(row, race_info, lap_times, history).values())
+
+def build_recommended_bets(sorted_horses, strategy='fixed'):
+    """
+    Builds the tansho/fukusho/wide recommendations from horses sorted by score.
+
+    strategy 'fixed' buys the top-2 / top-4 box below; 'ev' buys the highest expected-value
+    tickets within betting.DEFAULT_BUDGET, using the win odds in each entry's 'odds'.
+    """
+    if strategy == 'ev':
+        from betting import optimize_race_bets
+        recommended_bets, _ = optimize_race_bets(sorted_horses)
+        return recommended_bets
+
+    # --- Generate new recommendations based on LLM-add3.txt ---
+    # Tansho (Win): Top 2 horses
+    # Fukusho (Place): Top 2 horses
+    # Wide (Quinella Place): 6 combinations from top 4 horses
+
+    # Top 2 horses for Tansho and Fukusho
+    top_2_horses = sorted_horses[:2]
+    tansho_bets = [h['umaban'] for h in top_2_horses]
+    fukusho_bets = [h['umaban'] for h in top_2_horses]
+
+    # Top 4 horses for Wide combinations (yields C(4,2) = 6 combinations)
+    top_4_horses = sorted_horses[:4]
+    wide_combinations = list(itertools.combinations([h['umaban'] for h in top_4_horses], 2))
+    wide_bets = [tuple(sorted(combo)) for combo in wide_combinations]
+
+    return {
+        "tansho": tansho_bets,
+        "fukusho": fukusho_bets,
+        "wide": wide_bets
+    }
+
+def main(race_url, lap_times=None, bet_strategy='fixed', refresh_shutuba=False, scoring='sum'):
+    """
+    Scores every runner of the race and builds the recommended bets.
+
+    scoring 'sum' uses get_horse_total_score; 'model' scores the same components with the trained
+    ranking model (ranking_model.py), whose win probabilities are also used by the 'ev' strategy.
+
+    Returns:
+        tuple: (horses sorted by score, recommended bets), or (None, None) on error.
+    """
+    import pandas as pd
+    import horse_cache
+    import warehouse
+    from betting import race_odds
+    from fetch_plan import SCORER_KINDS, fetch_race_pages, print_fetch_stats
+    from scraping import fetch_and_save_shutuba_data
+
     print(f"--- Analyzing race: {race_url} ---")
 
     race_id_match = re.search(r'race_id=(\d+)', race_url)
@@ -71,7 +168,7 @@ def main(race_url, lap_times=None):
         return None, None
 
     race_id = race_id_match.group(1)
-    shutuba_csv_path = fetch_and_save_shutuba_data(race_id)
+    shutuba_csv_path = fetch_and_save_shutuba_data(race_id, refresh=refresh_shutuba)
     if not shutuba_csv_path:
         return None, None
 
@@ -81,79 +178,226 @@ def main(race_url, lap_times=None):
 
     try:
         df_shutuba = pd.read_csv(shutuba_csv_path)
+        warehouse.ingest_shutuba(df_shutuba)
+        horse_cache.record_entries(df_shutuba)
+        # Every page the scorer reads is fetched up front in parallel waves; scoring fetches nothing
+        bundle = fetch_race_pages(df_shutuba, SCORER_KINDS)
+        print_fetch_stats(bundle)
+        histories = [bundle['histories'].get(str(horse_id).strip(), (None, None))[0] for horse_id in df_shutuba['horse_id']]
+        horse_scores = []
+        if scoring == 'model':
+            import ranking_model
+            model = ranking_model.load_model()
+            if model is None:
+                print(f"学習済みモデルがありません: {ranking_model.MODEL_FILE} (python ranking_model.py で学習してください)")
+                return None, None
+            components = [shutuba_row_components(row, race_info, lap_times, history)
+                          for (_, row), history in zip(df_shutuba.iterrows(), histories)]
+            scores, win_probabilities = ranking_model.score_field(components, model)
+            for (index, row), score, win_probability in zip(df_shutuba.iterrows(), scores, win_probabilities):
+                horse_scores.append({
+                    'umaban': row['umaban'],
+                    'horse_name': row['horse_name'],
+                    'score': float(score),
+                    'win_probability': float(win_probability),
+                    'odds': race_odds(row)
+                })
+        else:
+            for (index, row), history in zip(df_shutuba.iterrows(), histories):
+                horse_scores.append({
+                    'umaban': row['umaban'],
+                    'horse_name': row['horse_name'],
+                    'score': score_shutuba_row(row, race_info, lap_times, history),
+                    'odds': race_odds(row)
+                })
+
+        sorted_horses = sorted(horse_scores, key=lambda x: x['score'], reverse=True)
+        return sorted_horses, build_recommended_bets(sorted_horses, bet_strategy)
+
+    except Exception as e:
+        print(f"Prediction error: {e}")
+        return None, None
+
+def main_with_deadline(race_url, time_budget, lap_times=None, bet_strategy='fixed'):
+    """
+    Same as main(), but returns within about time_budget seconds.
+
+    Runner horse pages are fetched in parallel waves (fetch_plan) on a worker thread, most popular
+    (yoso_ninki) first. At the deadline the worker is stopped and joined before scoring, so no
+    store write overlaps scoring or outlives the call. Runners whose page has not arrived are
+    scored without their history and carry 'omitted': ['history']; fully scored runners have an empty list.
+    The shutuba (from its CSV when one exists) and race page are always required; their fetches
+    count against the budget, each with a single attempt limited to the time left.
+    """
+    import threading
+    import time
+    import pandas as pd
+    import horse_cache
+    import warehouse
+    from betting import race_odds
+    from data_fetcher import get_cached_horse_history
+    from fetch_plan import SCORER_KINDS, fetch_race_pages
+    from history import EMPTY_HISTORY
+    from scraping import fetch_and_save_shutuba_data
+
+    deadline = time.monotonic() + time_budget
+    print(f"--- Analyzing race: {race_url} (制限時間 {time_budget:.0f}秒) ---")
+
+    race_id_match = re.search(r'race_id=(\d+)', race_url)
+    if not race_id_match:
+        print("URLからrace_idが見つかりません。")
+        return None, None
+
+    fetch_deadline = deadline - DEADLINE_SCORING_RESERVE_SECONDS
+    shutuba_csv_path = fetch_and_save_shutuba_data(race_id_match.group(1), retries=1,
+                                                   timeout=max(fetch_deadline - time.monotonic(), 0.1))
+    if not shutuba_csv_path:
+        return None, None
+    race_info = get_race_info_from_url(race_url, timeout=max(fetch_deadline - time.monotonic(), 0.1))
+    if not race_info:
+        return None, None
+
+    try:
+        df_shutuba = pd.read_csv(shutuba_csv_path)
+        warehouse.ingest_shutuba(df_shutuba)
+        horse_cache.record_entries(df_shutuba)
+
+        by_popularity = df_shutuba.sort_values('yoso_ninki', na_position='last')
+        stop_fetching = threading.Event()
+        fetcher = threading.Thread(target=fetch_race_pages, args=(by_popularity, SCORER_KINDS),
+                                   kwargs={'stop_event': stop_fetching, 'deadline': fetch_deadline}, daemon=True)
+        fetcher.start()
+        fetcher.join(max(0, fetch_deadline - time.monotonic()))
+        stop_fetching.set()
+        fetcher.join() # Requests are limited to the deadline, so this only waits for the one in flight
+
         horse_scores = []
         for index, row in df_shutuba.iterrows():
-            horse_id = str(row['horse_id'])
-            sire_id = pd.to_numeric(row['sire_id'], errors='coerce')
-            bms_id = pd.to_numeric(row['bms_id'], errors='coerce')
-            score = get_horse_total_score(
-                horse_id, race_info["distance"], race_info["track_type"],
-                race_info["weather"], row['yoso_ninki'], race_info["date"],
-                row['jockey_name'], pd.to_numeric(row['jockey_cd'], errors='coerce'),
-                sire_id if pd.notna(sire_id) else None,
-                bms_id if pd.notna(bms_id) else None,
-                row['futan'], row['weight'], row['weight_sa'], row['wakuban'],
-                row['odds'], row['corner'], row['kyaku'], row['time'], row['pace'],
-                row['harontimel3'], row['chakusa'], row['sex'], row['age'],
-                row['blinker'], row['norikawari'], row['trainer_syozoku'], row['owner_cd'], lap_times
-            )
+            cached = get_cached_horse_history(str(row['horse_id']))
             horse_scores.append({
                 'umaban': row['umaban'],
                 'horse_name': row['horse_name'],
-                'score': score
+                'score': score_shutuba_row(row, race_info, lap_times, cached[0] if cached else EMPTY_HISTORY),
+                'odds': race_odds(row),
+                'omitted': [] if cached else ['history'],
             })
 
+        omitted_count = sum(1 for h in horse_scores if h['omitted'])
+        if omitted_count:
+            print(f"制限時間内に過去成績を取得できなかった馬: {omitted_count}頭")
         sorted_horses = sorted(horse_scores, key=lambda x: x['score'], reverse=True)
-
-        # --- Generate new recommendations based on LLM-add3.txt ---
-        # Tansho (Win): Top 2 horses
-        # Fukusho (Place): Top 2 horses
-        # Wide (Quinella Place): 6 combinations from top 4 horses
-
-        # Top 2 horses for Tansho and Fukusho
-        top_2_horses = sorted_horses[:2]
-        tansho_bets = [h['umaban'] for h in top_2_horses]
-        fukusho_bets = [h['umaban'] for h in top_2_horses]
-
-        # Top 4 horses for Wide combinations (yields C(4,2) = 6 combinations)
-        top_4_horses = sorted_horses[:4]
-        wide_combinations = list(itertools.combinations([h['umaban'] for h in top_4_horses], 2))
-        wide_bets = [tuple(sorted(combo)) for combo in wide_combinations]
-
-        recommended_bets = {
-            "tansho": tansho_bets,
-            "fukusho": fukusho_bets,
-            "wide": wide_bets
-        }
-
-        return sorted_horses, recommended_bets
+        return sorted_horses, build_recommended_bets(sorted_horses, bet_strategy)
 
     except Exception as e:
         print(f"Prediction error: {e}")
         return None, None
 
+def prediction_to_dict(race_id, sorted_horses, recommended_bets):
+    """Converts main()'s output into plain JSON-serialisable types."""
+    return {
+        'race_id': race_id,
+        'horses': [
+            {'umaban': int(h['umaban']), 'horse_name': str(h['horse_name']), 'score': float(h['score'])}
+            for h in sorted_horses
+        ],
+        'bets': {
+            'tansho': [int(u) for u in recommended_bets.get('tansho', [])],
+            'fukusho': [int(u) for u in recommended_bets.get('fukusho', [])],
+            'wide': [[int(u) for u in combo] for combo in recommended_bets.get('wide', [])],
+        },
+    }
+
+def save_prediction(race_id, sorted_horses, recommended_bets):
+    """Writes a prediction to prediction_{race_id}.json so it can be shown again without rescoring."""
+    prediction = prediction_to_dict(race_id, sorted_horses, recommended_bets)
+    path = PREDICTION_CACHE_FILE_FORMAT.format(race_id=race_id)
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(prediction, f, ensure_ascii=False)
+    except OSError as e:
+        print(f"予測結果の保存に失敗しました: {e}")
+        return None
+    return path
+
+def load_prediction(race_id):
+    """Loads a cached prediction. Returns (sorted_horses, recommended_bets) or (None, None)."""
+    path = PREDICTION_CACHE_FILE_FORMAT.format(race_id=race_id)
+    if not os.path.exists(path):
+        return None, None
+    with open(path, encoding='utf-8') as f:
+        prediction = json.load(f)
+    bets = prediction['bets']
+    bets['wide'] = [tuple(combo) for combo in bets.get('wide', [])]
+    return prediction['horses'], bets
+
+def list_races():
+    """Lists race_ids with a local shutuba CSV, and whether a cached prediction exists."""
+    races = []
+    if not os.path.isdir(DATA_DIR):
+        return races
+    for name in sorted(os.listdir(DATA_DIR)):
+        match = re.fullmatch(r'shutuba_(\d+)\.csv', name)
+        if match:
+            race_id = match.group(1)
+            races.append((race_id, os.path.exists(PREDICTION_CACHE_FILE_FORMAT.format(race_id=race_id))))
+    return races
+
+def print_prediction(predicted_horses, recommended_bets):
+    print("\n--- スコア上位馬 ---")
+    for i, horse in enumerate(predicted_horses):
+        omitted = horse.get('omitted')
+        omitted_note = f" (未取得: {', '.join(COMPONENT_NAMES[c] for c in omitted)})" if omitted else ""
+        print(f"{i+1}. 馬番: {horse['umaban']}, 馬名: {horse['horse_name']}, スコア: {horse['score']:.2f}{omitted_note}")
+
+    print(f"\n--- おすすめ単勝馬券 ({len(recommended_bets.get('tansho', []))}点) ---")
+    if recommended_bets.get('tansho'):
+        for umaban in recommended_bets['tansho']:
+            print(f"- {umaban}")
+
+    print(f"\n--- おすすめ複勝馬券 ({len(recommended_bets.get('fukusho', []))}点) ---")
+    if recommended_bets.get('fukusho'):
+        for umaban in recommended_bets['fukusho']:
+            print(f"- {umaban}")
+
+    print(f"\n--- おすすめワイド馬券 ({len(recommended_bets.get('wide', []))}点) ---")
+    if recommended_bets.get('wide'):
+        for i, combo in enumerate(recommended_bets['wide']):
+            print(f"{i+1}. {combo}")
+
+def print_usage():
+    print("使用法: python main.py <レースページのURL>")
+    print("        python main.py --cached <race_id>   (保存済みの予測を表示)")
+    print("        python main.py <レースページのURL> --ev   (期待値ベースの買い目)")
+    print("        python main.py <レースページのURL> --deadline <秒>   (制限時間内に取得できた分で予測)")
+    print("        python main.py <レースページのURL> --refresh   (保存済みの出馬表を更新してから予測)")
+    print("        python main.py <レースページのURL> --model   (学習済みランキングモデルでスコア計算)")
+    print("        python main.py --list               (ローカルの出馬表と予測の一覧)")
+
 if __name__ == '__main__':
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 2 and sys.argv[1] == '--cached':
+        race_id_match = re.search(r'(\d{12})', sys.argv[2])
+        race_id = race_id_match.group(1) if race_id_match else sys.argv[2]
+        predicted_horses, recommended_bets = load_prediction(race_id)
+        if predicted_horses and recommended_bets:
+            print_prediction(predicted_horses, recommended_bets)
+        else:
+            print(f"race_id {race_id} の保存済み予測がありません。")
+    elif len(sys.argv) > 1 and sys.argv[1] == '--list':
+        for race_id, has_prediction in list_races():
+            print(f"{race_id}{' (予測済み)' if has_prediction else ''}")
+    elif len(sys.argv) > 1 and not sys.argv[1].startswith('-'):
         race_url = sys.argv[1]
-        predicted_horses, recommended_bets = main(race_url)
+        bet_strategy = 'ev' if '--ev' in sys.argv[2:] else 'fixed'
+        if '--deadline' in sys.argv[2:-1]:
+            time_budget = float(sys.argv[sys.argv.index('--deadline') + 1])
+            predicted_horses, recommended_bets = main_with_deadline(race_url, time_budget, bet_strategy=bet_strategy)
+        else:
+            predicted_horses, recommended_bets = main(race_url, bet_strategy=bet_strategy,
+                                                      refresh_shutuba='--refresh' in sys.argv[2:],
+                                                      scoring='model' if '--model' in sys.argv[2:] else 'sum')
         if predicted_horses and recommended_bets:
-            print("\n--- スコア上位馬 ---")
-            for i, horse in enumerate(predicted_horses):
-                print(f"{i+1}. 馬番: {horse['umaban']}, 馬名: {horse['horse_name']}, スコア: {horse['score']:.2f}")
-            
-            print("\n--- おすすめ単勝馬券 (2点) ---")
-            if recommended_bets.get('tansho'):
-                for umaban in recommended_bets['tansho']:
-                    print(f"- {umaban}")
-
-            print("\n--- おすすめ複勝馬券 (2点) ---")
-            if recommended_bets.get('fukusho'):
-                for umaban in recommended_bets['fukusho']:
-                    print(f"- {umaban}")
-
-            print("\n--- おすすめワイド馬券 (6点) ---")
-            if recommended_bets.get('wide'):
-                for i, combo in enumerate(recommended_bets['wide']):
-                    print(f"{i+1}. {combo}")
+            race_id_match = re.search(r'race_id=(\d+)', race_url)
+            save_prediction(race_id_match.group(1), predicted_horses, recommended_bets)
+            print_prediction(predicted_horses, recommended_bets)
     else:
-        print("使用法: python main.py <レースページのURL>")
+        print_usage()
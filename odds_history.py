@@ -0,0 +1,168 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Odds time series per race.
+# The shutuba CSV keeps one odds / yoso_odds / yoso_ninki value per runner and a refetch overwrites it.
+# Every HorseData fetch (scraping.fetch_shutuba_horse_data, so main.py --refresh, watch.py, card.py,
+# prefetch.py and server.py) appends a snapshot here, so how a race's odds moved can be read back
+# for scoring and backtests without scraping again.
+#
+#   odds_history/{race_id}.bin   SNAPSHOT_DTYPE records, appended in time order
+#
+# The records are fixed-width, so a file is read in one call as a NumPy structured array
+# whose fields are column views, and a time range is found with searchsorted. A runner whose values
+# are the same as in its previous snapshot is not written again; the latest record at or before a
+# time is its value then.
+#
+#   python odds_history.py <race_id>   print each runner's odds over time
+
+ODDS_HISTORY_DIR = "/Users/akahoshihiroki/Documents/pytests/keiba_yosou/odds_history"
+
+SNAPSHOT_DTYPE = np.dtype([
+    ('time', 'datetime64[s]'), # when the shutuba was polled (local time)
+    ('umaban', 'i2'),
+    ('odds', 'f4'),            # win odds, NaN before the market opens
+    ('yoso_odds', 'f4'),       # forecast odds, NaN when not published
+    ('yoso_ninki', 'i2'),      # forecast popularity, 0 when not published
+])
+EMPTY_SNAPSHOTS = np.zeros(0, dtype=SNAPSHOT_DTYPE)
+
+_last_values = {} # race_id -> {umaban: (odds, yoso_odds, yoso_ninki)} of the latest record
+
+def snapshot_path(race_id):
+    return os.path.join(ODDS_HISTORY_DIR, f"{race_id}.bin")
+
+def load(race_id):
+    """Every snapshot record of a race, oldest first. A record cut short by an interrupted write is dropped."""
+    path = snapshot_path(race_id)
+    if not os.path.exists(path):
+        return EMPTY_SNAPSHOTS
+    with open(path, 'rb') as f:
+        data = f.read()
+    return np.frombuffer(data[:len(data) - len(data) % SNAPSHOT_DTYPE.itemsize], dtype=SNAPSHOT_DTYPE)
+
+def _number(value):
+    number = pd.to_numeric(value, errors='coerce') # '---.-' and '' before the market opens
+    return np.nan if pd.isna(number) else float(number)
+
+def _values_key(record):
+    """Comparable (odds, yoso_odds, yoso_ninki), with NaN as None so unchanged rows compare equal."""
+    return tuple(None if isinstance(v, float) and np.isnan(v) else v
+                 for v in (float(record['odds']), float(record['yoso_odds']), int(record['yoso_ninki'])))
+
+def _latest_values(race_id):
+    if race_id not in _last_values:
+        _last_values[race_id] = {int(record['umaban']): _values_key(record) for record in load(race_id)}
+    return _last_values[race_id]
+
+def record_snapshot(race_id, horse_list, when=None):
+    """
+    Appends the odds of a HorseData list (scraping.fetch_shutuba_horse_data) polled at `when`
+    (default now). Runners without an umaban (before the draw) or whose values did not change are skipped.
+
+    Returns:
+        int: Number of records written.
+    """
+    race_id = str(race_id)
+    when = np.datetime64(pd.Timestamp(when) if when is not None else pd.Timestamp.now(), 's')
+    latest = _latest_values(race_id)
+    records = []
+    for horse in horse_list:
+        umaban = pd.to_numeric(horse.get('umaban'), errors='coerce')
+        if pd.isna(umaban):
+            continue
+        record = np.zeros((), dtype=SNAPSHOT_DTYPE)
+        yoso_ninki = _number(horse.get('yoso_ninki'))
+        record['time'], record['umaban'] = when, int(umaban)
+        record['odds'], record['yoso_odds'] = _number(horse.get('odds')), _number(horse.get('yoso_odds'))
+        record['yoso_ninki'] = 0 if np.isnan(yoso_ninki) else int(yoso_ninki)
+        if latest.get(int(umaban)) != _values_key(record):
+            records.append(record)
+    if not records:
+        return 0
+    new_records = np.array(records, dtype=SNAPSHOT_DTYPE)
+    try:
+        os.makedirs(ODDS_HISTORY_DIR, exist_ok=True)
+        with open(snapshot_path(race_id), 'ab') as f:
+            f.write(new_records.tobytes())
+    except OSError as e:
+        print(f"オッズ履歴の書き込みに失敗しました ({race_id}): {e}")
+        return 0
+    for record in new_records:
+        latest[int(record['umaban'])] = _values_key(record)
+    return len(new_records)
+
+def snapshots(race_id, start=None, end=None, umaban=None):
+    """Records of a race with start <= time <= end (either may be None), optionally of one runner."""
+    records = load(race_id)
+    times = records['time']
+    lo = np.searchsorted(times, np.datetime64(pd.Timestamp(start), 's'), side='left') if start is not None else 0
+    hi = np.searchsorted(times, np.datetime64(pd.Timestamp(end), 's'), side='right') if end is not None else len(records)
+    records = records[lo:hi]
+    if umaban is not None:
+        records = records[records['umaban'] == int(umaban)]
+    return records
+
+def win_odds(records):
+    """Win odds of each record, falling back to the forecast odds before the market opens (as betting.race_odds)."""
+    return np.where(np.isnan(records['odds']), records['yoso_odds'], records['odds'])
+
+def odds_as_of(race_id, when):
+    """{umaban: win odds} as they stood at `when`: each runner's latest record at or before it."""
+    records = snapshots(race_id, end=when)
+    # Last occurrence of each umaban: first occurrence in the reversed array
+    umaban, first_in_reversed = np.unique(records['umaban'][::-1], return_index=True)
+    odds = win_odds(records)[::-1][first_in_reversed]
+    return {int(u): round(float(o), 1) for u, o in zip(umaban, odds)} # float32 -> the 0.1 steps odds come in
+
+def odds_movement(race_id, start=None, end=None):
+    """
+    Odds movement features per runner between start and end (e.g. up to a backtest's cut-off time).
+    Unchanged values are not re-recorded, so each runner's window starts from its latest record at
+    or before start (its odds then, as odds_as_of).
+
+    Returns:
+        dict: {umaban: {'first': odds, 'last': odds, 'log_ratio': log(last / first) (negative when
+        the horse was backed), 'snapshots': number of records, the seed included}}
+    """
+    records = snapshots(race_id, end=end)
+    if start is not None:
+        in_window = records['time'] > np.datetime64(pd.Timestamp(start), 's')
+        # Latest record of each runner at or before start: first occurrence in the reversed array
+        _, last_before = np.unique(records['umaban'][~in_window][::-1], return_index=True)
+        seeds = np.flatnonzero(~in_window)[::-1][last_before]
+        records = records[np.sort(np.concatenate([seeds, np.flatnonzero(in_window)]))]
+    odds = win_odds(records)
+    movement = {}
+    for umaban in np.unique(records['umaban']):
+        runner_odds = odds[(records['umaban'] == umaban) & ~np.isnan(odds)]
+        if len(runner_odds) == 0:
+            continue
+        first, last = round(float(runner_odds[0]), 1), round(float(runner_odds[-1]), 1)
+        movement[int(umaban)] = {
+            'first': first, 'last': last,
+            'log_ratio': float(np.log(last / first)) if first > 0 and last > 0 else 0.0,
+            'snapshots': len(runner_odds),
+        }
+    return movement
+
+def print_history(race_id):
+    records = load(race_id)
+    if len(records) == 0:
+        print(f"オッズ履歴がありません: {race_id}")
+        return
+    print(f"{race_id}: {len(records)}件 ({records['time'][0]} 〜 {records['time'][-1]})")
+    odds = win_odds(records)
+    for umaban in np.unique(records['umaban']):
+        mask = records['umaban'] == umaban
+        path = " → ".join(f"{str(t)[11:16]} {o:.1f}" for t, o in zip(records['time'][mask], odds[mask]) if not np.isnan(o))
+        print(f"  {umaban:>2}番: {path}")
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("使用法: python odds_history.py <race_id>")
+        sys.exit(1)
+    print_history(sys.argv[1])
@@ -0,0 +1,114 @@
+import os
+import sys
+
+import pandas as pd
+
+import warehouse
+
+# Persistent pedigree graph: horse_id -> (sire_id, mare_id, bms_id).
+# Edges come from shutuba tables (sire_id / mare_id / bms_id columns) and from the
+# blood_table on horse pages, which also gives the parents of the sire and the mare.
+# Lookups for a whole field, or several generations up over those grandparent edges, are
+# dictionary walks instead of a horse page fetch per ancestor.
+#
+# Stored as an append-only CSV; when a horse appears more than once the non-empty
+# fields of later rows win.
+#
+#   python pedigree.py <horse_id> [generations]   print the stored ancestors of a horse
+
+GRAPH_FILE = "/Users/akahoshihiroki/Documents/pytests/keiba_yosou/pedigree_graph.csv"
+GRAPH_COLUMNS = ['horse_id', 'sire_id', 'mare_id', 'bms_id']
+NO_PARENTS = (None, None, None)
+
+_graph = None # horse_id -> (sire_id, mare_id, bms_id)
+
+def _normalize(value):
+    return warehouse.normalize_id(value) # Float ids from pandas ('2019104968.0') match their strings
+
+def load():
+    """Loads the graph from GRAPH_FILE. Called lazily on first use."""
+    global _graph
+    if _graph is not None:
+        return
+    _graph = {}
+    if os.path.exists(GRAPH_FILE):
+        df = pd.read_csv(GRAPH_FILE, dtype=str, keep_default_na=False)
+        for horse_id, sire_id, mare_id, bms_id in df[GRAPH_COLUMNS].itertuples(index=False):
+            _merge(horse_id, (_normalize(sire_id), _normalize(mare_id), _normalize(bms_id)))
+
+def _merge(horse_id, parents):
+    old = _graph.get(horse_id, NO_PARENTS)
+    new = tuple(n if n is not None else o for o, n in zip(old, parents))
+    _graph[horse_id] = new
+    return old, new
+
+def add_parents(horse_id, sire_id=None, mare_id=None, bms_id=None):
+    """
+    Records parents for horse_id. Unknown (None) fields keep their stored value.
+
+    Returns:
+        tuple: (old parents, new parents) as (sire_id, mare_id, bms_id).
+    """
+    load()
+    horse_id = _normalize(horse_id)
+    old, new = _merge(horse_id, (_normalize(sire_id), _normalize(mare_id), _normalize(bms_id)))
+    if new != old:
+        try:
+            pd.DataFrame([[horse_id, *new]], columns=GRAPH_COLUMNS).to_csv(
+                GRAPH_FILE, mode='a', header=not os.path.exists(GRAPH_FILE), index=False)
+        except OSError as e:
+            print(f"血統グラフの保存に失敗しました: {e}")
+    return old, new
+
+def add_from_parent_ids(horse_id, parent_ids):
+    """Records the edges parsed from a horse page's blood_table (see data_fetcher.get_horse_data)."""
+    if not parent_ids:
+        return
+    add_parents(horse_id, parent_ids.get('sire'), parent_ids.get('mare'), parent_ids.get('bms'))
+    for parent_id, (grand_sire, grand_dam) in parent_ids.get('grandparents', {}).items():
+        add_parents(parent_id, grand_sire, grand_dam)
+
+def get_parents(horse_id):
+    """Returns (sire_id, mare_id, bms_id); fields are None when unknown."""
+    load()
+    return _graph.get(_normalize(horse_id), NO_PARENTS)
+
+def get_field_parents(horse_ids):
+    """Batch lookup for a whole field: {horse_id: (sire_id, mare_id, bms_id)}."""
+    load()
+    return {horse_id: _graph.get(_normalize(horse_id), NO_PARENTS) for horse_id in horse_ids}
+
+def get_ancestors(horse_id, generations=2):
+    """
+    Walks the graph upwards.
+
+    Returns:
+        dict: {path: ancestor_id} where path names the route, e.g. 'sire', 'mare.sire' (= BMS),
+        'sire.mare'. Only ancestors present in the graph are included.
+    """
+    ancestors = {}
+    frontier = [('', _normalize(horse_id))]
+    for _ in range(generations):
+        next_frontier = []
+        for path, current_id in frontier:
+            sire_id, mare_id, _ = get_parents(current_id)
+            for name, parent_id in (('sire', sire_id), ('mare', mare_id)):
+                if parent_id:
+                    parent_path = f"{path}.{name}" if path else name
+                    ancestors[parent_path] = parent_id
+                    next_frontier.append((parent_path, parent_id))
+        frontier = next_frontier
+    bms_id = get_parents(horse_id)[2]
+    if generations >= 2 and 'mare.sire' not in ancestors and bms_id:
+        ancestors['mare.sire'] = bms_id # Shutuba rows name the BMS without the mare's own edge
+    return ancestors
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("使用法: python pedigree.py <horse_id> [世代数]")
+        sys.exit(1)
+    ancestors = get_ancestors(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 2)
+    if not ancestors:
+        print(f"血統グラフに登録がありません: {sys.argv[1]}")
+    for path, ancestor_id in sorted(ancestors.items(), key=lambda item: (item[0].count('.'), item[0])):
+        print(f"  {path}: {ancestor_id}")
@@ -0,0 +1,128 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import requests
+
+import data_fetcher
+import horse_cache
+from history import from_results_df
+
+# Pipelined horse page fetching for large cards and backtests.
+# get_horse_history fetches and parses on one thread, so the network sits idle while
+# BeautifulSoup and read_html run, and the CPU sits idle while waiting for the next page.
+# Here a fetch thread pulls pages at the rate limit and hands them to a process pool for
+# parsing (data_fetcher.parse_horse_page and the history conversion); the main thread stores the parsed results.
+# Both hand-offs are bounded, so when parsing falls behind the fetcher waits instead of
+# holding an unbounded number of pages in memory:
+#
+#   fetch thread --(PAGE_QUEUE_SIZE pages)--> main thread --(2 x workers in flight)--> parse processes
+#
+# Storing (warehouse, pedigree, horse_cache, in-process cache) stays on the main thread, as
+# those modules are not thread-safe.
+
+# One request start per PIPELINE_MIN_INTERVAL_SECONDS, matching data_fetcher's 1s per page.
+PIPELINE_MIN_INTERVAL_SECONDS = 1.0
+PAGE_QUEUE_SIZE = 8
+PARSE_WORKERS = max(1, (os.cpu_count() or 2) - 1) # Leave a core for the fetch and main threads
+IN_FLIGHT_PER_WORKER = 2
+
+def _parse_page(content, since):
+    """Worker process: parses a horse page and converts its results to a history array."""
+    race_results_df, parent_ids = data_fetcher.parse_horse_page(content, since)
+    return race_results_df, parent_ids, from_results_df(race_results_df)
+
+def _fetch_pages(tasks, pages, min_interval, stop_event):
+    """Fetch thread: puts (horse_id, content or None) on pages for each task, then None."""
+    for horse_id, _, _ in tasks:
+        if stop_event.is_set():
+            break
+        start = time.monotonic()
+        try:
+            response = data_fetcher.SESSION.get(f"{data_fetcher.BASE_URL}{horse_id}")
+            response.raise_for_status()
+            content = response.content
+        except requests.exceptions.RequestException as e:
+            print(f"Error fetching data for horse {horse_id}: {e}")
+            content = None
+        pages.put((horse_id, content)) # Blocks while the queue is full
+        time.sleep(max(0, min_interval - (time.monotonic() - start)))
+    pages.put(None)
+
+def fetch_horse_histories(horse_ids, workers=PARSE_WORKERS, min_interval=PIPELINE_MIN_INTERVAL_SECONDS,
+                          queue_size=PAGE_QUEUE_SIZE):
+    """
+    Fills data_fetcher's caches for horse_ids like calling get_horse_history on each, with fetching
+    and parsing overlapped. Horses already cached (and not stale) are skipped.
+
+    Returns:
+        dict: {'fetched': pages fetched, 'failed': pages that could not be fetched or parsed,
+        'seconds': wall time}
+    """
+    start = time.monotonic()
+    tasks = []
+    for horse_id in dict.fromkeys(str(h) for h in horse_ids):
+        if data_fetcher.get_cached_horse_history(horse_id) is not None:
+            continue
+        cached = horse_cache.get(horse_id)
+        since = horse_cache.last_race_date(horse_id) if cached is not None else None
+        tasks.append((horse_id, cached, since))
+    stats = {'fetched': 0, 'failed': 0, 'seconds': 0.0}
+    if not tasks:
+        return stats
+
+    task_by_id = {horse_id: (cached, since) for horse_id, cached, since in tasks}
+    pages = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    fetcher = threading.Thread(target=_fetch_pages, args=(tasks, pages, min_interval, stop_event), daemon=True)
+
+    def store(future):
+        horse_id = in_flight.pop(future)
+        try:
+            race_results_df, parent_ids, history = future.result()
+        except Exception as e:
+            print(f"An error occurred while processing horse {horse_id}: {e}")
+            race_results_df, parent_ids, history = None, None, None
+        if parent_ids is None:
+            stats['failed'] += 1
+        data_fetcher.store_horse_data(horse_id, race_results_df, parent_ids, task_by_id[horse_id][0], history)
+
+    in_flight = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        fetcher.start()
+        try:
+            while True:
+                item = pages.get()
+                if item is None:
+                    break
+                horse_id, content = item
+                stats['fetched'] += 1
+                if content is None:
+                    stats['failed'] += 1
+                    continue
+                # Second bound: wait for a parse to finish before submitting more
+                while len(in_flight) >= workers * IN_FLIGHT_PER_WORKER:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        store(future)
+                in_flight[pool.submit(_parse_page, content, task_by_id[horse_id][1])] = horse_id
+                for future in [f for f in in_flight if f.done()]:
+                    store(future)
+            for future in list(in_flight):
+                store(future)
+        finally:
+            stop_event.set()
+            # Unblock the fetch thread if it is waiting on a full queue after an error
+            while fetcher.is_alive():
+                try:
+                    pages.get_nowait()
+                except queue.Empty:
+                    fetcher.join(0.1)
+    stats['seconds'] = time.monotonic() - start
+    return stats
+
+def print_pipeline_stats(stats):
+    rate = stats['fetched'] / stats['seconds'] if stats['seconds'] else 0
+    print(f"馬ページ {stats['fetched']}件を{stats['seconds']:.1f}秒で取得・解析しました ({rate:.2f}件/秒, 失敗 {stats['failed']}件)")
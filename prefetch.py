@@ -0,0 +1,205 @@
+import sys
+import threading
+import time
+
+import pandas as pd
+
+import main as predictor
+import data_fetcher
+import horse_cache
+import pedigree
+import warehouse
+from card import SHUTUBA_URL_FORMAT, get_race_ids_for_date, get_race_ids_for_kaisai
+from scraping import fetch_and_save_shutuba_data
+
+# Prefetcher for upcoming race cards.
+# Reads the shutuba of every target race, lists the horses, parents, jockeys, sires and BMS
+# they reference, and fetches each one once under a rate limit: by default only the kinds the
+# scorer reads (SCORER_KINDS), every race's pages of a kind before the next kind, races soonest
+# post time first.
+# Run from the command line it fills the on-disk stores (shutuba CSVs, warehouse, pedigree
+# graph, jockey leading table); inside server.py (GET /prefetch) it also keeps the fetched
+# pages in the server's in-process caches, so race-day predictions are cache hits.
+#
+#   python prefetch.py <YYYYMMDD> [venue]
+#   python prefetch.py <race_id> [<race_id> ...]
+
+# At most one page every PREFETCH_MIN_INTERVAL_SECONDS (data_fetcher's own 1s sleep included).
+PREFETCH_MIN_INTERVAL_SECONDS = 2.0
+
+# Every kind of page a race references, in fetch order.
+ENTITY_KINDS = ('horse', 'jockey', 'sire', 'bms', 'parent')
+# get_horse_score_components reads only the runner's own page (shared with fetch_plan.py).
+SCORER_KINDS = ('horse',)
+KIND_NAMES = {'horse': '出走馬', 'jockey': '騎手', 'sire': '父', 'bms': '母父', 'parent': '父母の成績'}
+
+FETCHERS = {
+    'horse': data_fetcher.get_horse_history,
+    'parent': data_fetcher.get_horse_history,
+    'jockey': data_fetcher.get_jockey_course_aptitude,
+    'sire': data_fetcher.get_sire_course_aptitude,
+    'bms': data_fetcher.get_bms_course_aptitude,
+}
+
+# Progress of the current background run, read by server.py's /prefetch/status.
+_status = {'running': False, 'done': 0, 'total': 0, 'races': [], 'coverage': {}}
+
+def _ids(df, column):
+    if column not in df.columns:
+        return []
+    return [str(value).strip() for value in df[column].dropna() if str(value).strip()]
+
+def race_entities(df_shutuba):
+    """{kind: list of ids} referenced by one race's shutuba, in ENTITY_KINDS order."""
+    horse_ids = _ids(df_shutuba, 'horse_id')
+    parents = pedigree.get_field_parents(horse_ids)
+    return {
+        'horse': horse_ids,
+        'jockey': [f"{int(float(jockey_cd)):05d}" for jockey_cd in _ids(df_shutuba, 'jockey_cd')],
+        'sire': _ids(df_shutuba, 'sire_id'),
+        'bms': _ids(df_shutuba, 'bms_id'),
+        'parent': list(dict.fromkeys(parent_id for sire_id, mare_id, _ in parents.values()
+                                     for parent_id in (sire_id, mare_id) if parent_id)),
+    }
+
+def race_priority(race_id, race_info):
+    """Sort key: race date, then post time, then race_id (race number within a day)."""
+    if not race_info:
+        return (pd.Timestamp.max, '99:99', race_id)
+    return (race_info['date'], race_info.get('post_time') or '99:99', race_id)
+
+def plan_prefetch(race_ids):
+    """
+    Loads the shutuba of each race and orders the races by post time.
+
+    Returns:
+        list: [(race_id, {kind: ids})] soonest race first. Races without a shutuba are left out.
+    """
+    races = []
+    for race_id in race_ids:
+        csv_path = fetch_and_save_shutuba_data(race_id)
+        if not csv_path:
+            continue
+        df_shutuba = pd.read_csv(csv_path)
+        warehouse.ingest_shutuba(df_shutuba) # Registers sire/mare/BMS so parents are known
+        horse_cache.record_entries(df_shutuba) # Marks the horses' pages stale once this race is run
+        race_info = predictor.get_race_info_from_url(SHUTUBA_URL_FORMAT.format(race_id=race_id))
+        races.append((race_priority(race_id, race_info), race_id, race_entities(df_shutuba)))
+    return [(race_id, entities) for _, race_id, entities in sorted(races, key=lambda race: race[0])]
+
+def is_cached(kind, entity_id):
+    """True when fetching this entity again would be a cache hit."""
+    if kind in ('horse', 'parent'):
+        return data_fetcher.get_cached_horse_history(entity_id) is not None
+    return data_fetcher.is_course_aptitude_cached(kind, entity_id)
+
+def coverage(plan, kinds=SCORER_KINDS):
+    """{race_id: {kind: (cached, total)}} for a plan from plan_prefetch."""
+    return {
+        race_id: {kind: (sum(1 for entity_id in entities[kind] if is_cached(kind, entity_id)), len(entities[kind]))
+                  for kind in kinds}
+        for race_id, entities in plan
+    }
+
+def print_coverage(race_coverage):
+    print("\n--- キャッシュ済みの割合 ---")
+    for race_id, kinds in race_coverage.items():
+        print(f"{race_id}: " + ", ".join(f"{KIND_NAMES[kind]} {cached}/{total}" for kind, (cached, total) in kinds.items()))
+    cached = sum(c for kinds in race_coverage.values() for c, _ in kinds.values())
+    total = sum(t for kinds in race_coverage.values() for _, t in kinds.values())
+    print(f"合計: {cached}/{total} ({cached / total if total else 1:.0%})")
+
+def run_prefetch(plan, min_interval=PREFETCH_MIN_INTERVAL_SECONDS, lock=None, stop_event=None, kinds=SCORER_KINDS):
+    """
+    Fetches every entity of the given kinds in the plan that is not cached yet, at most one page
+    per min_interval. All races' pages of one kind come before the next kind's, so the horse
+    pages of later races are not held up behind the other pages of earlier ones.
+
+    Args:
+        lock (threading.Lock): Held during each fetch; server.py passes its prediction lock so
+            a prediction waits for at most one page.
+        stop_event (threading.Event): Ends the run early when set.
+
+    Returns:
+        int: Number of pages fetched.
+    """
+    tasks = []
+    seen = set()
+    for kind in kinds:
+        for race_id, entities in plan:
+            for entity_id in entities[kind]:
+                if (kind, entity_id) not in seen:
+                    seen.add((kind, entity_id))
+                    tasks.append((kind, entity_id))
+
+    _status.update(done=0, total=len(tasks))
+    fetched = 0
+    for kind, entity_id in tasks:
+        if stop_event is not None and stop_event.is_set():
+            break
+        _status['done'] += 1
+        if is_cached(kind, entity_id):
+            continue
+        start = time.monotonic()
+        if lock is not None:
+            with lock:
+                FETCHERS[kind](entity_id)
+        else:
+            FETCHERS[kind](entity_id)
+        fetched += 1
+        time.sleep(max(0, min_interval - (time.monotonic() - start)))
+    return fetched
+
+def start_background_prefetch(race_ids, min_interval=PREFETCH_MIN_INTERVAL_SECONDS, lock=None, kinds=SCORER_KINDS):
+    """Runs plan_prefetch and run_prefetch in a daemon thread. Returns None if a run is already going."""
+    if _status['running']:
+        return None
+
+    def worker():
+        try:
+            plan = plan_prefetch(race_ids)
+            _status['races'] = [race_id for race_id, _ in plan]
+            run_prefetch(plan, min_interval, lock, kinds=kinds)
+            _status['coverage'] = coverage(plan, kinds)
+        except Exception as e:
+            print(f"先読み中にエラー: {e}")
+        finally:
+            _status['running'] = False
+
+    _status.update(running=True, done=0, total=0, races=[], coverage={})
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    return thread
+
+def get_status():
+    """Progress of the background prefetch: running, done/total pages checked, races and coverage."""
+    return dict(_status)
+
+def resolve_race_ids(args):
+    """race_ids from the command line: a date (YYYYMMDD [venue]), a 10-digit kaisai prefix or race_ids."""
+    if len(args[0]) == 8:
+        return get_race_ids_for_date(args[0], args[1] if len(args) > 1 else None)
+    if len(args[0]) == 10:
+        return get_race_ids_for_kaisai(args[0])
+    return args
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("使用法: python prefetch.py <YYYYMMDD> [競馬場名]")
+        print("        python prefetch.py <race_id> [<race_id> ...]")
+        sys.exit(1)
+
+    race_ids = resolve_race_ids(sys.argv[1:])
+    if not race_ids:
+        print("対象レースが見つかりません。")
+        sys.exit(1)
+
+    plan = plan_prefetch(race_ids)
+    print(f"{len(plan)}レースを発走時刻順に先読みします (1ページ/{PREFETCH_MIN_INTERVAL_SECONDS:.0f}秒)。")
+    print_coverage(coverage(plan))
+    try:
+        fetched = run_prefetch(plan)
+        print(f"\n{fetched}ページを取得しました。")
+    except KeyboardInterrupt:
+        print("\n先読みを中断します。")
+    print_coverage(coverage(plan))
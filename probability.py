@@ -0,0 +1,138 @@
+import itertools
+
+import numpy as np
+
+# Finish-probability engine.
+# Per-runner scores are turned into win probabilities, and the Harville model
+# (P(j 2nd | i 1st) = p_j / (1 - p_i), and so on) gives the probability of every
+# finishing order. Place, wide and trio probabilities are sums over the n x n x n
+# tensor of ordered top-3 finishes, all computed with NumPy at once.
+# simulate_probabilities draws whole finishing orders from the same model (Plackett-Luce via
+# the Gumbel-max trick) for quantities without a closed form.
+
+# Scores are standardised per race before the softmax. Lower temperature = more
+# confidence in the top-scored runner.
+WIN_PROBABILITY_TEMPERATURE = 1.0
+DEFAULT_SIMULATIONS = 100_000
+WIDE_PLACES = 3
+
+def fukusho_places(num_runners):
+    """Number of paid places for fukusho: 2 with 7 or fewer runners, otherwise 3."""
+    return 2 if num_runners <= 7 else 3
+
+def scores_to_win_probabilities(scores, temperature=WIN_PROBABILITY_TEMPERATURE):
+    """Softmax over standardised scores. Returns an array summing to 1."""
+    scores = np.asarray(scores, dtype=float)
+    std = scores.std()
+    z = (scores - scores.mean()) / std if std > 0 else np.zeros_like(scores)
+    weights = np.exp((z - z.max()) / temperature)
+    return weights / weights.sum()
+
+def harville_order_probabilities(win_probabilities):
+    """
+    Harville probabilities for the top 3 finishing positions.
+
+    Returns:
+        tuple: (first[i], second[i, j] = P(i 1st, j 2nd), third[i, j, k] = P(i 1st, j 2nd, k 3rd))
+    """
+    p = np.asarray(win_probabilities, dtype=float)
+    n = len(p)
+    eye = np.eye(n, dtype=bool)
+    after_first = 1 - p
+    second = p[:, None] * p[None, :] / np.where(after_first > 0, after_first, 1)[:, None]
+    second[eye] = 0
+    after_second = 1 - p[:, None] - p[None, :]
+    third = second[:, :, None] * p[None, None, :] / np.where(after_second > 0, after_second, 1)[:, :, None]
+    distinct = ~(eye[:, :, None] | eye[:, None, :] | eye[None, :, :])
+    third[~distinct] = 0
+    return p, second, third
+
+def harville_probabilities(win_probabilities, places=None):
+    """
+    Closed-form probabilities under the Harville model.
+
+    Args:
+        win_probabilities (array): Win probability per runner.
+        places (int): Paid places for fukusho; defaults to fukusho_places(n).
+
+    Returns:
+        dict: 'win' (n,), 'place' (n,) fukusho probability, 'wide' (n, n) symmetric probability
+        that both runners finish in the top 3, 'trio' {(i, j, k): probability} with i < j < k.
+    """
+    first, second, third = harville_order_probabilities(win_probabilities)
+    n = len(first)
+    places = places or fukusho_places(n)
+
+    top2 = first + second.sum(axis=0)
+    top3 = top2 + third.sum(axis=(0, 1))
+    place = top3 if places >= 3 else top2
+
+    if n < WIDE_PLACES:
+        wide = 1 - np.eye(n) # Every runner is in the top 3: each pair is a wide hit
+    else:
+        both_in_top3 = third.sum(axis=2) + third.sum(axis=1) + third.sum(axis=0)
+        wide = both_in_top3 + both_in_top3.T
+
+    unordered = sum(third.transpose(order) for order in itertools.permutations(range(3)))
+    trio = {(i, j, k): unordered[i, j, k] for i, j, k in itertools.combinations(range(n), 3)}
+    return {'win': first, 'place': place, 'wide': wide, 'trio': trio}
+
+def simulate_finishing_orders(win_probabilities, num_simulations=DEFAULT_SIMULATIONS, top=3, rng=None):
+    """
+    Samples finishing orders from the Plackett-Luce (Harville) model.
+
+    Returns:
+        np.ndarray: (num_simulations, min(top, n)) runner indices of the first finishers.
+    """
+    rng = np.random.default_rng(rng)
+    log_p = np.log(np.clip(np.asarray(win_probabilities, dtype=float), 1e-300, None))
+    top = min(top, len(log_p))
+    keys = log_p[None, :] + rng.gumbel(size=(num_simulations, len(log_p)))
+    top_unsorted = np.argpartition(-keys, top - 1, axis=1)[:, :top]
+    order = np.argsort(-np.take_along_axis(keys, top_unsorted, axis=1), axis=1)
+    return np.take_along_axis(top_unsorted, order, axis=1)
+
+def simulate_probabilities(win_probabilities, num_simulations=DEFAULT_SIMULATIONS, places=None, rng=None):
+    """Monte Carlo estimate of the same quantities as harville_probabilities."""
+    n = len(win_probabilities)
+    places = places or fukusho_places(n)
+    orders = simulate_finishing_orders(win_probabilities, num_simulations, top=WIDE_PLACES, rng=rng)
+
+    win = np.bincount(orders[:, 0], minlength=n) / num_simulations
+    place = np.bincount(orders[:, :places].ravel(), minlength=n) / num_simulations
+    if n < WIDE_PLACES:
+        return {'win': win, 'place': place, 'wide': 1 - np.eye(n), 'trio': {}} # No trio; every pair is a wide hit
+
+    top3 = np.sort(orders, axis=1)
+    pair_codes = np.concatenate([top3[:, 0] * n + top3[:, 1], top3[:, 0] * n + top3[:, 2], top3[:, 1] * n + top3[:, 2]])
+    wide = np.bincount(pair_codes, minlength=n * n).reshape(n, n) / num_simulations
+    wide = wide + wide.T
+
+    trio_codes = (top3[:, 0] * n + top3[:, 1]) * n + top3[:, 2]
+    trio_counts = np.bincount(trio_codes, minlength=n ** 3)
+    trio = {(i, j, k): trio_counts[(i * n + j) * n + k] / num_simulations
+            for i, j, k in itertools.combinations(range(n), 3)}
+    return {'win': win, 'place': place, 'wide': wide, 'trio': trio}
+
+def race_probabilities(sorted_horses, method='harville', num_simulations=DEFAULT_SIMULATIONS):
+    """
+    Probabilities for main()'s sorted_horses, keyed by umaban.
+
+    Returns:
+        dict: 'win' and 'place' {umaban: p}, 'wide' {(umaban, umaban): p}, 'trio' {(u1, u2, u3): p},
+        with umaban tuples sorted ascending.
+    """
+    umaban = [int(h['umaban']) for h in sorted_horses]
+    win_probabilities = scores_to_win_probabilities([h['score'] for h in sorted_horses])
+    if method == 'monte_carlo':
+        probs = simulate_probabilities(win_probabilities, num_simulations)
+    else:
+        probs = harville_probabilities(win_probabilities)
+    n = len(umaban)
+    return {
+        'win': {umaban[i]: float(probs['win'][i]) for i in range(n)},
+        'place': {umaban[i]: float(probs['place'][i]) for i in range(n)},
+        'wide': {tuple(sorted((umaban[i], umaban[j]))): float(probs['wide'][i, j])
+                 for i, j in itertools.combinations(range(n), 2)},
+        'trio': {tuple(sorted(umaban[x] for x in combo)): float(p) for combo, p in probs['trio'].items()},
+    }
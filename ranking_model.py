@@ -0,0 +1,243 @@
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+
+# Trainable ranking model over the scorer's per-runner components (scorer.SCORE_COMPONENTS).
+# A conditional logit: runner i's win probability in its race is softmax(w . x_i) over the
+# field, and the finishing order is modelled as successive choices among the runners left
+# (Plackett-Luce over the first TRAIN_PLACES places). The log-likelihood is concave, so a
+# few Newton steps on the whole corpus at once (padded race x runner arrays) fit it in seconds.
+# Inference for a card is one matrix product.
+#
+#   python ranking_model.py [--holdout 0.2]   train on the feature store (features.py) and save
+#
+# main.main(..., scoring='model') and evaluate.py --model score races with the saved model.
+
+MODEL_FILE = "/Users/akahoshihiroki/Documents/pytests/keiba_yosou/ranking_model.json"
+
+TRAIN_PLACES = 3     # 1st, 2nd and 3rd place are each one choice among the runners left
+L2_PENALTY = 1.0     # on standardised weights
+MAX_NEWTON_STEPS = 50
+TOLERANCE = 1e-8     # stop when the log-likelihood improves by less than this per race
+DEFAULT_HOLDOUT = 0.2 # fraction of races (the latest) kept out of training for the report
+
+_model = None # Loaded lazily by load_model
+
+def pad_races(features, ranks, race_offsets):
+    """
+    Lays the store's runner rows out as (races, max field size) arrays.
+
+    Returns:
+        tuple: (X (races, runners, features), mask (races, runners) True for real runners,
+        finishing positions (races, runners), 0 for padding and unplaced runners)
+    """
+    sizes = np.diff(race_offsets)
+    num_races, field_size = len(sizes), int(sizes.max()) if len(sizes) else 0
+    race_numbers = np.repeat(np.arange(num_races), sizes)
+    positions = np.arange(len(race_numbers)) - np.repeat(race_offsets[:-1], sizes)
+    X = np.zeros((num_races, field_size, features.shape[1]))
+    mask = np.zeros((num_races, field_size), dtype=bool)
+    padded_ranks = np.zeros((num_races, field_size), dtype=int)
+    X[race_numbers, positions] = features
+    mask[race_numbers, positions] = True
+    padded_ranks[race_numbers, positions] = ranks
+    return X, mask, padded_ranks
+
+def log_likelihood(weights, X, mask, ranks, places=TRAIN_PLACES, l2=L2_PENALTY):
+    """Penalised Plackett-Luce log-likelihood of the first `places` places, with gradient and Hessian."""
+    num_features = X.shape[2]
+    utilities = X @ weights
+    remaining = mask.copy()
+    total = -0.5 * l2 * weights @ weights
+    gradient = -l2 * weights
+    hessian = -l2 * np.eye(num_features)
+    for place in range(1, places + 1):
+        chosen = ranks == place
+        # Only stages with exactly one runner in that place (dead heats are skipped) and a choice to make
+        valid = (chosen.sum(axis=1) == 1) & (remaining.sum(axis=1) > 1)
+        if valid.any():
+            u = np.where(remaining[valid], utilities[valid], -np.inf)
+            top = u.max(axis=1, keepdims=True)
+            expu = np.exp(u - top)
+            partition = expu.sum(axis=1, keepdims=True)
+            p = expu / partition
+            Xv = X[valid]
+            x_chosen = np.einsum('rn,rnf->rf', chosen[valid], Xv)
+            x_mean = np.einsum('rn,rnf->rf', p, Xv)
+            total += float((x_chosen @ weights - top[:, 0] - np.log(partition[:, 0])).sum())
+            gradient += (x_chosen - x_mean).sum(axis=0)
+            hessian -= np.einsum('rn,rnf,rng->fg', p, Xv, Xv) - x_mean.T @ x_mean
+        remaining &= ~chosen
+    return total, gradient, hessian
+
+def fit(features, ranks, race_offsets, places=TRAIN_PLACES, l2=L2_PENALTY):
+    """
+    Fits the weights by Newton's method with step halving.
+
+    Returns:
+        tuple: (weights on standardised features, mean, std, final log-likelihood)
+    """
+    mean = features.mean(axis=0)
+    std = features.std(axis=0)
+    std = np.where(std > 0, std, 1.0) # Constant components get weight ~0 from the penalty
+    X, mask, padded_ranks = pad_races((features - mean) / std, ranks, race_offsets)
+    weights = np.zeros(features.shape[1])
+    current, gradient, hessian = log_likelihood(weights, X, mask, padded_ranks, places, l2)
+    for _ in range(MAX_NEWTON_STEPS):
+        step = np.linalg.solve(hessian, -gradient)
+        scale = 1.0
+        while scale > 1e-4:
+            candidate = weights + scale * step
+            value, candidate_gradient, candidate_hessian = log_likelihood(candidate, X, mask, padded_ranks, places, l2)
+            if value >= current:
+                break
+            scale /= 2
+        else:
+            break # No step improves the fit
+        improvement = value - current
+        weights, current, gradient, hessian = candidate, value, candidate_gradient, candidate_hessian
+        if improvement < TOLERANCE * max(len(race_offsets) - 1, 1):
+            break
+    return weights, mean, std, current
+
+def utilities(features, model):
+    """w . x for a (runners, components) matrix, on the model's standardised scale."""
+    features = np.asarray(features, dtype=float)
+    return ((features - np.asarray(model['mean'])) / np.asarray(model['std'])) @ np.asarray(model['weights'])
+
+def win_probabilities(features, model):
+    """Softmax of the utilities over one race's runners."""
+    u = utilities(features, model)
+    expu = np.exp(u - u.max())
+    return expu / expu.sum()
+
+def race_metrics(features, ranks, race_offsets, score):
+    """Winner log-likelihood per race and top-1 accuracy of a score (utility) vector over a set of races."""
+    log_likelihoods, top1 = [], []
+    for start, end in zip(race_offsets[:-1], race_offsets[1:]):
+        race_ranks = ranks[start:end]
+        if (race_ranks == 1).sum() != 1:
+            continue
+        u = score[start:end]
+        u = u - u.max()
+        winner = int(np.argmax(race_ranks == 1))
+        log_likelihoods.append(u[winner] - np.log(np.exp(u).sum()))
+        top1.append(np.argmax(u) == winner)
+    return (float(np.mean(log_likelihoods)) if log_likelihoods else float('nan'),
+            float(np.mean(top1)) if top1 else float('nan'), len(top1))
+
+def train_from_store(store, holdout=DEFAULT_HOLDOUT, places=TRAIN_PLACES, l2=L2_PENALTY):
+    """
+    Trains on the races of an open feature store, keeping the latest `holdout` fraction for the report,
+    then refits on every race for the saved model.
+
+    Returns:
+        dict: The model (weights, mean, std, feature_names, scorer_version, version, report).
+    """
+    features = np.asarray(store['features'], dtype=float)
+    ranks = np.asarray(store['index']['rank'], dtype=int)
+    offsets = np.asarray(store['race_offsets'])
+    race_ids = np.asarray(store['index']['race_id'])[offsets[:-1]] if len(offsets) > 1 else np.zeros(0)
+
+    report = {}
+    num_races = len(offsets) - 1
+    num_holdout = int(num_races * holdout)
+    if num_holdout > 0:
+        # race_id starts with the year and orders races within a year well enough for a time split
+        order = np.argsort(race_ids, kind='stable')
+        train_races, test_races = np.sort(order[:-num_holdout]), np.sort(order[-num_holdout:])
+
+        def subset(race_numbers):
+            rows = np.concatenate([np.arange(offsets[r], offsets[r + 1]) for r in race_numbers])
+            sub_offsets = np.concatenate([[0], np.cumsum(np.diff(offsets)[race_numbers])])
+            return features[rows], ranks[rows], sub_offsets
+
+        train_features, train_ranks, train_offsets = subset(train_races)
+        test_features, test_ranks, test_offsets = subset(test_races)
+        weights, mean, std, _ = fit(train_features, train_ranks, train_offsets, places, l2)
+        held_out_model = {'weights': weights, 'mean': mean, 'std': std}
+        report['model'] = race_metrics(test_features, test_ranks, test_offsets, utilities(test_features, held_out_model))
+        # Baseline: get_horse_total_score's sum of components, through main's softmax of standardised scores
+        baseline = test_features.sum(axis=1)
+        baseline_std = np.concatenate([np.full(e - s, baseline[s:e].std() or 1.0) for s, e in zip(test_offsets[:-1], test_offsets[1:])])
+        baseline_mean = np.concatenate([np.full(e - s, baseline[s:e].mean()) for s, e in zip(test_offsets[:-1], test_offsets[1:])])
+        report['sum'] = race_metrics(test_features, test_ranks, test_offsets, (baseline - baseline_mean) / baseline_std)
+
+    weights, mean, std, value = fit(features, ranks, offsets, places, l2)
+    model = {
+        'feature_names': list(store['feature_names']),
+        'scorer_version': store['scorer_version'],
+        'weights': weights.tolist(),
+        'mean': mean.tolist(),
+        'std': std.tolist(),
+        'places': places,
+        'l2': l2,
+        'races': num_races,
+        'log_likelihood': value,
+        'report': report,
+    }
+    model['version'] = hashlib.sha1(json.dumps(model['weights']).encode()).hexdigest()[:8]
+    return model
+
+def save_model(model, path=MODEL_FILE):
+    global _model
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(model, f, ensure_ascii=False, indent=1)
+    _model = model
+
+def load_model(path=MODEL_FILE):
+    """The saved model, or None if none has been trained. Warns when it was trained on another scorer version."""
+    global _model
+    if _model is not None:
+        return _model
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        _model = json.load(f)
+    from scorer import SCORE_COMPONENTS, SCORER_VERSION
+    if _model['feature_names'] != list(SCORE_COMPONENTS):
+        print(f"モデルの特徴量がスコアラーと一致しません。再学習してください: {path}")
+        _model = None
+        return None
+    if _model['scorer_version'] != SCORER_VERSION:
+        print(f"注意: モデルはスコアラー {_model['scorer_version']} の特徴量で学習されています (現在 {SCORER_VERSION})。")
+    return _model
+
+def scoring_version(model):
+    """Version tag for results scored by the model (evaluate.py's journal key)."""
+    return f"{model['scorer_version']}+model-{model['version']}"
+
+def score_field(components, model):
+    """
+    Scores one race from its runners' component dicts (main.shutuba_row_components).
+
+    Returns:
+        tuple: (utilities, win probabilities) as arrays in the order of components.
+    """
+    matrix = np.array([[c[name] for name in model['feature_names']] for c in components], dtype=float)
+    return utilities(matrix, model), win_probabilities(matrix, model)
+
+def print_report(model):
+    print(f"学習レース数: {model['races']}, 対数尤度: {model['log_likelihood']:.1f}, モデル版: {model['version']}")
+    for name, weight in sorted(zip(model['feature_names'], model['weights']), key=lambda item: -abs(item[1])):
+        print(f"  {name}: {weight:+.3f}")
+    report = model.get('report') or {}
+    for key, label in (('sum', '現行スコア(合計)'), ('model', '学習モデル')):
+        if key in report:
+            log_likelihood_per_race, accuracy, races = report[key]
+            print(f"検証 {label}: 1着の対数尤度 {log_likelihood_per_race:.3f}/レース, 1着的中率 {accuracy:.1%} ({races}レース)")
+
+if __name__ == '__main__':
+    from features import FEATURE_STORE_DIR, open_feature_store
+    holdout = float(sys.argv[sys.argv.index('--holdout') + 1]) if '--holdout' in sys.argv[1:-1] else DEFAULT_HOLDOUT
+    store = open_feature_store()
+    if store is None or store['races'] == 0:
+        print(f"特徴量ストアがありません: {FEATURE_STORE_DIR} (python features.py で作成してください)")
+        sys.exit(1)
+    model = train_from_store(store, holdout)
+    save_model(model)
+    print_report(model)
+    print(f"モデルを保存しました: {MODEL_FILE}")
@@ -3,8 +3,13 @@
 import pandas as pd
 import numpy as np
 import re
-from data_fetcher import get_horse_data, get_jockey_leading_data, get_horse_course_aptitude, get_jockey_course_aptitude, get_sire_course_aptitude, get_bms_course_aptitude
-import time
+from history import MISSING, TRACK_CONDITIONS, WEATHERS, as_of, from_results_df
+from data_fetcher import get_horse_history_as_of
+import course_index
+
+# Bump whenever a change alters the scores. evaluate.py's journal only reuses races
+# evaluated with the same version.
+SCORER_VERSION = "2025.4"
 
 # --- Scoring Constants ---
 # Base scores for rank (reduced for finer granularity)
@@ -18,27 +23,6 @@ RANK_SCORES = {
 }
 DEFAULT_RANK_SCORE = 20
 
-# Margin adjustment (smaller margin = higher bonus, reduced values)
-# These are now interpreted as seconds or fractions of a second behind the winner.
-# Smaller values mean closer to the winner, thus higher bonus.
-MARGIN_TO_SECONDS = {
-    "クビ": 0.05,  # Neck
-    "アタマ": 0.02, # Head
-    "ハナ": 0.01,  # Nose
-    "1/2": 0.1,   # 1/2 length
-    "3/4": 0.15,  # 3/4 length
-    "1": 0.2,     # 1 length
-    "1 1/4": 0.25,
-    "1 1/2": 0.3,
-    "1 3/4": 0.35,
-    "2": 0.4,
-    "2 1/2": 0.5,
-    "3": 0.6,
-    "3 1/2": 0.7,
-    "4": 0.8,
-    "5": 1.0,
-    # Add more as needed, larger margins will get less bonus
-}
 MAX_MARGIN_BONUS = 500 # Increased max points for being very close to the winner
 
 # Race condition similarity weights (used to distribute max bonus)
@@ -58,9 +42,6 @@ POPULARITY_SCORES = {
 }
 DEFAULT_POPULARITY_SCORE = 500
 
-# Parent horse score multiplier
-PARENT_SCORE_MULTIPLIER = 3.0 # Further increased influence of parent scores
-
 # Fairness (忖度) Logic Constants
 MIN_RACES_FOR_FAIRNESS = 10 # Threshold for "fewer starts"
 MIN_AVG_SCORE_FOR_FAIRNESS = 15 # Average score per race to be considered "good" (e.g., better than 5th place base score)
@@ -103,34 +84,6 @@ CHAKUSA_SCORE_MULTIPLIER = 200 # Multiplier for chakusa score (smaller margin is
 
 # --- Helper Functions ---
 
-def parse_margin(margin_str):
-    """Converts margin string to a numerical value (seconds) for scoring."""
-    if pd.isna(margin_str):
-        return 999.0 # Large value for unknown margin
-
-    margin_str = str(margin_str).strip()
-
-    # Direct mapping for common small margins
-    if margin_str in MARGIN_TO_SECONDS:
-        return MARGIN_TO_SECONDS[margin_str]
-
-    # Handle numerical margins (e.g., "2 1/2", "3", "0.5")
-    try:
-        if " " in margin_str:
-            parts = margin_str.split(" ")
-            whole = float(parts[0])
-            # Safely parse fraction without eval
-            if '/' in parts[1]:
-                num, den = map(int, parts[1].split('/'))
-                fraction = num / den
-            else:
-                fraction = float(parts[1])
-            return whole + fraction
-        return float(margin_str)
-    except ValueError:
-        # If parsing fails, it's a large or unrecognised margin, assign a large value
-        return 999.0
-
 def calculate_race_condition_similarity(race_distance, race_track_type, race_weather, 
                                         target_distance, target_track_type, target_weather):
     """Calculates an additive similarity bonus based on race conditions."""
@@ -189,84 +142,78 @@ def calculate_sex_age_score(sex, age):
 
 # --- Main Scoring Functions ---
 
-def calculate_past_performance_score(race_results_df, target_distance, target_track_type, target_weather, current_race_date):
-    """Calculates a score based on a horse's past race results, considering recency and finishing speed."""
-    total_score = 0
-    num_races_evaluated = 0
-    total_score_recent_6_months = 0
-    total_agari_3f_score = 0
-
-    if race_results_df is None or race_results_df.empty:
-        return total_score, num_races_evaluated, total_score_recent_6_months, total_agari_3f_score
-
-    race_results_df['日付'] = pd.to_datetime(race_results_df['日付'], errors='coerce')
-    race_results_df['agari_3f'] = pd.to_numeric(race_results_df['agari_3f'], errors='coerce')
-
-    six_months_ago = current_race_date - pd.DateOffset(months=6)
-
-    for index, row in race_results_df.iterrows():
-        rank = row.get('着 順')
-        margin = row.get('着差') # This is margin to the winner for non-winners, or 0 for winner
-        race_distance = row.get('距離')
-        race_track_type = row.get('馬 場')
-        race_weather = row.get('天 気')
-        agari_3f = row.get('agari_3f')
-
-        if pd.isna(rank):
-            rank_score = DEFAULT_RANK_SCORE
-        else:
-            try:
-                rank = int(rank)
-                rank_score = RANK_SCORES.get(rank, DEFAULT_RANK_SCORE)
-            except ValueError:
-                rank_score = DEFAULT_RANK_SCORE
-
-        # Calculate margin bonus: smaller margin (closer to winner) means higher bonus
-        margin_bonus = 0
-        if pd.notna(margin) and rank != 1: # Only apply margin bonus if not 1st place
-            parsed_margin_seconds = parse_margin(margin)
-            # Inverse relationship: smaller seconds -> higher bonus
-            # Example: 0.01s (ハナ) -> MAX_MARGIN_BONUS
-            # 1.0s (5馬身) -> 0 bonus
-            if parsed_margin_seconds <= 0.5: # For very close finishes
-                margin_bonus = MAX_MARGIN_BONUS * (1 - (parsed_margin_seconds / 0.5))
-            elif parsed_margin_seconds <= 1.0: # For close finishes
-                margin_bonus = (MAX_MARGIN_BONUS / 2) * (1 - ((parsed_margin_seconds - 0.5) / 0.5))
-            # For margins > 1.0s, bonus quickly diminishes or becomes 0
-
-        race_base_score = rank_score + margin_bonus
-
-        # Agari 3F (finishing speed) score
-        agari_score = 0
-        if pd.notna(agari_3f) and agari_3f > 0:
-            # Higher score for faster times (lower agari_3f value)
-            agari_score = max(0, 50 - agari_3f) * 30 # Increased impact
-        
-        # Recency factor
-        race_date = row.get('日付')
-        if pd.isna(race_date):
-            continue
-        days_since_race = (current_race_date - race_date).days
-        recency_factor = max(0.1, 1 - (days_since_race / RECENCY_DECAY_DAYS))
-
-        # Apply recency to all parts of the score
-        race_score_with_recency = (race_base_score + agari_score) * recency_factor
-
-        # Similarity bonus
-        similarity_bonus = calculate_race_condition_similarity(
-            race_distance, race_track_type, race_weather,
-            target_distance, target_track_type, target_weather
-        )
-        
-        final_race_score = race_score_with_recency + similarity_bonus
-        total_score += final_race_score
-        num_races_evaluated += 1
-        total_agari_3f_score += agari_score * recency_factor # Keep track of the 3f score part
+def _condition_score_table(scores, vocabulary):
+    """Per-code score lookup for an encoded history column (OTHER scores 0)."""
+    return np.array([0] + [scores.get(value, 0) for value in vocabulary], dtype=float)
 
-        if pd.to_datetime(race_date) >= six_months_ago:
-            total_score_recent_6_months += final_race_score
+RANK_SCORE_TABLE = np.array([RANK_SCORES.get(rank, DEFAULT_RANK_SCORE) for rank in range(max(RANK_SCORES) + 1)], dtype=float)
+RANK_SCORE_TABLE[0] = DEFAULT_RANK_SCORE # rank 0 means the position was not a number
+TRACK_TYPE_SCORE_TABLE = _condition_score_table(TRACK_TYPE_SCORES, TRACK_CONDITIONS)
+WEATHER_SCORE_TABLE = _condition_score_table(WEATHER_SCORES, WEATHERS)
 
-    return total_score, num_races_evaluated, total_score_recent_6_months, total_agari_3f_score
+def calculate_past_performance_score(history, target_distance, target_track_type, target_weather, current_race_date):
+    """Calculates a score based on a horse's past race results, considering recency and finishing speed.
+    `history` is a compact history array (see history.py); a raw results DataFrame is converted first.
+    All past races are scored at once with NumPy.
+    """
+    if isinstance(history, pd.DataFrame) or history is None:
+        history = from_results_df(history)
+
+    history = history[~np.isnat(history['date'])] # Races without a date are skipped
+    if len(history) == 0:
+        return 0, 0, 0, 0
+
+    # Base score from finishing position
+    ranks = history['rank'].astype(int)
+    rank_score = np.where(ranks < len(RANK_SCORE_TABLE),
+                          RANK_SCORE_TABLE[np.clip(ranks, 0, len(RANK_SCORE_TABLE) - 1)], DEFAULT_RANK_SCORE)
+
+    # Margin bonus: smaller margin (closer to winner) means higher bonus, only when not 1st place
+    # Example: 0.01s (ハナ) -> MAX_MARGIN_BONUS, 1.0s (5馬身) -> 0 bonus
+    margins = history['margin'].astype(float)
+    margin_bonus = np.where(margins <= 0.5, MAX_MARGIN_BONUS * (1 - margins / 0.5),
+                            np.where(margins <= 1.0, (MAX_MARGIN_BONUS / 2) * (1 - (margins - 0.5) / 0.5), 0))
+    margin_bonus = np.where(np.isnan(margins) | (ranks == 1), 0, margin_bonus)
+
+    race_base_score = rank_score + margin_bonus
+
+    # Agari 3F (finishing speed) score: higher score for faster times (lower agari_3f value)
+    agari_3f = history['agari_3f'].astype(float)
+    agari_score = np.where(agari_3f > 0, np.maximum(0, 50 - np.nan_to_num(agari_3f)) * 30, 0)
+
+    # Recency factor, applied to all parts of the score
+    current_day = np.datetime64(pd.Timestamp(current_race_date).date(), 'D')
+    days_since_race = (current_day - history['date']).astype(int)
+    recency_factor = np.maximum(0.1, 1 - (days_since_race / RECENCY_DECAY_DAYS))
+    race_score_with_recency = (race_base_score + agari_score) * recency_factor
+
+    # Similarity bonus (vectorised calculate_race_condition_similarity)
+    similarity_bonus = np.zeros(len(history))
+    target_dist_match = re.search(r'\d+', str(target_distance)) if not pd.isna(target_distance) else None
+    if target_dist_match:
+        dist_diff = np.abs(history['distance'].astype(int) - int(target_dist_match.group()))
+        similarity_bonus += np.where(history['distance'] > 0,
+                                     np.maximum(0, (1 - dist_diff / 1000)) * MAX_SIMILARITY_BONUS_PER_FACTOR * DISTANCE_SIMILARITY_WEIGHT, 0)
+    if not pd.isna(target_track_type):
+        target_tt_score = TRACK_TYPE_SCORES.get(str(target_track_type).strip(), 0)
+        race_tt_score = TRACK_TYPE_SCORE_TABLE[np.maximum(history['condition'], 0)]
+        similarity_bonus += np.where(history['condition'] != MISSING,
+                                     (1 - np.abs(race_tt_score - target_tt_score) / 10) * MAX_SIMILARITY_BONUS_PER_FACTOR * TRACK_TYPE_SIMILARITY_WEIGHT, 0)
+    if not pd.isna(target_weather):
+        target_w_score = WEATHER_SCORES.get(str(target_weather).strip(), 0)
+        race_w_score = WEATHER_SCORE_TABLE[np.maximum(history['weather'], 0)]
+        similarity_bonus += np.where(history['weather'] != MISSING,
+                                     (1 - np.abs(race_w_score - target_w_score) / 10) * MAX_SIMILARITY_BONUS_PER_FACTOR * WEATHER_SIMILARITY_WEIGHT, 0)
+
+    final_race_score = race_score_with_recency + similarity_bonus
+
+    six_months_ago = (pd.Timestamp(current_race_date) - pd.DateOffset(months=6)).to_datetime64()
+    is_recent = history['date'].astype('datetime64[ns]') >= six_months_ago
+
+    total_score = float(final_race_score.sum())
+    total_score_recent_6_months = float(final_race_score[is_recent].sum())
+    total_agari_3f_score = float((agari_score * recency_factor).sum()) # Keep track of the 3f score part
+    return total_score, len(history), total_score_recent_6_months, total_agari_3f_score
 
 def calculate_popularity_score(popularity_rank):
     """Calculates a score based on the horse's popularity rank."""
@@ -292,6 +239,29 @@ def calculate_odds_score(odds):
     except ValueError:
         return 0
 
+def calculate_weight_change_score(weight_sa):
+    """Calculates a score based on the change in horse weight from the last race."""
+    if pd.isna(weight_sa):
+        return 0
+    weight_sa_str = str(weight_sa) # Convert to string to safely use 'in' operator
+    if '増' in weight_sa_str and len(weight_sa_str) > 1: # 大幅増
+        return WEIGHT_CHANGE_SCORE_MAP['大幅増']
+    elif '増' in weight_sa_str:
+        return WEIGHT_CHANGE_SCORE_MAP['増']
+    elif '減' in weight_sa_str and len(weight_sa_str) > 1: # 大幅減
+        return WEIGHT_CHANGE_SCORE_MAP['大幅減']
+    elif '減' in weight_sa_str:
+        return WEIGHT_CHANGE_SCORE_MAP['減']
+    else: # 維持
+        return WEIGHT_CHANGE_SCORE_MAP['維持']
+
+def calculate_race_day_score(weight_sa, odds):
+    """Score components driven by shutuba fields that change on race day (weight change, odds).
+    Everything else in get_horse_total_score stays fixed once the field is set, so watch mode
+    only recomputes this part when odds or weights are updated.
+    """
+    return calculate_weight_change_score(weight_sa) + calculate_odds_score(odds)
+
 def calculate_corner_score(corner_str):
     """Calculates a score based on the horse's position at corners."""
     if pd.isna(corner_str):
@@ -307,182 +277,6 @@ def calculate_corner_score(corner_str):
     except ValueError:
         return 0
 
-def get_horse_total_score(horse_id, target_distance, target_track_type, target_weather, 
-                          current_popularity_rank, current_race_date, 
-                          jockey_name, jockey_id, sire_id, bms_id, 
-                          futan, weight, weight_sa, wakuban, odds, corner, 
-                          kyaku, time_str, pace,
-                          is_parent=False):
-    """
-    Calculates the total score for a horse, including its own performance, parent's performance, and jockey's skill.
-    """
-    total_score = 0
-    
-    # Fetch horse data
-    race_results_df, parent_ids = get_horse_data(horse_id)
-    
-    # Calculate past performance score
-    past_performance_score, num_races, total_score_recent, _ = calculate_past_performance_score(
-        race_results_df, target_distance, target_track_type, target_weather, current_race_date
-    )
-    total_score += past_performance_score
-
-    # --- NEW: Add scores for additional factors ---
-    if not is_parent:
-        # Wakuban (Gate number) score
-        total_score += WAKUBAN_SCORES.get(wakuban, 0)
-
-        # Futan (Jockey weight) score
-        try:
-            futan_kg = float(futan)
-            total_score += (FUTAN_KG_BASE - futan_kg) * FUTAN_SCORE_MULTIPLIER
-        except (ValueError, TypeError):
-            pass # Ignore if futan is not a valid number
-
-        # Weight change score
-        if not pd.isna(weight_sa):
-            weight_sa_str = str(weight_sa) # Convert to string to safely use 'in' operator
-            if '増' in weight_sa_str and len(weight_sa_str) > 1: # 大幅増
-                total_score += WEIGHT_CHANGE_SCORE_MAP['大幅増']
-            elif '増' in weight_sa_str:
-                total_score += WEIGHT_CHANGE_SCORE_MAP['増']
-            elif '減' in weight_sa_str and len(weight_sa_str) > 1: # 大幅減
-                total_score += WEIGHT_CHANGE_SCORE_MAP['大幅減']
-            elif '減' in weight_sa_str:
-                total_score += WEIGHT_CHANGE_SCORE_MAP['減']
-            else: # 維持
-                total_score += WEIGHT_CHANGE_SCORE_MAP['維持']
-
-        # Odds score
-        total_score += calculate_odds_score(odds)
-
-        # Corner position score
-        total_score += calculate_corner_score(corner)
-
-        # Kyaku (Running style) score
-        total_score += calculate_kyaku_score(kyaku, target_distance)
-
-        # Time score
-        total_score += calculate_time_score(time_str, target_distance)
-
-        # Pace score
-        total_score += calculate_pace_score(pace, kyaku, target_distance)
-
-    # Fairness (忖度) Logic
-    if not is_parent and num_races > 0 and num_races < MIN_RACES_FOR_FAIRNESS:
-        avg_score_recent = total_score_recent / (num_races if num_races > 0 else 1)
-        if avg_score_recent > MIN_AVG_SCORE_FOR_FAIRNESS:
-            potential_score_increase = (MIN_RACES_FOR_FAIRNESS - num_races) * avg_score_recent * FAIRNESS_ADJUSTMENT_FACTOR
-            total_score += potential_score_increase
-
-    # Calculate popularity score
-    if not is_parent:
-        popularity_score = calculate_popularity_score(current_popularity_rank)
-        total_score += popularity_score
-
-    # Add jockey score
-    if not is_parent and jockey_name:
-        jockey_df = get_jockey_leading_data(current_race_date.year)
-        if not jockey_df.empty:
-            jockey_stats = jockey_df[jockey_df['騎手'] == jockey_name]
-            if not jockey_stats.empty:
-                win_rate = jockey_stats.iloc[0]['win_rate']
-                rentai_rate = jockey_stats.iloc[0]['rentai_rate']
-                jockey_score = (win_rate * 1000) + (rentai_rate * 200) # Increased win rate weighting
-                total_score += jockey_score
-
-    # Add horse course aptitude score
-    if not is_parent:
-        horse_aptitude_df = get_horse_course_aptitude(horse_id)
-        if not horse_aptitude_df.empty:
-            # Filter for relevant course conditions
-            # Assuming 'コース' column contains combined info like '東京 芝 1600m'
-            # And '勝率' and '連対率' are available
-            course_aptitude_score = 0
-            for index, row in horse_aptitude_df.iterrows():
-                course_info = row.get('コース', '')
-                win_rate = pd.to_numeric(row.get('勝率', 0), errors='coerce')
-                rentai_rate = pd.to_numeric(row.get('連対率', 0), errors='coerce')
-
-                # Check for matching distance and track type
-                if str(target_distance) in course_info and target_track_type in course_info:
-                    course_aptitude_score += (win_rate * 150) + (rentai_rate * 25) # Increased win rate weighting
-            total_score += course_aptitude_score
-
-    # Add jockey course aptitude score
-    if not is_parent and jockey_id:
-        jockey_aptitude_df = get_jockey_course_aptitude(jockey_id)
-        if not jockey_aptitude_df.empty:
-            jockey_course_aptitude_score = 0
-            for index, row in jockey_aptitude_df.iterrows():
-                course_info = row.get('コース', '')
-                win_rate = pd.to_numeric(row.get('勝率', 0), errors='coerce')
-                rentai_rate = pd.to_numeric(row.get('連対率', 0), errors='coerce')
-
-                if str(target_distance) in course_info and target_track_type in course_info:
-                    jockey_course_aptitude_score += (win_rate * 150) + (rentai_rate * 25) # Increased win rate weighting
-            total_score += jockey_course_aptitude_score
-
-    # Add parent horse scores
-    if not is_parent and parent_ids:
-        if parent_ids['sire']:
-            sire_score = get_horse_total_score(
-                parent_ids['sire'], target_distance, target_track_type, target_weather, 
-                None, current_race_date, None, None, None, None, 
-                None, None, None, None, None, None, None, None, None,
-                is_parent=True
-            )
-            total_score += sire_score * PARENT_SCORE_MULTIPLIER
-            time.sleep(0.5)
-
-        if parent_ids['mare']:
-            mare_score = get_horse_total_score(
-                parent_ids['mare'], target_distance, target_track_type, target_weather, 
-                None, current_race_date, None, None, None, None, 
-                None, None, None, None, None, None, None, None, None,
-                is_parent=True
-            )
-            total_score += mare_score * PARENT_SCORE_MULTIPLIER
-            time.sleep(0.5)
-
-    # Add sire course aptitude score
-    if not is_parent and sire_id:
-        sire_aptitude_df = get_sire_course_aptitude(sire_id)
-        if not sire_aptitude_df.empty:
-            sire_course_aptitude_score = 0
-            for index, row in sire_aptitude_df.iterrows():
-                course_info = row.get('コース', '')
-                win_rate = pd.to_numeric(row.get('勝率', 0), errors='coerce')
-                rentai_rate = pd.to_numeric(row.get('連対率', 0), errors='coerce')
-
-                if str(target_distance) in course_info and target_track_type in course_info:
-                    sire_course_aptitude_score += (win_rate * 75) + (rentai_rate * 12.5) # Increased win rate weighting
-            total_score += sire_course_aptitude_score
-
-    # Add bms course aptitude score
-    if not is_parent and bms_id:
-        bms_aptitude_df = get_bms_course_aptitude(bms_id)
-        if not bms_aptitude_df.empty:
-            bms_course_aptitude_score = 0
-            for index, row in bms_aptitude_df.iterrows():
-                course_info = row.get('コース', '')
-                win_rate = pd.to_numeric(row.get('勝率', 0), errors='coerce')
-                rentai_rate = pd.to_numeric(row.get('連対率', 0), errors='coerce')
-
-                if str(target_distance) in course_info and target_track_type in course_info:
-                    sire_course_aptitude_score += (win_rate * 175) + (rentai_rate * 37.5) # Further increased win rate weighting
-            total_score += bms_course_aptitude_score
-
-    # Trainer affiliation score
-    if not is_parent and not pd.isna(trainer_syozoku):
-        total_score += TRAINER_SYOZOKU_SCORES.get(trainer_syozoku, 0)
-
-    # Owner code bonus
-    if not is_parent and not pd.isna(owner_cd) and str(owner_cd) in OWNER_CD_BONUS_MAP:
-        total_score += OWNER_CD_BONUS_MAP[str(owner_cd)]
-
-    return total_score
-
 # --- New Scoring Constants for Kyaku, Time, Pace ---
 KYAKU_SCORE_MAP = {
     "逃げ": {"芝1200": 30, "芝1600": 20, "芝2000": 10, "ダ1200": 25, "ダ1800": 15}, # Example values
@@ -490,7 +284,12 @@ KYAKU_SCORE_MAP = {
     "差し": {"芝1200": 10, "芝1600": 20, "芝2000": 30, "ダ1200": 15, "ダ1800": 20},
     "追込": {"芝1200": 5, "芝1600": 10, "芝2000": 25, "ダ1200": 10, "ダ1800": 15},
 }
-TIME_SCORE_MULTIPLIER = 50 # Multiplier for time-based score (lower time is better)
+# Time index: seconds per 1000m faster than the course par time (course_index.py)
+TIME_INDEX_MULTIPLIER = 20 # Points per second per 1000m
+TIME_INDEX_RECENT_RACES = 5 # Latest past races with a par time that are averaged
+# Pace: a past race's first 3F this much faster (H) or slower (S) than the course par
+PACE_MARGIN_SECONDS = 0.5
+PACE_RECENT_RACES = 5 # Latest past races with a known pace that are averaged
 PACE_SCORE_MAP = {
     "S": {"逃げ": 40, "先行": 20, "差し": -20, "追込": -40}, # Slow pace favors front runners (more distinct)
     "M": {"逃げ": 20, "先行": 40, "差し": 20, "追込": 0}, # Middle pace is balanced (more distinct)
@@ -517,167 +316,171 @@ def calculate_kyaku_score(kyaku, target_distance):
         return KYAKU_SCORE_MAP[kyaku].get(distance_category, 0)
     return 0
 
-def calculate_time_score(time_str, target_distance):
-    """Calculates a score based on the horse's past race time."""
-    if pd.isna(time_str) or pd.isna(target_distance):
-        return 0
-    try:
-        # Convert time string (e.g., "1:33.4") to seconds
-        minutes, seconds = map(float, time_str.split(':'))
-        total_seconds = minutes * 60 + seconds
-
-        # This is a very simplified approach. Ideally, you'd compare to average times for the distance.
-        # For now, assume faster times are better and give a bonus.
-        # Example: 1:30.0 (90s) vs 1:35.0 (95s). Faster time gets more points.
-        # A simple inverse relationship for now.
-        if total_seconds > 0:
-            return TIME_SCORE_MULTIPLIER / total_seconds * 100 # Scale to make it meaningful
-        return 0
-    except (ValueError, AttributeError):
+def time_indices(history, as_of=None):
+    """
+    Time index of every past race of a history, in one vectorised par lookup:
+    seconds per 1000m faster than the course par time (NaN without a time or a par).
+    Pars are taken over the races before as_of (the scored race's date).
+    """
+    pars = course_index.history_pars(history, as_of)['par_time']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (pars - history['time']) / history['distance'] * 1000
+
+def calculate_time_score(history, as_of=None):
+    """Calculates a score from the horse's recent times relative to the par times of their courses."""
+    indices = time_indices(history, as_of)
+    recent = indices[np.isfinite(indices)][-TIME_INDEX_RECENT_RACES:]
+    if len(recent) == 0:
         return 0
+    return float(recent.mean()) * TIME_INDEX_MULTIPLIER
 
 def calculate_pace_score(pace, kyaku, target_distance):
-    """Calculates a score based on race pace and horse's running style."""
-    if pd.isna(kyaku) or pd.isna(target_distance) or pd.isna(pace):
+    """Calculates a score based on race pace ('S', 'M', 'H' or None) and horse's running style."""
+    if pace is None or pd.isna(kyaku) or pd.isna(target_distance):
         return 0
     
     if pace in PACE_SCORE_MAP and kyaku in PACE_SCORE_MAP[pace]:
         return PACE_SCORE_MAP[pace][kyaku]
     return 0
 
-def determine_race_pace(lap_times, target_distance):
-    """Determines the overall pace of the race (S: Slow, M: Medium, H: High) based on lap times.
-    This is a simplified heuristic and may need refinement.
+def pace_indices(history, as_of=None):
+    """
+    Pace of every past race of a history, in one vectorised par lookup: seconds by which the
+    race's first 3F (ペース) was faster than the course par (positive = faster, NaN without a par).
     """
-    if not lap_times or len(lap_times) < 2:
-        return None # Cannot determine pace without enough lap times
-
-    # Calculate average lap time
-    avg_lap_time = sum(lap_times) / len(lap_times)
-
-    # Heuristic for pace determination (these thresholds are examples and need tuning)
-    # Adjust thresholds based on distance and track type for better accuracy
-    if "1200" in target_distance:
-        if avg_lap_time < 11.5: # Very fast for 1200m
-            return 'H'
-        elif avg_lap_time < 12.0:
-            return 'M'
-        else:
-            return 'S'
-    elif "1600" in target_distance:
-        if avg_lap_time < 12.0:
-            return 'H'
-        elif avg_lap_time < 12.5:
-            return 'M'
-        else:
-            return 'S'
-    elif "1800" in target_distance:
-        if avg_lap_time < 12.5:
-            return 'H'
-        elif avg_lap_time < 13.0:
-            return 'M'
-        else:
-            return 'S'
-    elif "2000" in target_distance:
-        if avg_lap_time < 13.0:
-            return 'H'
-        elif avg_lap_time < 13.5:
-            return 'M'
-        else:
-            return 'S'
-    # Add more distance categories as needed
-    return 'M' # Default to Medium if distance not covered
+    pars = course_index.history_pars(history, as_of)['par_first_3f']
+    return pars - history['first_3f']
+
+def race_paces(history, as_of=None):
+    """'H', 'M' or 'S' for each past race of a history ('' where the pace is unknown)."""
+    indices = pace_indices(history, as_of)
+    return np.where(indices > PACE_MARGIN_SECONDS, 'H',
+                    np.where(indices < -PACE_MARGIN_SECONDS, 'S', np.where(np.isnan(indices), '', 'M')))
+
+def calculate_history_pace_score(history, kyaku, target_distance, as_of=None):
+    """
+    How well the paces of the horse's recent races, judged against their course pars, suited its
+    running style: PACE_SCORE_MAP averaged over the latest PACE_RECENT_RACES races with a known pace.
+    """
+    if pd.isna(kyaku) or pd.isna(target_distance) or kyaku not in PACE_SCORE_MAP['M']:
+        return 0
+    paces = race_paces(history, as_of)
+    recent = paces[paces != ''][-PACE_RECENT_RACES:]
+    if len(recent) == 0:
+        return 0
+    return float(np.mean([PACE_SCORE_MAP[pace][kyaku] for pace in recent]))
 
 # --- Main Scoring Functions ---
 
-def get_horse_total_score(horse_id, target_distance, target_track_type, target_weather, 
-                          current_popularity_rank, current_race_date, 
-                          jockey_name, jockey_id, sire_id, bms_id, 
-                          futan, weight, weight_sa, wakuban, odds, corner, 
-                          kyaku, time_str, pace,
-                          harontimel3, chakusa, sex, age, blinker, norikawari, trainer_syozoku, owner_cd, lap_times, is_parent=False):
+# Score components of get_horse_total_score, in the order they are added up.
+# features.py stores them per runner; get_horse_total_score is their sum.
+SCORE_COMPONENTS = (
+    'past_performance', 'wakuban', 'futan', 'race_day', 'corner', 'kyaku', 'time', 'pace',
+    'sex_age', 'blinker', 'norikawari', 'trainer', 'owner', 'fairness',
+)
+
+def get_horse_score_components(horse_id, target_distance, target_track_type, target_weather,
+                               current_popularity_rank, current_race_date,
+                               jockey_name, jockey_id, sire_id, bms_id,
+                               futan, weight, weight_sa, wakuban, odds, corner,
+                               kyaku, time_str, pace,
+                               harontimel3, chakusa, sex, age, blinker, norikawari, trainer_syozoku, owner_cd, lap_times, is_parent=False,
+                               history=None):
     """
-    Calculates the total score for a horse, including its own performance, parent's performance, and jockey's skill.
+    The parts of a horse's total score as {component: points}, keys in SCORE_COMPONENTS order.
+    Components that do not apply (everything but past performance for a parent) are 0.
+    A history array passed in is used instead of fetching the horse page (e.g. EMPTY_HISTORY when it is unavailable).
+    lap_times is not used: a race's own laps are only known once it has been run.
     """
-    total_score = 0
-    
-    # Fetch horse data
-    race_results_df, parent_ids = get_horse_data(horse_id)
-    
+    components = dict.fromkeys(SCORE_COMPONENTS, 0)
+
+    # Fetch horse data (only races before current_race_date, so backtests do not see later results)
+    if history is None:
+        history, parent_ids = get_horse_history_as_of(horse_id, current_race_date)
+    else:
+        history = as_of(history, current_race_date)
+
     # Calculate past performance score
     past_performance_score, num_races, total_score_recent, _ = calculate_past_performance_score(
-        race_results_df, target_distance, target_track_type, target_weather, current_race_date
+        history, target_distance, target_track_type, target_weather, current_race_date
     )
-    total_score += past_performance_score
+    components['past_performance'] = past_performance_score
 
     # --- NEW: Add scores for additional factors ---
     if not is_parent:
         # Wakuban (Gate number) score
-        total_score += WAKUBAN_SCORES.get(wakuban, 0)
+        components['wakuban'] = WAKUBAN_SCORES.get(wakuban, 0)
 
         # Futan (Jockey weight) score
         try:
             futan_kg = float(futan)
-            total_score += (FUTAN_KG_BASE - futan_kg) * FUTAN_SCORE_MULTIPLIER
+            components['futan'] = (FUTAN_KG_BASE - futan_kg) * FUTAN_SCORE_MULTIPLIER
         except (ValueError, TypeError):
             pass # Ignore if futan is not a valid number
 
-        # Weight change score
-        if not pd.isna(weight_sa):
-            weight_sa_str = str(weight_sa) # Convert to string to safely use 'in' operator
-            if '増' in weight_sa_str and len(weight_sa_str) > 1: # 大幅増
-                total_score += WEIGHT_CHANGE_SCORE_MAP['大幅増']
-            elif '増' in weight_sa_str:
-                total_score += WEIGHT_CHANGE_SCORE_MAP['増']
-            elif '減' in weight_sa_str and len(weight_sa_str) > 1: # 大幅減
-                total_score += WEIGHT_CHANGE_SCORE_MAP['大幅減']
-            elif '減' in weight_sa_str:
-                total_score += WEIGHT_CHANGE_SCORE_MAP['減']
-            else: # 維持
-                total_score += WEIGHT_CHANGE_SCORE_MAP['維持']
-
-        # Odds score
-        total_score += calculate_odds_score(odds)
+        # Weight change and odds score (the parts that move on race day)
+        components['race_day'] = calculate_race_day_score(weight_sa, odds)
 
         # Corner position score
-        total_score += calculate_corner_score(corner)
+        components['corner'] = calculate_corner_score(corner)
 
         # Kyaku (Running style) score
-        total_score += calculate_kyaku_score(kyaku, target_distance)
+        components['kyaku'] = calculate_kyaku_score(kyaku, target_distance)
 
-        # Time score
-        total_score += calculate_time_score(time_str, target_distance)
+        # Time score (past times against their course par times)
+        components['time'] = calculate_time_score(history, current_race_date)
 
-        # Pace score
-        total_score += calculate_pace_score(lap_times, kyaku, target_distance)
+        # Pace score (paces of past races against their course pars)
+        components['pace'] = calculate_history_pace_score(history, kyaku, target_distance, current_race_date)
 
         # Sex and Age score
-        total_score += calculate_sex_age_score(sex, age)
+        components['sex_age'] = calculate_sex_age_score(sex, age)
 
         # Blinker score
         if not pd.isna(blinker) and blinker == 1:
-            total_score += 10 # Small bonus for blinker
+            components['blinker'] = 10 # Small bonus for blinker
 
         # Norikawari (Jockey change) score
         if not pd.isna(norikawari) and norikawari == 1:
-            total_score -= 5 # Small penalty for jockey change
+            components['norikawari'] = -5 # Small penalty for jockey change
 
         # Trainer affiliation score
         if not pd.isna(trainer_syozoku):
-            total_score += TRAINER_SYOZOKU_SCORES.get(trainer_syozoku, 0)
+            components['trainer'] = TRAINER_SYOZOKU_SCORES.get(trainer_syozoku, 0)
 
         # Owner code bonus
         if not pd.isna(owner_cd) and str(owner_cd) in OWNER_CD_BONUS_MAP:
-            total_score += OWNER_CD_BONUS_MAP[str(owner_cd)]
+            components['owner'] = OWNER_CD_BONUS_MAP[str(owner_cd)]
 
     # Fairness (忖度) Logic
     if not is_parent and num_races > 0 and num_races < MIN_RACES_FOR_FAIRNESS:
         avg_score_recent = total_score_recent / (num_races if num_races > 0 else 1)
         if avg_score_recent > MIN_AVG_SCORE_FOR_FAIRNESS:
             potential_score_increase = (MIN_RACES_FOR_FAIRNESS - num_races) * avg_score_recent * FAIRNESS_ADJUSTMENT_FACTOR
-            total_score += potential_score_increase
+            components['fairness'] = potential_score_increase
+
+    return components
 
-    return total_score
+def get_horse_total_score(horse_id, target_distance, target_track_type, target_weather, 
+                          current_popularity_rank, current_race_date, 
+                          jockey_name, jockey_id, sire_id, bms_id, 
+                          futan, weight, weight_sa, wakuban, odds, corner, 
+                          kyaku, time_str, pace,
+                          harontimel3, chakusa, sex, age, blinker, norikawari, trainer_syozoku, owner_cd, lap_times, is_parent=False,
+                          history=None):
+    """
+    Calculates the total score for a horse, including its own performance, parent's performance, and jockey's skill.
+    The sum of get_horse_score_components.
+    """
+    return sum(get_horse_score_components(
+        horse_id, target_distance, target_track_type, target_weather,
+        current_popularity_rank, current_race_date,
+        jockey_name, jockey_id, sire_id, bms_id,
+        futan, weight, weight_sa, wakuban, odds, corner,
+        kyaku, time_str, pace,
+        harontimel3, chakusa, sex, age, blinker, norikawari, trainer_syozoku, owner_cd, lap_times, is_parent=is_parent,
+        history=history
+    ).values())
 
 if __name__ == '__main__':
     # Example Usage (using data from your shutuba_202510020411.csv)
@@ -5,36 +5,30 @@ from bs4 import BeautifulSoup
 import re
 import time
 import os
+from io import StringIO
 
-def fetch_and_save_shutuba_data(race_id, retries=3, delay=5):
+from data_fetcher import SESSION
+import odds_history
+
+SHUTUBA_CSV_FORMAT = "/Users/akahoshihiroki/Documents/pytests/keiba_yosou/shutuba_{race_id}.csv"
+
+def fetch_shutuba_horse_data(race_id, retries=3, delay=5, timeout=None):
     """
-    Fetches shutuba data from netkeiba.com race page and saves it to a CSV file.
-    It extracts data directly from the HTML, looking for a specific script tag.
-    Prioritizes loading from a local CSV if it already exists.
+    Fetches the HorseData list embedded in the netkeiba shutuba page, bypassing the local CSV.
 
     Args:
         race_id (str): The ID of the race.
         retries (int): Number of retries for fetching data.
         delay (int): Delay in seconds between retries.
+        timeout (float): Seconds to wait for each attempt (None: no limit).
 
     Returns:
-        str: The path to the saved CSV file, or None if an error occurred.
+        list: One dict per runner, or None if an error occurred or the data was empty.
     """
-    csv_path = f"/Users/akahoshihiroki/Documents/pytests/keiba_yosou/shutuba_{race_id}.csv"
-
-    # Check if CSV already exists locally
-    if os.path.exists(csv_path):
-        print(f"出馬表データを {csv_path} から読み込みました (既存ファイル)。")
-        return csv_path
-
-    # If not, try to fetch from netkeiba.com
     for i in range(retries):
         try:
             url = f"https://race.netkeiba.com/race/shutuba.html?race_id={race_id}"
-            response = requests.get(url, headers={
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/100.0.4896.127 Safari/537.36",
-                "Referer": "https://race.netkeiba.com/"
-            })
+            response = SESSION.get(url, headers={"Referer": "https://race.netkeiba.com/"}, timeout=timeout)
             response.raise_for_status()
             soup = BeautifulSoup(response.content, "lxml")
 
@@ -53,10 +47,8 @@ def fetch_and_save_shutuba_data(race_id, retries=3, delay=5):
             horse_list = json.loads(horse_data_json)
 
             if horse_list:
-                df = pd.DataFrame(horse_list)
-                df.to_csv(csv_path, index=False, encoding='utf-8-sig')
-                print(f"出馬表データを {csv_path} に保存しました。")
-                return csv_path
+                odds_history.record_snapshot(race_id, horse_list) # Keeps every polled odds value
+                return horse_list
             else:
                 print(f"出馬表データが空でした for race_id {race_id}。")
                 return None
@@ -76,6 +68,112 @@ def fetch_and_save_shutuba_data(race_id, retries=3, delay=5):
             return None
     return None
 
+def save_shutuba_data(race_id, horse_list):
+    """Writes a HorseData list to shutuba_{race_id}.csv and returns the path."""
+    csv_path = SHUTUBA_CSV_FORMAT.format(race_id=race_id)
+    df = pd.DataFrame(horse_list)
+    df.to_csv(csv_path, index=False, encoding='utf-8-sig')
+    return csv_path
+
+def _as_csv_strings(df):
+    """DataFrame with every cell as the text to_csv would write, so stored and fetched rows compare exactly."""
+    return pd.read_csv(StringIO(df.to_csv(index=False)), dtype=str, keep_default_na=False)
+
+def _umaban(value):
+    return int(value) if str(value).isdigit() else value # Empty before the draw
+
+def refresh_shutuba_data(race_id, retries=3, delay=5, timeout=None):
+    """
+    Re-pulls HorseData and updates the local CSV row by row, keyed by horse_id.
+
+    Only runners whose update_datetime differs from the stored row are rewritten; new runners
+    are added and runners no longer listed are dropped. Without a local CSV everything is saved.
+
+    Returns:
+        tuple: (csv_path, {'changed': {horse_id: umaban}, 'added': {horse_id: umaban},
+        'removed': {horse_id: umaban}}), or (None, None) if the fetch failed. The umaban is
+        empty for every runner before the draw, so the change sets are keyed by horse_id.
+    """
+    horse_list = fetch_shutuba_horse_data(race_id, retries, delay, timeout)
+    if not horse_list:
+        return None, None
+    csv_path = SHUTUBA_CSV_FORMAT.format(race_id=race_id)
+    new_rows = _as_csv_strings(pd.DataFrame(horse_list)).set_index('horse_id', drop=False)
+    if not os.path.exists(csv_path):
+        save_shutuba_data(race_id, horse_list)
+        return csv_path, {'changed': {}, 'added': dict(zip(new_rows.index, map(_umaban, new_rows['umaban']))), 'removed': {}}
+
+    old_rows = pd.read_csv(csv_path, dtype=str, keep_default_na=False).set_index('horse_id', drop=False)
+    old_rows = old_rows.reindex(columns=new_rows.columns, fill_value='')
+    changes = {'changed': {}, 'added': {}, 'removed': {}}
+    merged = []
+    for horse_id, new_row in new_rows.iterrows():
+        if horse_id not in old_rows.index:
+            changes['added'][horse_id] = _umaban(new_row['umaban'])
+            merged.append(new_row)
+        elif old_rows.loc[horse_id, 'update_datetime'] != new_row['update_datetime']:
+            changes['changed'][horse_id] = _umaban(new_row['umaban'])
+            merged.append(new_row)
+        else:
+            merged.append(old_rows.loc[horse_id])
+    changes['removed'] = {horse_id: _umaban(row['umaban']) for horse_id, row in old_rows.iterrows() if horse_id not in new_rows.index}
+
+    if any(changes.values()):
+        pd.DataFrame(merged).to_csv(csv_path, index=False, encoding='utf-8-sig')
+    return csv_path, changes
+
+def print_shutuba_changes(race_id, changes):
+    if not any(changes.values()):
+        print(f"出馬表 {race_id}: 更新なし")
+        return
+    umaban = {kind: list(runners.values()) for kind, runners in changes.items()}
+    print(f"出馬表 {race_id}: 更新 {umaban['changed']}, 追加 {umaban['added']}, 除外 {umaban['removed']} (馬番)")
+
+def fetch_and_save_shutuba_data(race_id, retries=3, delay=5, refresh=False, timeout=None):
+    """
+    Fetches shutuba data from netkeiba.com race page and saves it to a CSV file.
+    It extracts data directly from the HTML, looking for a specific script tag.
+    Prioritizes loading from a local CSV if it already exists.
+
+    Args:
+        race_id (str): The ID of the race.
+        retries (int): Number of retries for fetching data.
+        delay (int): Delay in seconds between retries.
+        refresh (bool): Update an existing CSV with the rows that changed (see refresh_shutuba_data).
+        timeout (float): Seconds to wait for each attempt (None: no limit).
+
+    Returns:
+        str: The path to the saved CSV file, or None if an error occurred.
+    """
+    csv_path = SHUTUBA_CSV_FORMAT.format(race_id=race_id)
+
+    if refresh:
+        refreshed_path, changes = refresh_shutuba_data(race_id, retries, delay, timeout)
+        if changes is not None:
+            print_shutuba_changes(race_id, changes)
+            return refreshed_path
+        if not os.path.exists(csv_path):
+            return None
+        print(f"出馬表の更新に失敗しました。{csv_path} をそのまま使用します。")
+        return csv_path
+
+    # Check if CSV already exists locally
+    if os.path.exists(csv_path):
+        print(f"出馬表データを {csv_path} から読み込みました (既存ファイル)。")
+        return csv_path
+
+    # If not, try to fetch from netkeiba.com
+    horse_list = fetch_shutuba_horse_data(race_id, retries, delay, timeout)
+    if not horse_list:
+        return None
+    try:
+        csv_path = save_shutuba_data(race_id, horse_list) # The fetch may have moved the stores (stub_server)
+    except Exception as e:
+        print(f"予期せぬエラーが発生しました for race_id {race_id}: {e}")
+        return None
+    print(f"出馬表データを {csv_path} に保存しました。")
+    return csv_path
+
 if __name__ == '__main__':
     # Example usage for testing
     test_race_id = "202410030211" # Example race ID (北九州記念)
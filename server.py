@@ -0,0 +1,151 @@
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import main as predictor
+import course_index
+import data_fetcher
+import prefetch
+from scraping import print_shutuba_changes, refresh_shutuba_data
+
+# Long-running prediction server. The scorer module, the horse page caches in data_fetcher,
+# the course par index the scorer reads, the race info cache in main and the HTTP connection
+# pool all stay warm between requests, so repeated queries for a race_id on race day are fast.
+#
+#   python server.py [port]            -> http://127.0.0.1:<port>/predict?race_id=...
+#   python server.py --unix <path>     -> same endpoints over a Unix socket
+#
+# Endpoints:
+#   GET /predict?race_id=<id>[&refresh=1]   scores and recommended tansho/fukusho/wide bets
+#                                           (a prediction older than PREDICTION_TTL_SECONDS, or any with
+#                                           refresh=1, re-pulls the shutuba; rescored only if rows changed)
+#   GET /health                             cache sizes
+#   GET /prefetch?date=<YYYYMMDD>[&venue=<name>] or ?race_id=<id>,<id>...
+#                                           warms the caches for upcoming races in the background
+#   GET /prefetch/status                    prefetch progress and per-race cache coverage
+
+DEFAULT_PORT = 8765
+SHUTUBA_URL_FORMAT = "https://race.netkeiba.com/race/shutuba.html?race_id={race_id}"
+
+# Predictions are served from memory for PREDICTION_TTL_SECONDS. Odds move all race day and feed
+# the win-probability / EV bets, so an older prediction re-pulls the shutuba before it is served.
+PREDICTION_TTL_SECONDS = 60
+_prediction_cache = {} # race_id -> (prediction, time.monotonic() when computed or confirmed current)
+# Scoring shares caches and is rate limited by netkeiba anyway, so it is serialised.
+_prediction_lock = threading.Lock()
+
+def predict_race(race_id, refresh=False):
+    """Returns the JSON-ready prediction for race_id. A cached prediction younger than
+    PREDICTION_TTL_SECONDS is returned as is; otherwise (and always with refresh=True) the shutuba
+    CSV is updated first and the race is rescored only if a runner's row changed."""
+    with _prediction_lock:
+        cached = _prediction_cache.get(race_id)
+        if cached is not None and not refresh and time.monotonic() - cached[1] < PREDICTION_TTL_SECONDS:
+            return cached[0]
+        _, changes = refresh_shutuba_data(race_id)
+        if changes is not None:
+            print_shutuba_changes(race_id, changes)
+            if not any(changes.values()) and cached is not None:
+                _prediction_cache[race_id] = (cached[0], time.monotonic())
+                return cached[0]
+        sorted_horses, recommended_bets = predictor.main(SHUTUBA_URL_FORMAT.format(race_id=race_id))
+        if not sorted_horses or not recommended_bets:
+            return None
+        prediction = predictor.prediction_to_dict(race_id, sorted_horses, recommended_bets)
+        _prediction_cache[race_id] = (prediction, time.monotonic())
+        return prediction
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        params = parse_qs(parsed.query)
+        if parsed.path == '/health':
+            self._send_json(200, {
+                'status': 'ok',
+                'cached_predictions': len(_prediction_cache),
+                'cached_horses': len(data_fetcher._horse_data_cache),
+                'cached_jockey_tables': len(data_fetcher._jockey_leading_cache),
+            })
+        elif parsed.path == '/prefetch':
+            if 'date' in params:
+                race_ids = prefetch.resolve_race_ids([params['date'][0]] + params.get('venue', []))
+            else:
+                race_ids = [r for r in params.get('race_id', [''])[0].split(',') if r.isdigit()]
+            if not race_ids:
+                self._send_json(400, {'error': 'date or race_id is required'})
+                return
+            if prefetch.start_background_prefetch(race_ids, lock=_prediction_lock) is None:
+                self._send_json(409, {'error': 'a prefetch is already running', **prefetch.get_status()})
+                return
+            self._send_json(202, {'status': 'started', 'race_ids': race_ids})
+        elif parsed.path == '/prefetch/status':
+            self._send_json(200, prefetch.get_status())
+        elif parsed.path == '/predict':
+            race_id = params.get('race_id', [''])[0]
+            if not race_id.isdigit():
+                self._send_json(400, {'error': 'race_id is required'})
+                return
+            start = time.perf_counter()
+            try:
+                prediction = predict_race(race_id, refresh=params.get('refresh', ['0'])[0] == '1')
+            except Exception as e:
+                self._send_json(500, {'error': str(e)})
+                return
+            if prediction is None:
+                self._send_json(502, {'error': f'prediction failed for race_id {race_id}'})
+                return
+            self._send_json(200, dict(prediction, elapsed_seconds=time.perf_counter() - start))
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket peers have no (host, port) address.
+        return self.client_address[0] if self.client_address else 'unix'
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+class ThreadingLocalHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def warm_up():
+    """Loads the course par index (course_index.py) the time and pace scores read before the first request arrives."""
+    course_index.get_index()
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--unix':
+        socket_path = sys.argv[2]
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, PredictionRequestHandler)
+        address = socket_path
+    else:
+        port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
+        server = ThreadingLocalHTTPServer(('127.0.0.1', port), PredictionRequestHandler)
+        address = f"http://127.0.0.1:{port}"
+
+    warm_up()
+    print(f"予測サーバーを起動しました: {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("予測サーバーを停止します。")
+    finally:
+        server.server_close()
@@ -0,0 +1,346 @@
+import importlib
+import json
+import math
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+# Local stand-in for netkeiba, for load and latency testing without hitting the real site.
+# Serves recorded pages (shutuba, race, result, horse, jockey, sire, BMS, jockey leading, race
+# list) at the same URL shapes, with configurable latency, error rate and 429 throttling.
+# data_fetcher.SESSION is pointed at it with NETKEIBA_BASE_URL (or data_fetcher.set_base_url);
+# a request for https://db.netkeiba.com/horse/2019104968 then arrives here as
+# GET /db.netkeiba.com/horse/2019104968.
+#
+#   python stub_server.py --record <race_id> [<race_id> ...]   record every page a race needs
+#   python stub_server.py [--port N] [--latency S] [--latency-sigma X] [--error-rate P] [--rate-limit R]
+#   NETKEIBA_BASE_URL=http://127.0.0.1:8766 python main.py <race URL>
+#   python stub_server.py --bench <race_id> [<race_id> ...] [options]   run main.main against the stub
+#
+# GET /_stats returns request counts per page kind and status, and latency percentiles.
+#
+# Stand-in pages (a default horse page served for any id, above all) must never be stored as real
+# data, so while a base URL is set every store in STORE_PATHS points into a fresh scratch directory
+# (use_scratch_stores). A bench therefore also starts from empty stores and measures fetching,
+# not reads of earlier runs.
+
+FIXTURE_DIR = "/Users/akahoshihiroki/Documents/pytests/keiba_yosou/netkeiba_fixtures"
+DEFAULT_PORT = 8766
+
+# Simulated server behaviour
+DEFAULT_LATENCY_SECONDS = 0.2 # median response time
+DEFAULT_LATENCY_SIGMA = 0.5   # log-normal spread; larger values give a longer tail
+DEFAULT_ERROR_RATE = 0.0      # fraction of requests answered with 500
+DEFAULT_RATE_LIMIT = 0.0      # requests per second before 429 (0 = unlimited)
+RETRY_AFTER_SECONDS = 1
+
+# Page kinds by URL path, first match wins.
+PAGE_KINDS = (
+    ('shutuba', r'^race\.netkeiba\.com/race/shutuba\.html'),
+    ('result', r'^race\.netkeiba\.com/race/result\.html'),
+    ('race_list', r'^race\.netkeiba\.com/top/race_list_sub\.html'),
+    ('jockey_leading', r'^db\.netkeiba\.com/jockey/jockey_leading_jra\.html'),
+    ('jockey', r'^db\.netkeiba\.com/jockey/'),
+    ('sire', r'^db\.netkeiba\.com/horse/sire/'),
+    ('bms', r'^db\.netkeiba\.com/horse/bms/'),
+    ('horse', r'^db\.netkeiba\.com/horse/'),
+)
+# Kinds for which any recorded page stands in for an unrecorded id, so a load test can ask for
+# more horses than were recorded. Paginated kinds are left out: a stand-in page would never end.
+DEFAULT_FIXTURE_KINDS = ('shutuba', 'result', 'horse', 'jockey', 'sire', 'bms')
+
+# On-disk stores written from fetched pages: (module, path attribute, name in the scratch directory).
+STORE_PATHS = (
+    ('horse_cache', 'CACHE_DIR', 'horse_cache'),
+    ('horse_cache', 'INDEX_FILE', 'horse_cache_index.csv'),
+    ('horse_cache', 'CALENDAR_FILE', 'race_calendar.csv'),
+    ('warehouse', 'RESULTS_FILE', 'warehouse_results.csv'),
+    ('warehouse', 'JOCKEYS_FILE', 'warehouse_jockeys.csv'),
+    ('pedigree', 'GRAPH_FILE', 'pedigree_graph.csv'),
+    ('odds_history', 'ODDS_HISTORY_DIR', 'odds_history'),
+    ('scraping', 'SHUTUBA_CSV_FORMAT', 'shutuba_{race_id}.csv'),
+    ('data_fetcher', 'JOCKEY_LEADING_CSV_FORMAT', 'jockey_leading_{year}.csv'),
+    ('course_index', 'COURSE_INDEX_FILE', 'course_index.npz'),
+    ('course_index', 'COURSE_LAPS_FILE', 'course_laps.csv'),
+    ('main', 'PREDICTION_CACHE_FILE_FORMAT', 'prediction_{race_id}.json'),
+)
+# Module state loaded from those stores, dropped whenever the paths change
+STORE_STATE = (
+    ('horse_cache', '_index', None), ('horse_cache', '_calendar', dict),
+    ('warehouse', '_results', None), ('warehouse', '_result_keys', set),
+    ('warehouse', '_jockey_names', dict), ('warehouse', '_aggregates', dict),
+    ('warehouse', '_aggregates_as_of', dict),
+    ('pedigree', '_graph', None), ('odds_history', '_last_values', dict),
+    ('course_index', '_index', None), ('course_index', '_recorded_laps', None),
+)
+
+def page_kind(target):
+    """Page kind of a '<host><path>?<query>' target, or None if it is not a netkeiba page we know."""
+    for kind, pattern in PAGE_KINDS:
+        if re.match(pattern, target):
+            return kind
+    return None
+
+def fixture_path(target):
+    """File holding the recorded page for a '<host><path>?<query>' target."""
+    return os.path.join(FIXTURE_DIR, re.sub(r'[^\w.-]', '_', target.rstrip('/')) + '.html')
+
+def default_fixture_path(kind):
+    return os.path.join(FIXTURE_DIR, f"_default_{kind}.html")
+
+def url_to_target(url):
+    parts = urlsplit(url)
+    return f"{parts.netloc}{parts.path}" + (f"?{parts.query}" if parts.query else "")
+
+# --- Scratch stores ---
+
+def _store_module(name):
+    """The module of a store, which is __main__ when that file is the running script (python main.py)."""
+    script = sys.modules.get('__main__')
+    if os.path.basename(getattr(script, '__file__', None) or '') == f"{name}.py":
+        return script
+    return importlib.import_module(name)
+
+def _reset_store_state():
+    for module_name, attribute, initial in STORE_STATE:
+        setattr(_store_module(module_name), attribute, initial() if initial else None)
+
+def use_scratch_stores(directory=None):
+    """
+    Points every STORE_PATHS store into directory (a new temporary one by default).
+
+    Returns:
+        dict: The state restore_stores needs: 'directory' and the previous 'paths'.
+    """
+    directory = directory or tempfile.mkdtemp(prefix="netkeiba_stub_")
+    paths = {}
+    for module_name, attribute, name in STORE_PATHS:
+        module = _store_module(module_name)
+        paths[module_name, attribute] = getattr(module, attribute)
+        setattr(module, attribute, os.path.join(directory, name))
+    _reset_store_state()
+    print(f"スタブ使用中のためデータはスクラッチ領域に保存されます: {directory}")
+    return {'directory': directory, 'paths': paths}
+
+def restore_stores(scratch):
+    """Points the stores back at their real paths and removes the scratch directory."""
+    for (module_name, attribute), path in scratch['paths'].items():
+        setattr(_store_module(module_name), attribute, path)
+    _reset_store_state()
+    shutil.rmtree(scratch['directory'], ignore_errors=True)
+
+# --- Recording ---
+
+def record_page(url):
+    """Fetches url from the real site and stores it as a fixture. Returns the page bytes or None."""
+    import data_fetcher
+    try:
+        response = data_fetcher.SESSION.get(url)
+        response.raise_for_status()
+    except Exception as e:
+        print(f"記録に失敗しました ({url}): {e}")
+        return None
+    target = url_to_target(url)
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    with open(fixture_path(target), 'wb') as f:
+        f.write(response.content)
+    kind = page_kind(target)
+    if kind in DEFAULT_FIXTURE_KINDS and not os.path.exists(default_fixture_path(kind)):
+        with open(default_fixture_path(kind), 'wb') as f:
+            f.write(response.content)
+    time.sleep(1)
+    return response.content
+
+def record_race(race_id):
+    """Records the shutuba and result pages of a race and the pages of every entity it references."""
+    import pandas as pd
+    from scraping import fetch_shutuba_horse_data
+    record_page(f"https://race.netkeiba.com/race/shutuba.html?race_id={race_id}")
+    record_page(f"https://race.netkeiba.com/race/result.html?race_id={race_id}")
+    horse_list = fetch_shutuba_horse_data(race_id)
+    if not horse_list:
+        return 0
+    df_shutuba = pd.DataFrame(horse_list)
+    urls = [f"https://db.netkeiba.com/jockey/jockey_leading_jra.html?year={race_id[:4]}&page=1"]
+    urls += [f"https://db.netkeiba.com/horse/{horse_id}" for horse_id in df_shutuba['horse_id'].dropna()]
+    urls += [f"https://db.netkeiba.com/jockey/{int(float(jockey_cd)):05d}/" for jockey_cd in df_shutuba['jockey_cd'].dropna()]
+    urls += [f"https://db.netkeiba.com/horse/sire/{sire_id}/" for sire_id in df_shutuba['sire_id'].dropna()]
+    urls += [f"https://db.netkeiba.com/horse/bms/{bms_id}/" for bms_id in df_shutuba['bms_id'].dropna()]
+    recorded = 2
+    for url in dict.fromkeys(urls):
+        if os.path.exists(fixture_path(url_to_target(url))):
+            continue
+        recorded += record_page(url) is not None
+    return recorded
+
+# --- Serving ---
+
+_stats_lock = threading.Lock()
+_stats = {'counts': {}, 'latencies': []}
+
+def reset_stats():
+    with _stats_lock:
+        _stats['counts'].clear()
+        _stats['latencies'].clear()
+
+def get_stats():
+    """Request counts per 'kind status' and latency percentiles (seconds) of the answered requests."""
+    with _stats_lock:
+        latencies = sorted(_stats['latencies'])
+        counts = dict(_stats['counts'])
+    percentiles = {}
+    for q in (50, 90, 95, 99):
+        percentiles[f"p{q}"] = latencies[min(len(latencies) - 1, int(len(latencies) * q / 100))] if latencies else None
+    return {'requests': sum(counts.values()), 'counts': counts, 'latency': percentiles}
+
+def make_handler(latency=DEFAULT_LATENCY_SECONDS, latency_sigma=DEFAULT_LATENCY_SIGMA,
+                 error_rate=DEFAULT_ERROR_RATE, rate_limit=DEFAULT_RATE_LIMIT, seed=None):
+    """Request handler class with the given simulated behaviour."""
+    rng = random.Random(seed)
+    # Token bucket: rate_limit tokens per second, bursts of up to rate_limit requests.
+    bucket = {'tokens': rate_limit, 'updated': time.monotonic()}
+    bucket_lock = threading.Lock()
+
+    def take_token():
+        if rate_limit <= 0:
+            return True
+        with bucket_lock:
+            now = time.monotonic()
+            bucket['tokens'] = min(rate_limit, bucket['tokens'] + (now - bucket['updated']) * rate_limit)
+            bucket['updated'] = now
+            if bucket['tokens'] < 1:
+                return False
+            bucket['tokens'] -= 1
+            return True
+
+    class StubRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            start = time.perf_counter()
+            if self.path == '/_stats':
+                self._send(200, json.dumps(get_stats()).encode('utf-8'), 'application/json')
+                return
+            target = self.path.lstrip('/')
+            kind = page_kind(target)
+            if not take_token():
+                status, body = 429, b''
+            else:
+                # Log-normal response time around the median
+                time.sleep(latency * math.exp(rng.gauss(0, latency_sigma)) if latency > 0 else 0)
+                status, body = self._page(target, kind)
+            self._send(status, body, 'text/html')
+            with _stats_lock:
+                key = f"{kind} {status}"
+                _stats['counts'][key] = _stats['counts'].get(key, 0) + 1
+                _stats['latencies'].append(time.perf_counter() - start)
+
+        def _page(self, target, kind):
+            if kind is None:
+                return 404, b''
+            if error_rate > 0 and rng.random() < error_rate:
+                return 500, b''
+            path = fixture_path(target)
+            if not os.path.exists(path) and kind in DEFAULT_FIXTURE_KINDS:
+                path = default_fixture_path(kind)
+            if not os.path.exists(path):
+                return 404, b''
+            with open(path, 'rb') as f:
+                return 200, f.read()
+
+        def _send(self, status, body, content_type):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            if status == 429:
+                self.send_header('Retry-After', str(RETRY_AFTER_SECONDS))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # One line per request would drown the benchmark output
+
+    return StubRequestHandler
+
+def start_stub_server(port=0, **behaviour):
+    """Starts the stand-in in a daemon thread. Returns (server, base_url); port 0 picks a free port."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(**behaviour))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def run_bench(race_ids, **behaviour):
+    """Predicts each race against a fresh stand-in, with empty scratch stores, and prints throughput and latency."""
+    import data_fetcher
+    import main as predictor
+    from card import SHUTUBA_URL_FORMAT
+
+    server, base_url = start_stub_server(**behaviour)
+    data_fetcher.set_base_url(base_url) # Also moves the stores to a scratch directory
+    reset_stats()
+    start = time.perf_counter()
+    race_times = []
+    try:
+        for race_id in race_ids:
+            race_start = time.perf_counter()
+            predictor.main(SHUTUBA_URL_FORMAT.format(race_id=race_id))
+            race_times.append(time.perf_counter() - race_start)
+    finally:
+        data_fetcher.set_base_url(None)
+        server.shutdown()
+    elapsed = time.perf_counter() - start
+    stats = get_stats()
+    print("\n--- スタブサーバー ベンチマーク ---")
+    print(f"レース数: {len(race_times)}, 合計 {elapsed:.1f}秒, 1レース平均 {elapsed / max(len(race_times), 1):.2f}秒, 最大 {max(race_times, default=0):.2f}秒")
+    print(f"リクエスト数: {stats['requests']} ({stats['requests'] / elapsed:.1f} req/s)")
+    print("応答時間: " + ", ".join(f"{q} {v * 1000:.0f} ms" for q, v in stats['latency'].items() if v is not None))
+    for key, count in sorted(stats['counts'].items()):
+        print(f"  {key}: {count}")
+    return stats
+
+def parse_options(args):
+    """Splits --option value pairs from positional arguments."""
+    options = {}
+    positional = []
+    names = {'--port': ('port', int), '--latency': ('latency', float), '--latency-sigma': ('latency_sigma', float),
+             '--error-rate': ('error_rate', float), '--rate-limit': ('rate_limit', float), '--seed': ('seed', int)}
+    i = 0
+    while i < len(args):
+        if args[i] in names and i + 1 < len(args):
+            name, cast = names[args[i]]
+            options[name] = cast(args[i + 1])
+            i += 2
+        else:
+            positional.append(args[i])
+            i += 1
+    return positional, options
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--record':
+        for race_id in sys.argv[2:]:
+            print(f"{race_id}: {record_race(race_id)}ページを記録しました。")
+        sys.exit(0)
+
+    if len(sys.argv) > 2 and sys.argv[1] == '--bench':
+        race_ids, options = parse_options(sys.argv[2:])
+        options.pop('port', None)
+        run_bench(race_ids, **options)
+        sys.exit(0)
+
+    _, options = parse_options(sys.argv[1:])
+    port = options.pop('port', DEFAULT_PORT)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(**options))
+    server.daemon_threads = True
+    print(f"netkeibaスタブサーバーを起動しました: http://127.0.0.1:{port} (fixtures: {FIXTURE_DIR})")
+    print(f"使用法: NETKEIBA_BASE_URL=http://127.0.0.1:{port} python main.py <URL>")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("スタブサーバーを停止します。")
+    finally:
+        server.server_close()
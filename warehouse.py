@@ -0,0 +1,202 @@
+import os
+import re
+
+import pandas as pd
+
+import pedigree
+from history import parse_rank
+
+# Local history warehouse.
+# Every horse page we parse contains that horse's past races. Collected over many
+# horses, those rows are enough to compute course aptitude (starts, win rate, rentai
+# rate by surface/distance/condition) for jockeys, sires and BMS locally, instead of
+# scraping one aptitude page per entity per runner.
+#
+# Sires and BMS come from the pedigree graph (pedigree.py). Stored as append-only CSV files:
+#   warehouse_results.csv   one row per (horse_id, date): surface, distance, condition, rank, jockey
+#   warehouse_jockeys.csv   jockey_cd -> jockey_name (history rows only carry the name)
+# Aggregates are built with one groupby when the warehouse is loaded and then updated
+# incrementally as new rows are ingested.
+#
+# Those aggregates cover every stored date, so a backtest would see results from after its race.
+# get_course_aptitude(..., as_of=date) aggregates only the rows dated before it instead (one
+# groupby per kind and date, memoised until new rows arrive). The getters in data_fetcher.py pass
+# as_of through, but no live scorer path reads course aptitude (scorer.get_horse_score_components
+# has no jockey / sire / BMS term), so this engine serves ad-hoc analysis only.
+
+RESULTS_FILE = "/Users/akahoshihiroki/Documents/pytests/keiba_yosou/warehouse_results.csv"
+JOCKEYS_FILE = "/Users/akahoshihiroki/Documents/pytests/keiba_yosou/warehouse_jockeys.csv"
+
+RESULT_COLUMNS = ['horse_id', 'date', 'surface', 'distance', 'condition', 'rank', 'jockey']
+JOCKEY_COLUMNS = ['jockey_cd', 'jockey_name']
+AGGREGATE_KEY = ['surface', 'distance', 'condition']
+
+# Below this many local starts an entity's aptitude falls back to the scraped page.
+MIN_LOCAL_APTITUDE_STARTS = 30
+
+_results = None         # DataFrame of RESULT_COLUMNS
+_result_keys = set()    # (horse_id, date) already stored
+_jockey_names = {}      # jockey_cd -> jockey_name
+_aggregates = {}        # kind ('jockey', 'sire', 'bms') -> DataFrame indexed by (entity,) + AGGREGATE_KEY
+_aggregates_as_of = {}  # (kind, 'YYYY-MM-DD') -> the same over the rows dated before that day
+
+def normalize_id(value):
+    """Returns ids as strings, dropping the '.0' pandas adds to numeric codes. None if empty."""
+    if value is None or pd.isna(value):
+        return None
+    if isinstance(value, float):
+        value = int(value)
+    value = str(value).strip()
+    if not value:
+        return None
+    return str(int(value)) if value.isdigit() and len(value) <= 5 else value # jockey_cd '01174' -> '1174'
+
+def _cell(row, column):
+    """Returns a history cell as a stripped string, '' when empty."""
+    value = row.get(column)
+    return '' if value is None or pd.isna(value) else str(value).strip()
+
+def _read_csv(path, columns):
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=columns)
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+def _append_csv(path, df):
+    try:
+        df.to_csv(path, mode='a', header=not os.path.exists(path), index=False)
+    except OSError as e:
+        print(f"ウェアハウスへの書き込みに失敗しました ({path}): {e}")
+
+def _aggregate(results, kind):
+    """Grouped starts/wins/rentai counts for one entity kind over a block of result rows."""
+    if kind == 'jockey':
+        rows = results.rename(columns={'jockey': 'entity'})
+    else:
+        rows = results.assign(entity=results['horse_id'].map(
+            lambda horse_id: pedigree.get_parents(horse_id)[0 if kind == 'sire' else 2]))
+    rows = rows.dropna(subset=['entity'])
+    ranks = rows['rank'].astype(int)
+    counts = rows.assign(starts=1, wins=(ranks == 1).astype(int), rentai=((ranks >= 1) & (ranks <= 2)).astype(int))
+    return counts.groupby(['entity'] + AGGREGATE_KEY)[['starts', 'wins', 'rentai']].sum()
+
+def _add_to_aggregates(results, kinds=('jockey', 'sire', 'bms')):
+    _aggregates_as_of.clear()
+    for kind in kinds:
+        delta = _aggregate(results, kind)
+        if delta.empty:
+            continue
+        current = _aggregates.get(kind)
+        _aggregates[kind] = delta if current is None or current.empty else current.add(delta, fill_value=0).astype(int)
+
+def load():
+    """Loads the warehouse files and builds the aggregates. Called lazily on first use."""
+    global _results
+    if _results is not None:
+        return
+    for _, row in _read_csv(JOCKEYS_FILE, JOCKEY_COLUMNS).iterrows():
+        _jockey_names[normalize_id(row['jockey_cd'])] = row['jockey_name']
+    _results = _read_csv(RESULTS_FILE, RESULT_COLUMNS)
+    _results['distance'] = pd.to_numeric(_results['distance'], errors='coerce').fillna(0).astype(int)
+    _results['rank'] = pd.to_numeric(_results['rank'], errors='coerce').fillna(0).astype(int)
+    _results['jockey'] = _results['jockey'].replace('', None)
+    _result_keys.update(zip(_results['horse_id'], _results['date']))
+    _aggregates.clear()
+    _add_to_aggregates(_results)
+
+def ingest_horse_results(horse_id, race_results_df):
+    """Adds the rows of a parsed horse page that are not stored yet. Returns the number of new rows."""
+    load()
+    global _results
+    if race_results_df is None or race_results_df.empty:
+        return 0
+    horse_id = str(horse_id)
+    dates = pd.to_datetime(race_results_df.get('日付', pd.Series(index=race_results_df.index)), errors='coerce')
+    new_rows = []
+    for (_, row), date in zip(race_results_df.iterrows(), dates):
+        if pd.isna(date) or (horse_id, date.strftime('%Y-%m-%d')) in _result_keys:
+            continue
+        distance = _cell(row, '距離')
+        distance_match = re.search(r'\d+', distance)
+        new_rows.append({
+            'horse_id': horse_id,
+            'date': date.strftime('%Y-%m-%d'),
+            'surface': distance[:1],
+            'distance': int(distance_match.group()) if distance_match else 0,
+            'condition': _cell(row, '馬 場'),
+            'rank': parse_rank(row.get('着 順')),
+            'jockey': _cell(row, '騎手') or None,
+        })
+    if not new_rows:
+        return 0
+    new_df = pd.DataFrame(new_rows, columns=RESULT_COLUMNS)
+    _result_keys.update(zip(new_df['horse_id'], new_df['date']))
+    _results = pd.concat([_results, new_df], ignore_index=True)
+    _add_to_aggregates(new_df)
+    _append_csv(RESULTS_FILE, new_df)
+    return len(new_rows)
+
+def register_pedigree(horse_id, sire_id=None, mare_id=None, bms_id=None):
+    """Adds pedigree edges to the graph. Rows already stored for the horse are added to the
+    aggregates of a sire or BMS that was not known before."""
+    load()
+    horse_id = str(horse_id)
+    (old_sire, _, old_bms), (sire_id, _, bms_id) = pedigree.add_parents(horse_id, sire_id, mare_id, bms_id)
+    kinds = [kind for kind, old, new in (('sire', old_sire, sire_id), ('bms', old_bms, bms_id)) if old is None and new]
+    if not kinds:
+        return
+    horse_rows = _results[_results['horse_id'] == horse_id]
+    if not horse_rows.empty:
+        _add_to_aggregates(horse_rows, kinds)
+
+def ingest_shutuba(df_shutuba):
+    """Registers pedigree (sire/mare/BMS) and jockey code -> name mappings from a shutuba table."""
+    load()
+    new_jockeys = []
+    for _, row in df_shutuba.iterrows():
+        register_pedigree(row['horse_id'], row.get('sire_id'), row.get('mare_id'), row.get('bms_id'))
+        jockey_cd = normalize_id(row.get('jockey_cd'))
+        if jockey_cd and not pd.isna(row.get('jockey_name')) and jockey_cd not in _jockey_names:
+            _jockey_names[jockey_cd] = str(row['jockey_name'])
+            new_jockeys.append([jockey_cd, _jockey_names[jockey_cd]])
+    if new_jockeys:
+        _append_csv(JOCKEYS_FILE, pd.DataFrame(new_jockeys, columns=JOCKEY_COLUMNS))
+
+def _aggregate_as_of(kind, as_of):
+    """The aggregate of a kind over every row (as_of None) or over the rows dated before as_of."""
+    if as_of is None:
+        return _aggregates.get(kind)
+    key = (kind, pd.Timestamp(as_of).strftime('%Y-%m-%d'))
+    if key not in _aggregates_as_of:
+        _aggregates_as_of[key] = _aggregate(_results[_results['date'] < key[1]], kind)
+    return _aggregates_as_of[key]
+
+def get_course_aptitude(kind, entity_id, min_starts=MIN_LOCAL_APTITUDE_STARTS, as_of=None):
+    """
+    Course aptitude computed from the warehouse, shaped like the scraped コース別成績 tables.
+
+    Args:
+        kind (str): 'jockey', 'sire' or 'bms'.
+        entity_id: jockey_cd, sire_id or bms_id.
+        min_starts (int): Minimum local starts needed to trust the local figures.
+        as_of (date): Count only races before this date (None: every stored race).
+
+    Returns:
+        pd.DataFrame: Columns コース, 出走数, 勝率, 連対率 (rates as fractions), or None when
+        the warehouse does not hold enough data for this entity.
+    """
+    load()
+    entity_id = normalize_id(entity_id)
+    if kind == 'jockey':
+        entity_id = _jockey_names.get(entity_id)
+    aggregate = _aggregate_as_of(kind, as_of)
+    if entity_id is None or aggregate is None or entity_id not in aggregate.index.get_level_values(0):
+        return None
+    stats = aggregate.xs(entity_id, level=0).reset_index()
+    if stats['starts'].sum() < min_starts:
+        return None
+    return pd.DataFrame({
+        'コース': (stats['surface'] + stats['distance'].astype(str) + ' ' + stats['condition']).str.strip(),
+        '出走数': stats['starts'],
+        '勝率': stats['wins'] / stats['starts'],
+        '連対率': stats['rentai'] / stats['starts'],
+    })
@@ -0,0 +1,141 @@
+import re
+import sys
+import time
+
+import pandas as pd
+
+import main as predictor
+from betting import race_odds
+from scorer import calculate_race_day_score
+from scraping import refresh_shutuba_data
+
+# Race-day watch mode: polls the shutuba page, updates the local CSV with the runners whose
+# update_datetime changed (scraping.refresh_shutuba_data) and re-scores only those. Odds and weight updates only touch calculate_race_day_score, so
+# each runner's history-dependent part (base_score) is computed once and reused.
+
+DEFAULT_POLL_INTERVAL_SECONDS = 60
+
+# Shutuba fields expected to move on race day.
+RACE_DAY_FIELDS = ['odds', 'yoso_odds', 'yoso_ninki', 'weight', 'weight_sa']
+
+# Fields handed to get_horse_total_score (see main.score_shutuba_row). A change in any of
+# these that is not a race-day field (e.g. a jockey change) triggers a full re-score of that runner.
+SCORING_FIELDS = [
+    'horse_id', 'sire_id', 'bms_id', 'yoso_ninki', 'jockey_name', 'jockey_cd',
+    'futan', 'weight', 'weight_sa', 'wakuban', 'odds', 'corner', 'kyaku', 'time', 'pace',
+    'harontimel3', 'chakusa', 'sex', 'age', 'blinker', 'norikawari', 'trainer_syozoku', 'owner_cd',
+]
+
+def values_differ(old_value, new_value):
+    """Compares two shutuba cell values, treating NaN as equal to NaN."""
+    if pd.isna(old_value) and pd.isna(new_value):
+        return False
+    return old_value != new_value
+
+def changed_fields(old_row, new_row):
+    """Columns whose value differs between a runner's previous and current shutuba row."""
+    return {c for c in new_row.index if c in old_row.index and c != 'update_datetime'
+            and values_differ(old_row[c], new_row[c])}
+
+def by_horse_id(df_shutuba):
+    """Shutuba rows indexed by horse_id as text, the key of refresh_shutuba_data's change sets."""
+    return df_shutuba.set_index(df_shutuba['horse_id'].astype(str), drop=False)
+
+def score_runner(row, race_info, lap_times=None):
+    """Fully scores a runner and splits the score into its fixed and race-day parts."""
+    score = predictor.score_shutuba_row(row, race_info, lap_times)
+    return {
+        'umaban': row['umaban'],
+        'horse_name': row['horse_name'],
+        'score': score,
+        'base_score': score - calculate_race_day_score(row['weight_sa'], row['odds']),
+        'odds': race_odds(row),
+    }
+
+def rescore_race_day(entry, row):
+    """Updates a runner's score after a change limited to race-day fields."""
+    entry['score'] = entry['base_score'] + calculate_race_day_score(row['weight_sa'], row['odds'])
+    entry['odds'] = race_odds(row)
+
+def poll_shutuba(race_id):
+    """
+    Refreshes the local CSV from the current shutuba and reads it back as main() would.
+
+    Returns:
+        tuple: (DataFrame, refresh_shutuba_data's change set), or (None, None) if the fetch failed.
+    """
+    csv_path, changes = refresh_shutuba_data(race_id)
+    if not csv_path:
+        return None, None
+    return pd.read_csv(csv_path), changes
+
+def watch_race(race_url, interval=DEFAULT_POLL_INTERVAL_SECONDS, max_polls=None, lap_times=None, bet_strategy='fixed'):
+    """Polls the race's shutuba every `interval` seconds and prints updated rankings and bets.
+    With bet_strategy='ev' the expected-value bets are re-optimised against the odds of every poll."""
+    race_id_match = re.search(r'race_id=(\d+)', race_url)
+    if not race_id_match:
+        print("URLからrace_idが見つかりません。")
+        return
+    race_id = race_id_match.group(1)
+
+    race_info = predictor.get_race_info_from_url(race_url)
+    if not race_info:
+        return
+
+    df_shutuba = None
+    entries = {}
+    polls = 0
+    while max_polls is None or polls < max_polls:
+        if polls > 0:
+            time.sleep(interval)
+        polls += 1
+
+        new_df, changes = poll_shutuba(race_id)
+        if new_df is None:
+            print("出馬表の取得に失敗しました。次のポーリングまで待機します。")
+            continue
+
+        start = time.perf_counter()
+        # Keyed by horse_id: umaban is empty for every runner before the draw
+        new_rows = by_horse_id(new_df)
+        if df_shutuba is None:
+            for horse_id, row in new_rows.iterrows():
+                entries[horse_id] = score_runner(row, race_info, lap_times)
+            print(f"\n--- 初回スコア計算 ({len(entries)}頭) ---")
+        else:
+            if not any(changes.values()):
+                print(f"[{time.strftime('%H:%M:%S')}] 変更なし")
+                continue
+            old_rows = by_horse_id(df_shutuba)
+            for horse_id in changes['removed']:
+                entries.pop(horse_id, None)
+            for horse_id in changes['added']:
+                entries[horse_id] = score_runner(new_rows.loc[horse_id], race_info, lap_times)
+            for horse_id in changes['changed']:
+                row = new_rows.loc[horse_id]
+                fields = changed_fields(old_rows.loc[horse_id], row)
+                if fields & (set(SCORING_FIELDS) - set(RACE_DAY_FIELDS)):
+                    entries[horse_id] = score_runner(row, race_info, lap_times)
+                elif fields & set(RACE_DAY_FIELDS):
+                    rescore_race_day(entries[horse_id], row)
+                entries[horse_id]['umaban'] = row['umaban'] # Filled in at the draw
+                print(f"  馬番 {row['umaban']} ({row['horse_name']}): {', '.join(sorted(fields))}")
+            print(f"\n--- [{time.strftime('%H:%M:%S')}] 更新: 変更{len(changes['changed'])}頭, "
+                  f"追加{len(changes['added'])}頭, 除外{len(changes['removed'])}頭 ---")
+        df_shutuba = new_df
+
+        sorted_horses = sorted(entries.values(), key=lambda x: x['score'], reverse=True)
+        recommended_bets = predictor.build_recommended_bets(sorted_horses, bet_strategy)
+        print(f"再計算: {(time.perf_counter() - start) * 1000:.1f} ms")
+        predictor.print_prediction(sorted_horses, recommended_bets)
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if a != '--ev']
+    if args:
+        interval = float(args[1]) if len(args) > 1 else DEFAULT_POLL_INTERVAL_SECONDS
+        try:
+            watch_race(args[0], interval, bet_strategy='ev' if '--ev' in sys.argv else 'fixed')
+        except KeyboardInterrupt:
+            print("\n監視を終了します。")
+    else:
+        print("使用法: python watch.py <レースページのURL> [ポーリング間隔(秒)] [--ev]")